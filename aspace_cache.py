@@ -0,0 +1,358 @@
+"""Caching wrappers for the ArchivesSpace API client.
+
+aspaceRecordCache sits in front of an archivesspace.ArchivesSpace instance and
+answers repeat GETs for the same URI from memory. It can be passed anywhere an
+aspace client is expected, e.g. to record_funcs.aspaceRecordFuncs.
+
+Records are handed out as deep copies so that callers which rewrite records in
+place (e.g. getAgents renaming jsonmodel_type) can't corrupt the cache. A
+transform such as authorities.authorityNormalizer.normalizeRecord can tidy up
+each record once as it enters the cache.
+
+aspacePersistentCache keeps full JSONModel records (anything with a
+lock_version) in an SQLite file between runs. When it is opened it asks
+ArchivesSpace which of the cached records were modified since the last run and
+drops only those, so a repeat export refetches just the changed records. The
+server the records came from is kept with them, and a cache file opened for a
+different server is emptied first. Chain the two for a nightly export:
+
+    server = getServerName('archivesspace.cfg', 'production')
+    aspace = aspaceRecordCache(aspacePersistentCache(aspace, 'aspace-cache.sqlite', server=server))
+"""
+import calendar
+import collections
+import configparser
+import contextlib
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+# Allowance for clock differences between us and the ArchivesSpace server when
+# asking it for records modified since the last run.
+CLOCK_SKEW_SECONDS = 300
+
+
+def parseMtime(system_mtime):
+    ' Returns an ArchivesSpace system_mtime such as 2019-01-01T00:00:00Z as seconds since the epoch, or None '
+
+    try:
+        return calendar.timegm(time.strptime(system_mtime, '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return None
+
+
+def getServerName(config_file, section):
+    ' Returns protocol://hostname:port for a server section of an archivesspace.cfg, or the section name if it can\'t be read '
+
+    config = configparser.ConfigParser()
+    if not config.read(config_file) or not (section == config.default_section or config.has_section(section)):
+        return section
+    settings = config[section]
+    return '%s://%s:%s' % (settings.get('protocol', 'http'), settings.get('hostname', ''), settings.get('port', ''))
+
+
+def getModifiedIds(aspace, endpoint, since):
+    ' Returns the set of ids of records under a list endpoint (e.g. /subjects) modified since the epoch time since '
+    ' Returns None if ArchivesSpace could not say, in which case every record should be treated as modified '
+
+    try:
+        response = aspace.get(endpoint + '?all_ids=true&modified_since=%d' % since)
+    except Exception as e:
+        logging.warning('Could not check %s for modified records: %s' % (endpoint, e))
+        return None
+
+    if not isinstance(response, list):
+        logging.warning('Unexpected response checking %s for modified records: %s' % (endpoint, response))
+        return None
+
+    modified = set()
+    for item in response:
+        if isinstance(item, dict):
+            # Endpoints like /repositories list whole records and ignore modified_since
+            mtime = parseMtime(item.get('system_mtime'))
+            if mtime is None or mtime > since:
+                modified.add(item.get('uri', '').rsplit('/', 1)[-1])
+        else:
+            modified.add(str(item))
+
+    return modified
+
+
+class aspaceRecordCache(object):
+    def __init__(self, aspace, maxsize=DEFAULT_CACHE_SIZE, transform=None):
+        ' transform, if given, is called on each record as it enters the cache and returns the record to keep '
+
+        self.aspace = aspace
+        self.maxsize = maxsize
+        self.transform = transform
+        self.records = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Safe to share between worker threads. A URI being fetched by one
+        # thread is waited on by the others rather than fetched again.
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.reads = threading.local()
+
+    def get(self, uri, *args, **kwargs):
+        ' Returns a copy of the record at uri, fetching it only if it is not cached '
+
+        if args or kwargs or '?' in uri:
+            # Requests with extra parameters aren't keyed by URI alone
+            return self.aspace.get(uri, *args, **kwargs)
+
+        while True:
+            with self.lock:
+                if uri in self.records:
+                    logging.debug('Cache hit for %s' % uri)
+                    self.hits += 1
+                    self.records.move_to_end(uri)
+                    self.noteRead(uri, self.records[uri])
+                    return copy.deepcopy(self.records[uri])
+                fetching = self.pending.get(uri)
+                if fetching is None:
+                    logging.debug('Cache miss for %s' % uri)
+                    self.misses += 1
+                    self.pending[uri] = threading.Event()
+                    break
+            fetching.wait()
+
+        try:
+            record = self.aspace.get(uri)
+            if isinstance(record, dict) and 'error' in record:
+                # Possibly transient, so the next lookup asks again
+                logging.debug('Not caching error for %s: %s' % (uri, record['error']))
+            else:
+                if self.transform is not None:
+                    record = self.transform(record)
+                self.store(uri, record)
+        finally:
+            with self.lock:
+                self.pending.pop(uri).set()
+
+        self.noteRead(uri, record)
+        return record
+
+    @contextlib.contextmanager
+    def trackReads(self):
+        ' Collects the URI and [lock_version, system_mtime] of every record this thread reads inside the with block '
+
+        # Blocks can nest; the outer one carries on once the inner one is done
+        outer = getattr(self.reads, 'inputs', None)
+        inputs = {}
+        self.reads.inputs = inputs
+        try:
+            yield inputs
+        finally:
+            self.reads.inputs = outer
+
+    def noteRead(self, uri, record):
+        inputs = getattr(self.reads, 'inputs', None)
+        if inputs is not None and isinstance(record, dict) and 'lock_version' in record:
+            inputs[uri] = [record['lock_version'], record.get('system_mtime')]
+
+    def noteInputs(self, inputs):
+        ' Counts records collected by an earlier trackReads block, e.g. ones shared by many records, as read by this thread too '
+
+        current = getattr(self.reads, 'inputs', None)
+        if current is not None:
+            current.update(inputs)
+
+    def store(self, uri, record):
+        ' Adds a copy of record to the cache under uri, evicting the least recently used records if full '
+
+        record = copy.deepcopy(record)
+        with self.lock:
+            self.records[uri] = record
+            self.records.move_to_end(uri)
+            while len(self.records) > self.maxsize:
+                self.records.popitem(last=False)
+                self.evictions += 1
+
+    def prime(self, uri, record):
+        ' Adds a record fetched some other way, e.g. in a batch, to this cache and any cache it wraps '
+
+        # Wrapped caches keep the record as ArchivesSpace sent it
+        if hasattr(self.aspace, 'prime'):
+            self.aspace.prime(uri, record)
+        if self.transform is not None:
+            record = self.transform(copy.deepcopy(record))
+        self.store(uri, record)
+
+    def isCached(self, uri):
+        with self.lock:
+            if uri in self.records:
+                return True
+        if hasattr(self.aspace, 'isCached'):
+            return self.aspace.isCached(uri)
+        return False
+
+    def invalidate(self, uri):
+        with self.lock:
+            self.records.pop(uri, None)
+
+    def post(self, uri, *args, **kwargs):
+        ' Posts through to the client and drops the now stale cached record '
+
+        self.invalidate(uri)
+        return self.aspace.post(uri, *args, **kwargs)
+
+    def __getattr__(self, name):
+        # Anything we don't cache goes straight to the wrapped client
+        return getattr(self.aspace, name)
+
+    def logStats(self):
+        requests = self.hits + self.misses
+        if requests > 0:
+            hit_ratio = 100.0 * self.hits / requests
+        else:
+            hit_ratio = 0.0
+        logging.info('Record cache: %s requests, %s hits, %s misses (%.1f%% hit ratio), %s evictions, %s records cached' % (requests, self.hits, self.misses, hit_ratio, self.evictions, len(self.records)))
+
+
+# Number of newly fetched records to write before committing to disk
+COMMIT_INTERVAL = 100
+
+
+class aspacePersistentCache(object):
+    def __init__(self, aspace, path, max_age=None, purge=False, server=None):
+        ' max_age is in seconds; records fetched longer ago than that are refetched regardless '
+        ' server names the ArchivesSpace the records come from; a cache filled from any other server is purged '
+
+        self.aspace = aspace
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.uncommitted = 0
+        # One connection shared by all worker threads, serialised by the lock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS records (uri TEXT PRIMARY KEY, body BLOB, lock_version INTEGER, system_mtime TEXT, fetched_at REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+        if purge:
+            self.purge()
+        if server is not None:
+            self.checkServer(server)
+        self.revalidate()
+
+    def get(self, uri, *args, **kwargs):
+        ' Returns the record at uri from disk if it is still current, otherwise from ArchivesSpace '
+
+        if args or kwargs or '?' in uri:
+            return self.aspace.get(uri, *args, **kwargs)
+
+        with self.lock:
+            row = self.db.execute('SELECT body, fetched_at FROM records WHERE uri = ?', (uri,)).fetchone()
+            if row is not None:
+                body, fetched_at = row
+                if self.max_age is None or time.time() - fetched_at <= self.max_age:
+                    self.hits += 1
+                    return json.loads(zlib.decompress(body).decode('utf-8'))
+                logging.debug('Persistent cache entry for %s is older than %s seconds' % (uri, self.max_age))
+                self.expired += 1
+            self.misses += 1
+
+        record = self.aspace.get(uri)
+        self.store(uri, record)
+
+        return record
+
+    def store(self, uri, record):
+        ' Saves record if it is a versioned JSONModel record; trees, lists and errors are not persisted '
+
+        if not isinstance(record, dict) or 'lock_version' not in record:
+            return
+        body = zlib.compress(json.dumps(record).encode('utf-8'))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', (uri, body, record['lock_version'], record.get('system_mtime'), time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def prime(self, uri, record):
+        self.store(uri, record)
+
+    def isCached(self, uri):
+        with self.lock:
+            row = self.db.execute('SELECT fetched_at FROM records WHERE uri = ?', (uri,)).fetchone()
+        return row is not None and (self.max_age is None or time.time() - row[0] <= self.max_age)
+
+    def invalidate(self, uri):
+        with self.lock:
+            self.db.execute('DELETE FROM records WHERE uri = ?', (uri,))
+            self.db.commit()
+
+    def purge(self):
+        logging.info('Purging persistent cache %s' % self.path)
+        self.db.execute('DELETE FROM records')
+        self.db.execute('DELETE FROM meta')
+        self.db.commit()
+
+    def checkServer(self, server):
+        ' Purges the cache if it holds records from a server other than server, then notes server as the source '
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'server'").fetchone()
+        cached = self.db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        if cached and (row is None or row[0] != server):
+            logging.warning('Persistent cache %s holds records from %s, not %s' % (self.path, row[0] if row is not None else 'an unknown server', server))
+            self.purge()
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('server', ?)", (server,))
+        self.db.commit()
+
+    def revalidate(self):
+        ' Drops cached records that ArchivesSpace reports as modified since the last run '
+
+        started = time.time()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'last_validated'").fetchone()
+        if row is not None:
+            since = int(float(row[0]) - CLOCK_SKEW_SECONDS)
+            endpoints = {}
+            for uri, lock_version in self.db.execute('SELECT uri, lock_version FROM records'):
+                endpoint, record_id = uri.rsplit('/', 1)
+                endpoints.setdefault(endpoint, {})[record_id] = lock_version
+            dropped = 0
+            for endpoint, cached in endpoints.items():
+                stale = self.getStaleIds(endpoint, cached, since)
+                for record_id in stale:
+                    self.db.execute('DELETE FROM records WHERE uri = ?', (endpoint + '/' + record_id,))
+                dropped += len(stale)
+            logging.info('Persistent cache %s: %s records cached, %s modified since last run' % (self.path, sum(len(cached) for cached in endpoints.values()), dropped))
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('last_validated', ?)", (str(started),))
+        self.db.commit()
+
+    def getStaleIds(self, endpoint, cached, since):
+        ' Returns the ids of cached records under endpoint which are out of date '
+
+        modified = getModifiedIds(self.aspace, endpoint, since)
+        if modified is None:
+            logging.warning('Dropping all cached records from %s' % endpoint)
+            return list(cached.keys())
+
+        return [record_id for record_id in cached if record_id in modified]
+
+    def post(self, uri, *args, **kwargs):
+        self.invalidate(uri)
+        return self.aspace.post(uri, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.aspace, name)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def logStats(self):
+        logging.info('Persistent cache: %s hits, %s misses, %s expired' % (self.hits, self.misses, self.expired))
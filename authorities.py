@@ -0,0 +1,121 @@
+"""Turns the authority_id of subjects and agents into a full authority URI.
+
+ArchivesSpace records often hold just the identifier from an authority file,
+e.g. sh85061212 with source lcsh, where MODS wants a valueURI. The prefix for
+each source comes from a table, which can be extended or overridden from the
+[authority_prefixes] section of a config file:
+
+    [authority_prefixes]
+    lcsh = http://id.loc.gov/authorities/subjects/
+    fast = http://id.worldcat.org/fast/
+
+The same few hundred authorities turn up across a whole collection, so each
+(source, authority_id) pair is only worked out once. Pass
+authorityNormalizer.normalizeRecord to aspace_cache.aspaceRecordCache as its
+transform to normalize subject and agent records once, as they are fetched;
+normalizingClient does that for a client which doesn't normalize already.
+"""
+import configparser
+import logging
+import urllib.parse
+
+import aspace_cache
+
+
+DEFAULT_PREFIXES = {
+    'lcsh': 'http://id.loc.gov/authorities/subjects/',
+    'lcnaf': 'http://id.loc.gov/authorities/names/',
+    'naf': 'http://id.loc.gov/authorities/names/',
+    'tgn': 'http://vocab.getty.edu/tgn/',
+    'aat': 'http://vocab.getty.edu/aat/',
+}
+
+CONFIG_SECTION = 'authority_prefixes'
+
+
+def loadPrefixes(config_file):
+    ' Returns the default prefix table updated with the [authority_prefixes] section of config_file '
+
+    # No DEFAULT section, so settings meant for a server don't turn into sources
+    config = configparser.ConfigParser(default_section='')
+    with open(config_file) as fh:
+        config.read_file(fh, source=config_file)
+
+    prefixes = dict(DEFAULT_PREFIXES)
+    if config.has_section(CONFIG_SECTION):
+        prefixes.update(config[CONFIG_SECTION])
+    else:
+        logging.warning('No [%s] section in %s, using the default authority prefixes' % (CONFIG_SECTION, config_file))
+
+    return prefixes
+
+
+def getDomain(prefix):
+    ' Returns the registered domain of a prefix, e.g. loc.gov for http://id.loc.gov/authorities/names/ '
+
+    hostname = urllib.parse.urlsplit(prefix).hostname or ''
+    return '.'.join(hostname.split('.')[-2:])
+
+
+class authorityNormalizer(object):
+    def __init__(self, prefixes=None):
+        if prefixes is None:
+            prefixes = DEFAULT_PREFIXES
+        self.prefixes = dict(prefixes)
+        # An authority_id that mentions the authority's domain is already a URI. Prefixes
+        # such as info:lc/ or urn: have no domain, so only the prefix itself counts for them
+        self.domains = dict((source, getDomain(prefix)) for source, prefix in self.prefixes.items())
+        self.normalized = {}
+
+    def normalize(self, source, authority_id):
+        ' Returns authority_id as a full URI if source has a known prefix, otherwise unchanged '
+
+        key = (source, authority_id)
+        try:
+            return self.normalized[key]
+        except KeyError:
+            pass
+
+        prefix = self.prefixes.get(source)
+        if prefix is None or authority_id.startswith(prefix):
+            uri = authority_id
+        elif self.domains[source] and self.domains[source] in authority_id:
+            # A URI in another form, e.g. https rather than http
+            uri = authority_id
+        else:
+            uri = prefix + authority_id
+        # Worst case two threads work out the same answer
+        self.normalized[key] = uri
+
+        return uri
+
+    def normalizeRecord(self, record):
+        ' Normalizes the authority_id of a subject, or an agent\'s display_name, in place and returns the record '
+        ' Any other record is returned untouched '
+
+        if not isinstance(record, dict):
+            return record
+
+        jsonmodel_type = record.get('jsonmodel_type', '')
+        if jsonmodel_type == 'subject':
+            authority = record
+        elif jsonmodel_type.startswith('agent_'):
+            authority = record.get('display_name')
+        else:
+            return record
+
+        if isinstance(authority, dict) and authority.get('authority_id') and authority.get('source'):
+            authority['authority_id'] = self.normalize(authority['source'], authority['authority_id'])
+
+        return record
+
+
+def normalizingClient(client, normalizer=None):
+    ' Returns client if it already normalizes records, e.g. an aspace_cache.aspaceRecordCache with a transform '
+    ' Otherwise returns client wrapped in a record cache that normalizes them with normalizer, or the default prefixes '
+
+    if getattr(client, 'transform', None) is not None:
+        return client
+    if normalizer is None:
+        normalizer = authorityNormalizer()
+    return aspace_cache.aspaceRecordCache(client, transform=normalizer.normalizeRecord)
@@ -0,0 +1,122 @@
+"""Micro-benchmark for normalizing subject and agent authority_ids.
+
+Builds N synthetic records, each linking a handful of subjects and agents drawn
+from a pool of a few hundred authorities with a realistic mix of sources, and
+normalizes them three ways:
+
+- the old if/elif chains, run on every use of a subject or agent
+- authorities.authorityNormalizer on every use, answered from its memo
+- authorities.authorityNormalizer once per distinct record, as the record
+  cache does when a subject or agent is first fetched
+
+Run from the top of the repository:
+
+    python3 benchmarks/authority_benchmark.py -n 5000
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import authorities
+
+
+# Share of authorities from each source, roughly as in the YWCA records
+SOURCE_MIX = [('lcsh', 55), ('naf', 12), ('lcnaf', 8), ('aat', 10), ('tgn', 5), ('local', 10)]
+
+
+def makeAuthorities(count, rng):
+    ' Returns count subject and agent records with sources drawn from SOURCE_MIX, a tenth of them already URIs '
+
+    sources = [source for source, weight in SOURCE_MIX for n in range(weight)]
+    records = []
+    for number in range(count):
+        source = rng.choice(sources)
+        authority_id = '%s%s' % (source[:2], number)
+        if source in authorities.DEFAULT_PREFIXES and rng.random() < 0.1:
+            authority_id = authorities.DEFAULT_PREFIXES[source] + authority_id
+        if number % 3 == 0:
+            records.append({'uri': '/agents/people/%s' % number, 'jsonmodel_type': 'agent_person', 'display_name': {'source': source, 'authority_id': authority_id}})
+        else:
+            records.append({'uri': '/subjects/%s' % number, 'jsonmodel_type': 'subject', 'source': source, 'authority_id': authority_id})
+    return records
+
+
+def normalizeOld(record):
+    ' The if/elif chains getSubjects and getAgents used to run, with the agent branches un-nested '
+
+    if record['jsonmodel_type'] == 'subject':
+        authority = record
+    else:
+        authority = record['display_name']
+    if 'authority_id' in authority.keys():
+        if authority['source'] == 'lcsh':
+            if 'loc.gov' not in authority['authority_id']:
+                authority['authority_id'] = 'http://id.loc.gov/authorities/subjects/' + authority['authority_id']
+        elif authority['source'] == 'lcnaf':
+            if 'loc.gov' not in authority['authority_id']:
+                authority['authority_id'] = 'http://id.loc.gov/authorities/names/' + authority['authority_id']
+        elif authority['source'] == 'naf':
+            if 'loc.gov' not in authority['authority_id']:
+                authority['authority_id'] = 'http://id.loc.gov/authorities/names/' + authority['authority_id']
+        elif authority['source'] == 'tgn':
+            if 'getty.edu' not in authority['authority_id']:
+                authority['authority_id'] = 'http://vocab.getty.edu/tgn/' + authority['authority_id']
+        elif authority['source'] == 'aat':
+            if 'getty.edu' not in authority['authority_id']:
+                authority['authority_id'] = 'http://vocab.getty.edu/aat/' + authority['authority_id']
+    return record
+
+
+def perUse(normalize, copies):
+    ' Normalizes every use of a subject or agent. copies are made up front, as the record cache hands out a copy on every use anyway '
+
+    for record in copies:
+        normalize(record)
+
+
+def perRecord(normalize, pool):
+    ' Normalizes each distinct record once, as the record cache does when it is fetched '
+
+    for record in pool:
+        normalize(record)
+
+
+def timeIt(label, func, count):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print('%-45s %8.3fs %12.1f lookups/s' % (label, elapsed, count / elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Compare per-use if/elif authority normalization with the memoized, table driven normalizer.")
+    argparser.add_argument('-n', '--records', type=int, default=5000, help="Number of synthetic archival objects. (default: %(default)s)")
+    argparser.add_argument('--authorities', type=int, default=300, help="Number of distinct subjects and agents they link to. (default: %(default)s)")
+    argparser.add_argument('--links', type=int, default=6, help="Subjects and agents linked from each archival object. (default: %(default)s)")
+    argparser.add_argument('--seed', type=int, default=1, help="Random seed. (default: %(default)s)")
+    cliArguments = argparser.parse_args()
+
+    rng = random.Random(cliArguments.seed)
+    pool = makeAuthorities(cliArguments.authorities, rng)
+    uses = [rng.randrange(len(pool)) for n in range(cliArguments.records * cliArguments.links)]
+    count = len(uses)
+
+    # Both ways must give the same URIs
+    normalizer = authorities.authorityNormalizer()
+    for record in pool:
+        assert normalizeOld(copy.deepcopy(record)) == normalizer.normalizeRecord(copy.deepcopy(record))
+
+    # Copying is the same whichever way records are normalized, so it's left out of the timings
+    copies = [copy.deepcopy(pool[index]) for index in uses]
+    old = timeIt('if/elif on every use', lambda: perUse(normalizeOld, copies), count)
+    copies = [copy.deepcopy(pool[index]) for index in uses]
+    timeIt('authorityNormalizer on every use', lambda: perUse(authorities.authorityNormalizer().normalizeRecord, copies), count)
+    distinct = copy.deepcopy(pool)
+    new = timeIt('authorityNormalizer once per record', lambda: perRecord(authorities.authorityNormalizer().normalizeRecord, distinct), count)
+
+    print('Speedup: %.2fx' % (old / new))
@@ -0,0 +1,154 @@
+"""End-to-end export benchmark against a synthetic ArchivesSpace.
+
+Builds a fake_aspace.fakeArchivesSpace of the requested shape, runs a full
+export of it to a temporary directory through the same client chain as
+exportASAOtoMODS.py (request limiter, record cache, authority normalizer) and
+reports:
+
+- wall time and records written per second
+- requests by endpoint, with record ids replaced by :id
+- the share of requests for a URI that had already been requested
+- peak RSS, and RSS once the fake server was built
+
+--mode pipeline runs exportResource as the command line does. --mode
+sequential runs getAllResourceUris, then getDigitalObjectUris, then
+renderRecord and a file write for each Digital Object in turn.
+
+Results are printed as JSON, and with --output appended as one line to a
+JSON Lines file so runs can be compared across changes. Run from the top of
+the repository:
+
+    python3 benchmarks/export_benchmark.py --depth 4 --fanout 6 --digital-objects 1000 --latency 5 --workers 8 --output benchmark-results.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import aspace_cache
+import authorities
+import exportASAOtoMODS
+import mods_renderer
+import profiling
+import record_funcs
+import worker_pool
+import fake_aspace
+
+
+def getPeakRss():
+    ' Returns the peak resident set size of this process so far in MB '
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes rather than kilobytes
+        peak = peak / 1024
+    return peak / 1024
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def exportPipeline(save_path, workers, batch_size):
+    exportASAOtoMODS.exportResource(fake_aspace.RESOURCE_NUM, save_path, workers=workers, batch_size=batch_size)
+    return len(os.listdir(save_path))
+
+
+def exportSequential(save_path, workers, batch_size):
+    myrecordfuncs = exportASAOtoMODS.myrecordfuncs
+    ao_uris = myrecordfuncs.getAllResourceUris(fake_aspace.RESOURCE_NUM, digital_only=True)
+    do_uris = myrecordfuncs.getDigitalObjectUris(ao_uris, workers, batch_size)
+    for do_uri in do_uris:
+        xml = exportASAOtoMODS.renderRecord(do_uri)
+        handle = myrecordfuncs.getModsFileName(exportASAOtoMODS.getDigitalObject(do_uri))
+        with open(os.path.join(save_path, handle + '.xml'), 'w') as fh:
+            fh.write(xml)
+    return len(do_uris)
+
+
+def runBenchmark(cliArguments):
+    started = time.perf_counter()
+    fake = fake_aspace.fakeArchivesSpace(depth=cliArguments.depth, fanout=cliArguments.fanout, digital_objects=cliArguments.digital_objects,
+                                         subjects=cliArguments.subjects, agents=cliArguments.agents, latency=cliArguments.latency / 1000.0, seed=cliArguments.seed)
+    setup_seconds = time.perf_counter() - started
+    setup_rss = getPeakRss()
+
+    client = worker_pool.aspaceRequestLimiter(fake, cliArguments.max_requests or cliArguments.workers)
+    cache = aspace_cache.aspaceRecordCache(client, maxsize=cliArguments.cache_size, transform=authorities.authorityNormalizer().normalizeRecord)
+    exportASAOtoMODS.useClient(cache)
+    exportASAOtoMODS.useRenderer(mods_renderer.modsRenderer(cliArguments.template))
+
+    with tempfile.TemporaryDirectory() as save_path:
+        started = time.perf_counter()
+        if cliArguments.mode == 'sequential':
+            records = exportSequential(save_path, cliArguments.workers, cliArguments.batch_size)
+        else:
+            records = exportPipeline(save_path, cliArguments.workers, cliArguments.batch_size)
+        wall_seconds = time.perf_counter() - started
+
+    by_endpoint = {}
+    for path, count in fake.requests.items():
+        endpoint = profiling.uriPattern(path)
+        by_endpoint[endpoint] = by_endpoint.get(endpoint, 0) + count
+    total = sum(fake.requests.values())
+    distinct = len(fake.requests)
+
+    return {
+        'label': cliArguments.label,
+        'commit': getCommit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': {
+            'mode': cliArguments.mode, 'depth': cliArguments.depth, 'fanout': cliArguments.fanout, 'digital_objects': fake.digital_object_count,
+            'archival_objects': fake.ao_count, 'subjects': cliArguments.subjects, 'agents': cliArguments.agents, 'latency_ms': cliArguments.latency,
+            'workers': cliArguments.workers, 'batch_size': cliArguments.batch_size, 'cache_size': cliArguments.cache_size,
+        },
+        'setup_seconds': round(setup_seconds, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        'records': records,
+        'records_per_second': round(records / max(wall_seconds, 0.001), 1),
+        'requests': total,
+        'distinct_requests': distinct,
+        'duplicate_ratio': round((total - distinct) / total, 4) if total else 0.0,
+        'requests_by_endpoint': dict(sorted(by_endpoint.items(), key=lambda item: -item[1])),
+        'cache': {'hits': cache.hits, 'misses': cache.misses, 'evictions': cache.evictions},
+        'setup_rss_mb': round(setup_rss, 1),
+        'peak_rss_mb': round(getPeakRss(), 1),
+    }
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Benchmark a full export against a synthetic, in-memory ArchivesSpace.")
+    argparser.add_argument('--depth', type=int, default=3, help="Levels of Archival Objects below the resource. (default: %(default)s)")
+    argparser.add_argument('--fanout', type=int, default=5, help="Children of each Archival Object above the leaves. (default: %(default)s)")
+    argparser.add_argument('--digital-objects', type=int, default=100, help="Digital Objects, spread over the leaves; capped at the number of leaves. (default: %(default)s)")
+    argparser.add_argument('--subjects', type=int, default=200, help="Distinct subjects the Archival Objects link to. (default: %(default)s)")
+    argparser.add_argument('--agents', type=int, default=100, help="Distinct agents the Archival Objects link to. (default: %(default)s)")
+    argparser.add_argument('--latency', type=float, default=0.0, help="Milliseconds each request takes. (default: %(default)s)")
+    argparser.add_argument('--seed', type=int, default=1, help="Random seed for the synthetic records. (default: %(default)s)")
+    argparser.add_argument('--mode', choices=['pipeline', 'sequential'], default='pipeline', help="Export with exportResource, or one step after another. (default: %(default)s)")
+    argparser.add_argument('--workers', type=int, default=1, help="As for exportASAOtoMODS.py. (default: %(default)s)")
+    argparser.add_argument('--batch-size', type=int, default=record_funcs.DEFAULT_BATCH_SIZE, help="As for exportASAOtoMODS.py. (default: %(default)s)")
+    argparser.add_argument('--max-requests', type=int, help="As for exportASAOtoMODS.py. Defaults to the number of workers.")
+    argparser.add_argument('--cache-size', type=int, default=aspace_cache.DEFAULT_CACHE_SIZE, help="As for exportASAOtoMODS.py. (default: %(default)s)")
+    argparser.add_argument('--template', default=mods_renderer.DEFAULT_TEMPLATE, help="Template to render. (default: %(default)s)")
+    argparser.add_argument('--label', help="Name for this run in the results, e.g. the change being measured.")
+    argparser.add_argument('--output', metavar='FILE', help="Append the results as a line of JSON to FILE.")
+    cliArguments = argparser.parse_args()
+
+    # The exporter logs every record at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = runBenchmark(cliArguments)
+    print(json.dumps(results, indent=2))
+    if cliArguments.output:
+        with open(cliArguments.output, 'a') as fh:
+            fh.write(json.dumps(results) + '\n')
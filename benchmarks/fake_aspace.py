@@ -0,0 +1,213 @@
+"""An in-memory stand-in for the ArchivesSpace API client, for benchmarks.
+
+fakeArchivesSpace answers get() like archivesspace.ArchivesSpace does, from a
+synthetic resource built when it is created:
+
+- a tree of Archival Objects, depth levels deep with fanout children each
+- digital_objects Digital Objects spread evenly over the leaves
+- a pool of subjects and agents with a mix of authority sources
+- top containers, notes and a repository
+
+It serves plain record URIs, the repository list, the tree/root, tree/node
+and tree/waypoint endpoints, id_set[] batches and all_ids listings (honouring
+modified_since), optionally sleeping for latency seconds on every request to
+stand in for the network. Every request is counted by URI so duplicate fetches
+show up. Posting a record, or touch(), bumps its lock_version and
+system_mtime as ArchivesSpace would.
+
+    aspace = fakeArchivesSpace(depth=4, fanout=5, digital_objects=500, latency=0.005)
+"""
+import calendar
+import collections
+import copy
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+
+REPO_URI = '/repositories/2'
+RESOURCE_NUM = 1
+
+# Authority sources of the subject and agent pools, with their share
+SOURCE_MIX = [('lcsh', 55), ('naf', 12), ('lcnaf', 8), ('aat', 10), ('tgn', 5), ('local', 10)]
+
+WAYPOINT_SIZE = 200
+
+MTIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class fakeArchivesSpace(object):
+    def __init__(self, depth=3, fanout=5, digital_objects=50, subjects=200, agents=100, latency=0.0, seed=1):
+        self.depth = max(depth, 1)
+        self.fanout = max(fanout, 1)
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.records = {}
+        self.children = {}
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.build(digital_objects, subjects, agents)
+
+    def setServerCfg(self, *args, **kwargs):
+        pass
+
+    def connect(self):
+        pass
+
+    def add(self, record):
+        record.setdefault('lock_version', 0)
+        record.setdefault('system_mtime', '2019-01-01T00:00:00Z')
+        self.records[record['uri']] = record
+
+    def build(self, digital_objects, subjects, agents):
+        sources = [source for source, weight in SOURCE_MIX for n in range(weight)]
+
+        self.add({'uri': REPO_URI, 'jsonmodel_type': 'repository', 'name': 'Sophia Smith Collection', 'parent_institution_name': 'Smith College'})
+
+        self.subject_uris = []
+        for number in range(1, subjects + 1):
+            source = self.rng.choice(sources)
+            term_type = 'genre_form' if number % 10 == 0 else self.rng.choice(['topical', 'geographic', 'temporal'])
+            uri = '/subjects/%s' % number
+            self.add({'uri': uri, 'jsonmodel_type': 'subject', 'title': 'Subject %s' % number, 'source': source, 'authority_id': '%s%s' % (source[:2], number), 'terms': [{'term': 'Subject %s' % number, 'term_type': term_type}]})
+            self.subject_uris.append(uri)
+
+        self.agent_uris = []
+        for number in range(1, agents + 1):
+            if number % 2:
+                uri = '/agents/people/%s' % number
+                jsonmodel_type = 'agent_person'
+            else:
+                uri = '/agents/corporate_entities/%s' % number
+                jsonmodel_type = 'agent_corporate_entity'
+            source = self.rng.choice(['naf', 'lcnaf', 'local'])
+            self.add({'uri': uri, 'jsonmodel_type': jsonmodel_type, 'title': 'Agent %s' % number, 'display_name': {'source': source, 'authority_id': 'n%s' % number}})
+            self.agent_uris.append(uri)
+
+        for number in (1, 2):
+            self.add({'uri': REPO_URI + '/top_containers/%s' % number, 'jsonmodel_type': 'top_container', 'display_string': 'Box %s' % number})
+
+        self.resource_uri = REPO_URI + '/resources/%s' % RESOURCE_NUM
+        self.add({
+            'uri': self.resource_uri, 'jsonmodel_type': 'resource', 'title': 'Synthetic Records', 'id_0': 'MS 00001', 'ead_location': 'http://findingaids.example.edu/1',
+            'repository': {'ref': REPO_URI},
+            'notes': [self.note('scopecontent', 'Resource scope and content'), self.note('userestrict', 'Use freely'), self.note('accessrestrict', 'Open for research'),
+                      {'type': 'langmaterial', 'content': ['The primary language of the materials is English.;French']}],
+            'subjects': [{'ref': uri} for uri in self.subject_uris[9:30:10]],
+            'linked_agents': [{'role': 'creator', 'ref': self.agent_uris[0]}, {'role': 'source', 'ref': self.agent_uris[-1]}],
+        })
+
+        self.ao_count = 0
+        leaves = []
+        self.children[self.resource_uri] = [self.addArchivalObject(None, 1, leaves) for child in range(self.fanout)]
+
+        # Spread the Digital Objects evenly over the leaves
+        digital_objects = min(digital_objects, len(leaves))
+        for number in range(1, digital_objects + 1):
+            leaf = self.records[leaves[(number - 1) * len(leaves) // digital_objects]]
+            do_uri = REPO_URI + '/digital_objects/%s' % number
+            self.add({'uri': do_uri, 'jsonmodel_type': 'digital_object', 'digital_object_id': 'synthetic_digital_object_%s' % number,
+                      'linked_instances': [{'ref': leaf['uri']}], 'file_versions': [{'file_uri': 'https://compass.example.edu/object/test:%s' % number, 'publish': True}]})
+            leaf['instances'].append({'instance_type': 'digital_object', 'digital_object': {'ref': do_uri}})
+        self.digital_object_count = digital_objects
+
+    def note(self, note_type, content):
+        return {'type': note_type, 'jsonmodel_type': 'note_multipart', 'subnotes': [{'content': content}]}
+
+    def addArchivalObject(self, parent_uri, level, leaves):
+        self.ao_count += 1
+        number = self.ao_count
+        uri = REPO_URI + '/archival_objects/%s' % number
+        record = {
+            'uri': uri, 'jsonmodel_type': 'archival_object', 'title': 'Archival Object %s' % number, 'ref_id': 'ref%s' % number, 'level': 'file',
+            'resource': {'ref': self.resource_uri}, 'repository': {'ref': REPO_URI},
+            'dates': [{'expression': '1920-1925', 'begin': '1920', 'end': '1925'}], 'extents': [],
+            'notes': [], 'instances': [],
+            'subjects': [{'ref': uri} for uri in self.rng.sample(self.subject_uris, min(3, len(self.subject_uris)))],
+            'linked_agents': [],
+        }
+        if parent_uri is not None:
+            record['parent'] = {'ref': parent_uri}
+        if number % 3 == 0:
+            record['notes'].append(self.note('scopecontent', 'Scope and content of %s' % number))
+        if self.agent_uris and number % 2 == 0:
+            record['linked_agents'] = [{'role': 'subject', 'ref': self.rng.choice(self.agent_uris)}, {'role': 'creator', 'ref': self.rng.choice(self.agent_uris)}]
+        self.add(record)
+
+        if level < self.depth:
+            self.children[uri] = [self.addArchivalObject(uri, level + 1, leaves) for child in range(self.fanout)]
+        else:
+            self.children[uri] = []
+            record['instances'].append({'instance_type': 'mixed_materials', 'sub_container': {'top_container': {'ref': REPO_URI + '/top_containers/%s' % (1 + number % 2)}, 'type_2': 'folder', 'indicator_2': str(number)}})
+            leaves.append(uri)
+        return uri
+
+    def nodeSummary(self, uri):
+        ' The tree endpoints\' summary of a node '
+
+        record = self.records[uri]
+        return {'uri': uri, 'title': record['title'], 'child_count': len(self.children[uri]),
+                'has_digital_instance': any('digital_object' in instance for instance in record['instances'])}
+
+    def waypoints(self, parent_uri):
+        return (len(self.children[parent_uri]) + WAYPOINT_SIZE - 1) // WAYPOINT_SIZE
+
+    def waypoint(self, parent_uri, offset):
+        return [self.nodeSummary(uri) for uri in self.children[parent_uri][offset * WAYPOINT_SIZE:(offset + 1) * WAYPOINT_SIZE]]
+
+    def get(self, path, requestData={}):
+        with self.lock:
+            self.requests[path] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        split = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(split.query)
+        uri = split.path
+        tree_uri = self.resource_uri + '/tree'
+
+        if uri == tree_uri + '/root':
+            return {'uri': self.resource_uri, 'child_count': len(self.children[self.resource_uri]), 'waypoints': self.waypoints(self.resource_uri), 'waypoint_size': WAYPOINT_SIZE,
+                    'precomputed_waypoints': {'': {'0': self.waypoint(self.resource_uri, 0)}}}
+        if uri == tree_uri + '/node':
+            node_uri = query['node_uri'][0]
+            node = self.nodeSummary(node_uri)
+            node.update({'waypoints': self.waypoints(node_uri), 'waypoint_size': WAYPOINT_SIZE, 'precomputed_waypoints': {node_uri: {'0': self.waypoint(node_uri, 0)}}})
+            return node
+        if uri == tree_uri + '/waypoint':
+            parent_uri = query.get('parent_node', [self.resource_uri])[0]
+            return self.waypoint(parent_uri, int(query['offset'][0]))
+        if 'id_set[]' in query:
+            return [self.copy(uri + '/' + record_id) for record_id in query['id_set[]'] if uri + '/' + record_id in self.records]
+        if uri == '/repositories':
+            return [self.copy(REPO_URI)]
+        if 'all_ids' in query:
+            since = int(query.get('modified_since', [0])[0])
+            return sorted(int(record_uri.rsplit('/', 1)[1]) for record_uri, record in self.records.items()
+                          if record_uri.rsplit('/', 1)[0] == uri and calendar.timegm(time.strptime(record['system_mtime'], MTIME_FORMAT)) > since)
+        if uri in self.records:
+            return self.copy(uri)
+        return {'error': 'Record not found'}
+
+    def copy(self, uri):
+        ' Hands out a fresh copy of a record, as decoding a real response would '
+
+        return json.loads(json.dumps(self.records[uri]))
+
+    def post(self, path, requestData={}):
+        with self.lock:
+            self.requests['POST ' + path] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        self.records[path] = copy.deepcopy(requestData)
+        self.touch(path)
+        return {'status': 'Updated', 'uri': path}
+
+    def touch(self, uri):
+        ' Marks a record as modified now, as saving it in ArchivesSpace would '
+
+        record = self.records[uri]
+        record['lock_version'] = record.get('lock_version', 0) + 1
+        record['system_mtime'] = time.strftime(MTIME_FORMAT, time.gmtime())
@@ -0,0 +1,62 @@
+"""An in-memory stand-in for a requests session talking to Fedora, for tests.
+
+fakeFedoraSession answers the datastream content and datastream profile URLs
+that check_asis_mods_diff builds, from datastreams added with ingest(). A
+datastream that was never ingested gets a 404, as from Fedora. status makes
+every request answer with that HTTP status instead, e.g. 401 for bad
+credentials, and error makes every request raise it, e.g. a timeout. Every
+request is counted by URL.
+
+    session = fakeFedoraSession()
+    session.ingest('smith:1234', b'<mods/>')
+"""
+import collections
+import re
+import threading
+
+
+FEDORA_CONFIG = {'ENVIRONMENT': 'fedora.example.edu', 'FEDORA_PORT': '8443', 'FEDORA_USER': 'fedora', 'FEDORA_PASS': 'secret'}
+
+URL_PATTERN = re.compile(r'/fedora/objects/(?P<pid>[^/]+)/datastreams/(?P<datastream>[^/?]+)(?P<content>/content)?')
+
+PROFILE_TEMPLATE = '<datastreamProfile xmlns="http://www.fedora.info/definitions/1/0/management/"><dsLabel>MODS Record</dsLabel><dsVersionID>%s.%s</dsVersionID><dsCreateDate>2019-01-01T00:00:%02d.000Z</dsCreateDate><dsChecksum>none</dsChecksum></datastreamProfile>'
+
+
+class fakeResponse(object):
+    def __init__(self, status_code, content=b''):
+        self.status_code = status_code
+        self.content = content
+
+
+class fakeFedoraSession(object):
+    def __init__(self):
+        self.datastreams = {}
+        self.versions = {}
+        self.status = None
+        self.error = None
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def ingest(self, pid, contents, datastream='MODS'):
+        ' Adds or replaces a datastream, giving it a new version in its profile '
+
+        key = (pid, datastream)
+        self.datastreams[key] = contents
+        self.versions[key] = self.versions.get(key, -1) + 1
+
+    def get(self, url, auth=None, timeout=None):
+        with self.lock:
+            self.requests[url] += 1
+        if self.error is not None:
+            raise self.error
+        if self.status is not None:
+            return fakeResponse(self.status)
+
+        match = URL_PATTERN.search(url)
+        key = (match.group('pid'), match.group('datastream'))
+        if key not in self.datastreams:
+            return fakeResponse(404, b'Not Found')
+        if match.group('content'):
+            return fakeResponse(200, self.datastreams[key])
+        version = self.versions[key]
+        return fakeResponse(200, (PROFILE_TEMPLATE % (key[1], version, version)).encode('utf-8'))
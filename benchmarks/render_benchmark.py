@@ -0,0 +1,92 @@
+"""Micro-benchmark for rendering MODS records.
+
+Renders N synthetic records through the old path, which built a new jinja
+Environment and looked up the template for every record, and through
+mods_renderer.modsRenderer, with and without a precompiled template.
+
+Run from the top of the repository:
+
+    python3 benchmarks/render_benchmark.py -n 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import jinja2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mods_renderer
+
+
+def makeRecord(number):
+    ' Returns template data shaped like exportASAOtoMODS.getRecordData output '
+
+    subjects = [{'source': 'lcsh', 'authority_id': 'http://id.loc.gov/authorities/subjects/sh%s' % i, 'title': 'Subject %s' % i, 'terms': [{'term_type': 'topical', 'term': 'Subject %s' % i}]} for i in range(5)]
+    agents = [{'role': role, 'data': {'title': 'Agent %s' % i, 'jsonmodel_type': 'personal', 'display_name': {'source': 'naf', 'authority_id': 'http://id.loc.gov/authorities/names/n%s' % i}}} for i, role in enumerate(['creator', 'source', 'subject', 'subject'])]
+    return {
+        'archival_object': {'title': 'Photograph %s' % number, 'ref_id': 'ref%s' % number, 'uri': '/repositories/2/archival_objects/%s' % number, 'dates': [{'expression': '1920-1925', 'begin': '1920', 'end': '1925'}], 'extents': [{'number': '1', 'extent_type': 'photograph', 'container_summary': '1 print'}]},
+        'resource': {'title': 'YWCA of the U.S.A. Photographic Records', 'ead_location': 'http://findingaids.smith.edu/repositories/2/resources/676'},
+        'repository': {'parent_institution_name': 'Smith College'},
+        'digital_object': {'digital_object_id': 'smith_ssc_324_digital_object_%s' % number, 'uri': '/repositories/2/digital_objects/%s' % number},
+        'langs': ['English'],
+        'subjects': subjects,
+        'genre_subs': [{'source': 'aat', 'authority_id': 'http://vocab.getty.edu/aat/300046300', 'title': 'Photographs'}],
+        'agents': agents,
+        'collecting_unit': 'Sophia Smith Collection',
+        'ms_no': 'MS 324',
+        'folder': 'Folder %s' % number,
+        'container': 'Box 1',
+        'abstract': [{'content': 'Scope and content %s' % number}],
+        'userestrict': [{'content': 'Use restrictions'}],
+        'accessrestrict': [{'content': 'Open for research'}],
+    }
+
+
+def renderOld(template_path, records):
+    searchpath, name = os.path.split(template_path)
+    for data in records:
+        templateLoader = jinja2.FileSystemLoader(searchpath=searchpath or '.')
+        templateEnv = jinja2.Environment(loader=templateLoader)
+        template = templateEnv.get_template(name)
+        template.render(data)
+
+
+def renderNew(renderer, records):
+    for data in records:
+        renderer.render(data)
+
+
+def timeIt(label, func, count):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print('%-40s %8.3fs %10.1f records/s' % (label, elapsed, count / elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Compare per-record template loading with a reused modsRenderer.")
+    argparser.add_argument('-n', '--records', type=int, default=1000, help="Number of synthetic records to render. (default: %(default)s)")
+    argparser.add_argument('--template', default=mods_renderer.DEFAULT_TEMPLATE, help="Template to render. (default: %(default)s)")
+    cliArguments = argparser.parse_args()
+
+    records = [makeRecord(number) for number in range(cliArguments.records)]
+    count = len(records)
+
+    old = timeIt('new Environment per record', lambda: renderOld(cliArguments.template, records), count)
+
+    started = time.perf_counter()
+    renderer = mods_renderer.modsRenderer(cliArguments.template)
+    print('%-40s %8.3fs' % ('modsRenderer startup', time.perf_counter() - started))
+    new = timeIt('modsRenderer', lambda: renderNew(renderer, records), count)
+
+    with tempfile.TemporaryDirectory() as compiled_path:
+        mods_renderer.compileTemplate(cliArguments.template, compiled_path)
+        started = time.perf_counter()
+        compiled_renderer = mods_renderer.modsRenderer(cliArguments.template, compiled_path=compiled_path)
+        print('%-40s %8.3fs' % ('precompiled modsRenderer startup', time.perf_counter() - started))
+        timeIt('precompiled modsRenderer', lambda: renderNew(compiled_renderer, records), count)
+
+    print('Speedup: %.1fx' % (old / new))
@@ -0,0 +1,87 @@
+"""Manifest of what check_asis_mods_diff found last time, so unchanged datastreams can be skipped.
+
+For each PID and datastream the manifest keeps the local file's mtime, size
+and canonical XML hash, the ingested datastream's canonical XML hash along with
+the dsVersionID, dsCreateDate and dsChecksum from its Fedora datastream
+profile, and whether the two differed.
+
+On the next run a local file with the same mtime and size is taken to be
+unchanged without reading it, and an ingested datastream whose profile is
+unchanged is taken to be unchanged without fetching it. When neither side has
+changed the last result is reused, so only the small profile request is made.
+Everything else is fetched and compared in full and its entry brought up to
+date.
+"""
+import json
+import logging
+import os
+import threading
+
+
+# Fields of the Fedora datastream profile that change whenever the datastream does
+PROFILE_FIELDS = ('dsVersionID', 'dsCreateDate', 'dsChecksum')
+
+
+def manifestFilename(environment):
+    return '.datastream-manifest-%s.json' % environment
+
+
+class datastreamManifest(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.seen = set()
+        self.skipped = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                self.entries = json.load(fh).get('datastreams', {})
+        except FileNotFoundError:
+            logging.info('No datastream manifest at %s, every datastream will be fetched' % self.path)
+            return
+        except ValueError as e:
+            logging.warning('Could not read datastream manifest %s, every datastream will be fetched: %s' % (self.path, e))
+            return
+
+        logging.info('Loaded datastream manifest with %s datastreams from %s' % (len(self.entries), self.path))
+
+    def localState(self, filepathname):
+        ' Returns the mtime and size of a local file, which stand in for its contents between runs '
+
+        stat = os.stat(filepathname)
+        return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    def get(self, key):
+        ' Returns the entry for a PID and datastream such as smith:1234/MODS from the last run, or None '
+
+        with self.lock:
+            self.seen.add(key)
+            return self.entries.get(key)
+
+    def skip(self, key):
+        ' Counts a datastream whose entry was reused as it was '
+
+        with self.lock:
+            self.skipped += 1
+
+    def record(self, key, local, remote, differs, detailed):
+        ' Notes the state of both sides of a datastream that was just compared '
+
+        with self.lock:
+            self.seen.add(key)
+            self.entries[key] = {'local': local, 'remote': remote, 'differs': differs, 'detailed': detailed}
+
+    def save(self, prune=True):
+        ' Writes the manifest. prune drops datastreams with no local file in this run '
+
+        with self.lock:
+            if prune:
+                self.entries = dict((key, entry) for key, entry in self.entries.items() if key in self.seen)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as fh:
+                json.dump({'datastreams': self.entries}, fh)
+            os.replace(temp_path, self.path)
+        logging.info('Saved datastream manifest with %s datastreams, %s were unchanged and skipped' % (len(self.entries), self.skipped))
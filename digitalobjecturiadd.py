@@ -1,74 +1,359 @@
+import hashlib
 import json
 import os
+import random
+import time
+import urllib.parse
+import requests
 from archivesspace import archivesspace
 import pprint
 # from utilities import *
 import argparse
 import logging
 
-## -----Connect to ASpace API----- ##
+import check_asis_mods_diff
+import record_funcs
+import worker_pool
+
+try:
+    # Parses JSON files a doc at a time, rather than all at once
+    import ijson
+except ImportError:
+    ijson = None
+
+JSON_ERRORS = (ijson.JSONError,) if ijson is not None else ()
+
+logging.basicConfig(level=logging.INFO)
 
 CONFIGFILE = "archivesspace.cfg"
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument("jsonfile", help="Path to the JSON file containing the data with which to update the records.")
-argparser.add_argument("SERVERCFG", nargs="?", default="DEFAULT", help="Name of the server configuration section e.g. 'production' or 'testing'. Edit archivesspace.cfg to add a server configuration section. If no configuration is specified, the default settings will be used host=localhost user=admin pass=admin.")
-cliArguments = argparser.parse_args()
+COMPASS_ROOT = 'https://compass.fivecolleges.edu/object/'
+
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 5
+# Seconds to wait before the first retry, doubled for each one after
+RETRY_BACKOFF = 0.5
+
+# Docs to fetch per request when paging through Solr
+SOLR_ROWS = 500
+# cursorMark paging needs a sort on Solr's unique key
+SOLR_SORT = 'PID asc'
+
+# ArchivesSpace's answer when the record was saved by someone else since we fetched it
+CONFLICT_MESSAGES = ('lock_version', 'modified since you fetched it')
+# Errors that trying again won't fix. Validation errors, which map fields to messages, aren't retried either
+PERMANENT_MESSAGES = ('Record not found', 'Access denied')
+
+aspace = None
+
+
+class inputFailed(Exception):
+    ' The Solr output could not be read '
+
+
+class updateFailed(Exception):
+    ' A Digital Object could not be updated; retryable is True for conflicts, server errors and dropped connections '
+
+    def __init__(self, message, retryable=False, conflict=False):
+        super().__init__(message)
+        self.retryable = retryable or conflict
+        self.conflict = conflict
+
+
+def checkResponse(response, action):
+    ' Raises updateFailed if an ArchivesSpace response is an error '
+    ' The client hands back server errors as error bodies too, so anything but a validation error, '
+    ' a missing record or a permission problem is worth retrying '
+
+    if isinstance(response, dict) and 'error' in response:
+        error = str(response['error'])
+        conflict = any(message in error for message in CONFLICT_MESSAGES)
+        permanent = isinstance(response['error'], dict) or any(message in error for message in PERMANENT_MESSAGES)
+        raise updateFailed('%s failed: %s' % (action, error), retryable=not permanent, conflict=conflict)
+    return response
+
+
+def callAspace(action, func, *args, **kwargs):
+    ' Calls aspace.get or aspace.post, turning errors into updateFailed '
+
+    try:
+        return checkResponse(func(*args, **kwargs), action)
+    except updateFailed:
+        raise
+    except Exception as e:
+        # Clients built on requests attach the response to HTTP errors
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        if status is None:
+            # Timeouts and dropped connections are worth another try
+            raise updateFailed('%s failed: %s' % (action, e), retryable=isinstance(e, OSError))
+        raise updateFailed('%s failed with %s: %s' % (action, status, e), retryable=status >= 500 or status == 429, conflict=status == 409)
+
+
+## -- Reading the Solr output -- ##
+
+def makeCompassObject(doc):
+    ' Returns a Solr doc with a full Compass URI as its PID and just the ArchivesSpace id as its mods_identifier_local_s '
+    ' e.g. "smith_ssc_324_digital_object_289" becomes "289"; the whole identifier is kept as digital_object_id '
+
+    compass_object = dict(doc)
+    compass_object['PID'] = COMPASS_ROOT + doc['PID']
+    compass_object['digital_object_id'] = doc['mods_identifier_local_s']
+    compass_object['mods_identifier_local_s'] = doc['mods_identifier_local_s'].split('_')[-1]
+    return compass_object
+
+
+def isSolrURL(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def iterJsonDocs(jsonfile):
+    ' Yields the docs of a JSON file of Solr query output, one at a time if ijson is installed '
+
+    with open(jsonfile, 'rb') as json_file:
+        if ijson is not None:
+            yield from ijson.items(json_file, 'response.docs.item')
+        else:
+            logging.warning('ijson is not installed, so all of %s is being loaded into memory; install it from requirements.txt or use a .jsonl file or Solr URL' % jsonfile)
+            yield from json.load(json_file)['response']['docs']
+
+
+def iterJsonLinesDocs(jsonfile):
+    ' Yields the docs of a JSON Lines file, one doc per line '
+
+    with open(jsonfile) as json_file:
+        for line in json_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iterSolrDocs(solr_url, rows=SOLR_ROWS, cursor=False, session=None):
+    ' Yields the docs matching a Solr select URL, e.g. http://localhost:8080/solr/select?q=...&fl=PID,mods_identifier_local_s '
+    ' Pages through them rows at a time with start, or with cursorMark if cursor is True '
+
+    if session is None:
+        session = check_asis_mods_diff.makeSession()
+    split = urllib.parse.urlsplit(solr_url)
+    params = [(name, value) for name, value in urllib.parse.parse_qsl(split.query) if name not in ('start', 'rows', 'wt', 'cursorMark')]
+    params += [('wt', 'json'), ('rows', rows)]
+    if cursor and not any(name == 'sort' for name, value in params):
+        params.append(('sort', SOLR_SORT))
+    url = urllib.parse.urlunsplit((split.scheme, split.netloc, split.path, '', ''))
+
+    start = 0
+    cursor_mark = '*'
+    while True:
+        if cursor:
+            page_params = params + [('cursorMark', cursor_mark)]
+        else:
+            page_params = params + [('start', start)]
+        httpResponse = session.get(url, params=page_params, timeout=check_asis_mods_diff.DEFAULT_TIMEOUT)
+        httpResponse.raise_for_status()
+        page = httpResponse.json()
+        docs = page['response']['docs']
+        yield from docs
+
+        if cursor:
+            if page['nextCursorMark'] == cursor_mark:
+                return
+            cursor_mark = page['nextCursorMark']
+        else:
+            start += len(docs)
+            if not docs or start >= page['response']['numFound']:
+                return
 
-aspace = archivesspace.ArchivesSpace()
-aspace.setServerCfg(CONFIGFILE, section=cliArguments.SERVERCFG)
-aspace.connect()
 
-##-------------------------------- ##
+def iterCompassObjects(source, rows=SOLR_ROWS, cursor=False):
+    ' Yields the Compass objects from a JSON file of Solr query output, a JSON Lines file of docs or a Solr select URL '
+    ' Raises inputFailed if the source cannot be read or parsed '
+
+    if isSolrURL(source):
+        docs = iterSolrDocs(source, rows, cursor)
+    elif source.endswith('.jsonl'):
+        docs = iterJsonLinesDocs(source)
+    else:
+        docs = iterJsonDocs(source)
+
+    try:
+        for doc in docs:
+            if 'PID' not in doc or 'mods_identifier_local_s' not in doc:
+                logging.warning('Skipping Solr doc without a PID and mods_identifier_local_s: %s' % doc)
+                continue
+            yield makeCompassObject(doc)
+    except (OSError, ValueError, KeyError, requests.RequestException) + JSON_ERRORS as e:
+        # Only covers reading the docs; the updates run outside this generator
+        raise inputFailed('Could not read %s: %r' % (source, e))
+
+
+def getJournalPath(source):
+    ' Returns the default journal for a JSON file or Solr URL '
+
+    if isSolrURL(source):
+        return 'solr-%s.done' % hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+    return source + '.done'
+
+
+## -- Journal of finished updates -- ##
+
+class updateJournal(object):
+    ' The digital_object_ids already updated, kept one per line in a file so a rerun can skip them '
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as fh:
+                self.done = set(line.strip() for line in fh if line.strip())
+        self.fh = None
+
+    def __contains__(self, digital_object_id):
+        return digital_object_id in self.done
+
+    def add(self, digital_object_id):
+        if self.fh is None:
+            self.fh = open(self.path, 'a')
+        self.fh.write(digital_object_id + '\n')
+        # Flushed at once so nothing is lost if the run dies
+        self.fh.flush()
+        self.done.add(digital_object_id)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+## -- Updating ArchivesSpace -- ##
+
+def addCompassURI(digital_object, compass_uri):
+    ' Adds the Compass URI to a Digital Object record as a file version, unless it already has it, and publishes the first file version '
+    ' Returns a description of each change made, empty if the record was already up to date '
+
+    file_versions = digital_object.setdefault('file_versions', [])
+    changes = []
+    if not any(file_version.get('file_uri') == compass_uri for file_version in file_versions):
+        file_versions.append({'file_uri': compass_uri})
+        changes.append('add file version %s' % compass_uri)
+    if file_versions[0].get('publish') is not True:
+        file_versions[0]['publish'] = True
+        changes.append('publish file version %s' % file_versions[0].get('file_uri'))
+    return changes
+
+
+def updateDOwithCompassURI(ywca_compass_object, dry_run=False, retries=DEFAULT_RETRIES, repo_num=record_funcs.DEFAULT_REPO_NUM):
+    ' Updates ArchivesSpace Digital Object records with their Compass URIs '
+    ' Returns the digital_object_id and the changes made, as from addCompassURI; records that need none are not saved again '
+    ' If someone else saves the record first, or ArchivesSpace has trouble, fetches it again and retries with backoff '
+
+    # Gets the digital object id and the digital object record
+    do_uri = '/repositories/%s/digital_objects/%s' % (repo_num, ywca_compass_object['mods_identifier_local_s'])
+    attempt = 0
+    while True:
+        try:
+            digital_object = callAspace('GET %s' % do_uri, aspace.get, do_uri)
+            # Builds the data dictionary necessary for the API call to update the digital object record
+            changes = addCompassURI(digital_object, ywca_compass_object['PID'])
+            if changes and not dry_run:
+                # Updates digital object records with the file URIs
+                callAspace('POST %s' % do_uri, aspace.post, do_uri, requestData=digital_object)
+            return digital_object['digital_object_id'], changes
+        except updateFailed as e:
+            if not e.retryable or attempt >= retries:
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt * random.uniform(1, 1.5)
+            if e.conflict:
+                logging.info('%s changed while being updated, fetching it again in %.1fs' % (do_uri, delay))
+            else:
+                logging.warning('%s, retrying in %.1fs' % (e, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def updateAll(compass_objects, journal=None, workers=DEFAULT_WORKERS, dry_run=False, retries=DEFAULT_RETRIES, repo_num=record_funcs.DEFAULT_REPO_NUM):
+    ' Updates the Digital Objects of compass_objects using up to workers threads '
+    ' Returns how many were updated, already had their Compass URI, were skipped as already done and failed '
+
+    counts = {'updated': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+
+    def update(compass_object):
+        try:
+            return compass_object, updateDOwithCompassURI(compass_object, dry_run, retries, repo_num), None
+        except updateFailed as e:
+            return compass_object, (None, []), e
+        except Exception as e:
+            # Anything else wrong with one record fails just that record
+            return compass_object, (None, []), repr(e)
+
+    def pending():
+        for compass_object in compass_objects:
+            if journal is not None and compass_object['digital_object_id'] in journal:
+                counts['skipped'] += 1
+                continue
+            yield compass_object
+
+    for compass_object, (digital_object_id, changes), error in worker_pool.mapInOrder(update, pending(), workers):
+        if error is not None:
+            logging.error('Could not update %s: %s' % (compass_object['digital_object_id'], error))
+            counts['failed'] += 1
+            continue
+
+        if not changes:
+            logging.info('%s already has %s' % (digital_object_id, compass_object['PID']))
+            counts['unchanged'] += 1
+        elif dry_run:
+            print('Would %s on %s' % (' and '.join(changes), digital_object_id))
+            counts['updated'] += 1
+        else:
+            print(digital_object_id)
+            counts['updated'] += 1
+        if journal is not None and not dry_run:
+            journal.add(compass_object['digital_object_id'])
+
+    return counts
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("jsonfile", help="Path to the JSON file of Solr output containing the data with which to update the records, a .jsonl file with one Solr doc per line, or a Solr select URL to page through.")
+    argparser.add_argument("SERVERCFG", nargs="?", default="DEFAULT", help="Name of the server configuration section e.g. 'production' or 'testing'. Edit archivesspace.cfg to add a server configuration section. If no configuration is specified, the default settings will be used host=localhost user=admin pass=admin.")
+    argparser.add_argument("--repository", type=int, default=record_funcs.DEFAULT_REPO_NUM, help="Repository the Digital Objects are in. (default: %(default)s)")
+    argparser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of Digital Objects to update at once. (default: %(default)s)")
+    argparser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Times to retry an update after a conflict, server error or dropped connection. (default: %(default)s)")
+    argparser.add_argument("--journal", metavar="FILE", help="File listing the digital_object_ids already updated, which are skipped, and to which each update is added. (default: the JSON file's path with .done appended, or solr-<hash of the URL>.done)")
+    argparser.add_argument("--no-journal", action="store_true", help="Update every Digital Object and don't keep a journal.")
+    argparser.add_argument("--solr-rows", type=int, default=SOLR_ROWS, help="Docs to fetch per request when jsonfile is a Solr URL. (default: %(default)s)")
+    argparser.add_argument("--solr-cursor", action="store_true", help="Page through Solr with cursorMark, sorted by PID, instead of start. Needs Solr 4.7 or later.")
+    argparser.add_argument("--dry-run", action="store_true", help="Report the updates that would be made without saving anything.")
+    cliArguments = argparser.parse_args()
+
+    ## -----Connect to ASpace API----- ##
+
+    client = archivesspace.ArchivesSpace()
+    client.setServerCfg(CONFIGFILE, section=cliArguments.SERVERCFG)
+    client.connect()
+    aspace = worker_pool.aspaceRequestLimiter(client, max(cliArguments.workers, 1))
+
+    ##-------------------------------- ##
+
+    # Reads SOLR query output for YWCA of the U.S.A. Photographic Records within Compass a doc at a time,
+    # so updates start straight away
+    compass_objects = iterCompassObjects(cliArguments.jsonfile, cliArguments.solr_rows, cliArguments.solr_cursor)
+
+    journal = None
+    if not cliArguments.no_journal:
+        journal = updateJournal(cliArguments.journal or getJournalPath(cliArguments.jsonfile))
 
-# Opens JSON file of SOLR query output for YWCA of the U.S.A. Photographic Records within Compass
-# Transforms JSON into usable Python dictionary object
-jsonfile = cliArguments.jsonfile
-with open(jsonfile) as json_file:
     try:
-    	json_data = json.load(json_file)
-    except ValueError:
-    	exit(1)
-
-# Parses the dictionary and adds to a list the dictionaries within that dictionary of each Compass object
-ywca_compass_objects = []
-for ob_dict in json_data['response']['docs']:
-	x = ob_dict
-	ywca_compass_objects.append(x)
-
-# Adds Compass root to PID
-for ob in ywca_compass_objects:
-	pid = ob['PID']
-	ob['PID'] = 'https://compass.fivecolleges.edu/object/' + pid
-# ywca_compass_objects now contains full Compass URIs for every Compass object
-
-# Strips identifier to the numeric string needed for the API endpoint
-# e.g. "smith_ssc_324_digital_object_289" to "289"
-for ob in ywca_compass_objects:
-	do_id = ob['mods_identifier_local_s']
-	ob['mods_identifier_local_s'] = do_id.split('_')[-1]
-# ywca_compass_objects['mods_identifier_local_s'] now contains only the ASpace object id necessary to run API calls 
-
-##-------------------------------- ##
-
-def updateDOwithCompassURI(ywca_compass_object):
-	' Updates ArchivesSpace Digital Object records with their Compass URIs '
-	
-	# Gets the digital object id and the digital object record
-	do_id = ywca_compass_object['mods_identifier_local_s']
-	digital_object = aspace.get('/repositories/2/digital_objects/' + do_id)
-	# Gets the Compass URI and builds the data dictionary necessary for the API call to update the digital object record
-	compass_uri = ywca_compass_object['PID']
-	uri_key = {'file_uri': compass_uri}
-	digital_object['file_versions'].append(uri_key)
-	digital_object['file_versions'][0]['publish'] = True
-	# Updates digital object records with the file URIs
-	response = aspace.post('/repositories/2/digital_objects/' + do_id, requestData=digital_object)
-
-	return digital_object['digital_object_id']
-
-
-## -- Function call -- ##
-
-for compass_ob in ywca_compass_objects:
-	print(updateDOwithCompassURI(compass_ob))
+        counts = updateAll(compass_objects, journal, cliArguments.workers, cliArguments.dry_run, cliArguments.retries, cliArguments.repository)
+    except inputFailed as e:
+        logging.error(e)
+        exit(1)
+    finally:
+        if journal is not None:
+            journal.close()
+
+    if cliArguments.dry_run:
+        logging.info('Dry run: %(updated)s would be updated, %(unchanged)s unchanged, %(skipped)s already done, %(failed)s failed' % counts)
+    else:
+        logging.info('%(updated)s updated, %(unchanged)s unchanged, %(skipped)s already done, %(failed)s failed' % counts)
+    if counts['failed']:
+        exit(1)
@@ -1,26 +1,27 @@
 from archivesspace import archivesspace
-import jinja2
 import pprint
 import argparse
 import glob
 import os.path
 import record_funcs
+import aspace_cache
+import worker_pool
+import pipeline
+import mods_renderer
+import export_manifest
+import check_asis_mods_diff
+import authorities
+import profiling
+import collections
+import contextlib
+import copy
 import logging
+import sys
+import threading
+import time
 
 CONFIGFILE = "archivesspace.cfg"
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument("outputpath", help="File path for record output.")
-argparser.add_argument("RESOURCERECORDID", type=int, help="ID of top level resource record to get digital objects from. (example: 676)")
-argparser.add_argument("SERVERCFG", default="DEFAULT", help="Name of the server configuration section e.g. 'production' or 'testing'. Edit archivesspace.cfg to add a server configuration section. If no configuration is specified, the default settings will be used host=localhost user=admin pass=admin.")
-cliArguments = argparser.parse_args()
-
-aspace = archivesspace.ArchivesSpace()
-aspace.setServerCfg(CONFIGFILE, section=cliArguments.SERVERCFG)
-aspace.connect()
-
-myrecordfuncs = record_funcs.aspaceRecordFuncs(aspace)
-
 """
 Query ArchivesSpace API for details about an Archival Object and format the
 resulting data in MODS format using a jinja template.
@@ -37,7 +38,86 @@ logging.basicConfig(level=logging.INFO)
 
 NOTETYPESURI = '/config/enumerations/45'
 
-print("*********")
+# Set by useClient before any of the functions below are called
+aspace = None
+myrecordfuncs = None
+
+# Set by useRenderer, or loaded from the default template on first use
+renderer = None
+
+# Resource URI -> resourceContext, built the first time a record from the Resource is assembled
+resource_contexts = {}
+resource_contexts_lock = threading.Lock()
+# Resource URI -> Event set once the context being built by another thread is ready
+resource_contexts_pending = {}
+
+# MODS name types for agents' jsonmodel_types
+AGENT_NAME_TYPES = {'agent_person': 'personal', 'agent_corporate_entity': 'corporate'}
+# Roles whose agents are rendered as MODS names
+NAME_ROLES = ('creator', 'source', 'subject')
+
+# Set by useProfiler to time the export
+profiler = None
+
+# Helpers timed when profiling, from this module and from record_funcs
+PROFILED_HELPERS = ['getDigitalObject', 'getArchivalObject', 'getShelfLocation', 'getFolder', 'getAgents', 'getAllAgents', 'getResourceContext', 'getRecordData', 'renderData', 'prefetchRecords']
+PROFILED_RECORD_FUNCS = ['getResource', 'getSubjects', 'getGenreSubjects', 'getNotesTree', 'getLangAtAOLevel', 'getAncestors', 'getDigitalObjectRefs', 'getModsFileName', 'prefetchRecords', 'prefetchLinkedRecords']
+
+
+def useClient(client):
+    ' Points the functions in this module at an aspace client, e.g. one wrapped in a record cache '
+    ' A client that doesn\'t normalize authority_ids gets a record cache with the default authorityNormalizer '
+
+    global aspace, myrecordfuncs
+    aspace = authorities.normalizingClient(client)
+    myrecordfuncs = record_funcs.aspaceRecordFuncs(aspace)
+    with resource_contexts_lock:
+        resource_contexts.clear()
+    if profiler is not None:
+        instrumentHelpers()
+
+
+def useProfiler(export_profiler):
+    ' Times the stages and helpers of the export with a profiling.exportProfiler, before or after useClient '
+    ' None puts the untimed helpers back '
+
+    global profiler
+    if profiler is not None:
+        profiler.restore()
+    profiler = export_profiler
+    if profiler is not None:
+        instrumentHelpers()
+
+
+def instrumentHelpers():
+    ' Swaps in the profiler\'s timed versions of the helpers; ones already swapped are left alone '
+
+    profiler.instrument(sys.modules[__name__], PROFILED_HELPERS)
+    if myrecordfuncs is not None:
+        profiler.instrument(myrecordfuncs, PROFILED_RECORD_FUNCS, prefix='record_funcs.')
+
+
+def profiled(name, func):
+    ' Returns func, timed as a stage of the export if profiling '
+
+    if profiler is None:
+        return func
+    return profiler.timed(name, func, kind='stage')
+
+
+def profileRecord(do_uri):
+    ' Watches for URIs looked up more than once while assembling a record, if profiling '
+
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.record(do_uri)
+
+
+def useRenderer(mods_template_renderer):
+    ' Sets the mods_renderer.modsRenderer used to render every record '
+
+    global renderer
+    renderer = mods_template_renderer
 
 
 def getDigitalObject(do_uri):
@@ -112,6 +192,12 @@ def getMsNo(archival_object):
 
     logging.debug('Retrieving MS number of Archival Object %s' % archival_object['uri'])
     resource = myrecordfuncs.getResource(archival_object)
+    return getResourceMsNo(resource)
+
+
+def getResourceMsNo(resource):
+    'Get the MS number of a Resource'
+
     try:
         id_1 = resource['id_1']
         id_2 = resource['id_2']
@@ -122,160 +208,487 @@ def getMsNo(archival_object):
     return ms_no
 
 
+def resolveAgents(linked_agents):
+    ' Returns the role, ref and agent record of each distinct role and ref in linked_agents, in order '
+    ' Agents are read through the record cache, so each is fetched once and every record gets its own copy '
+
+    agents = []
+    seen = set()
+    for agent in linked_agents:
+        pair = (agent['role'], agent['ref'])
+        if pair in seen:
+            continue
+        seen.add(pair)
+        data = aspace.get(agent['ref'])
+        if agent['role'] in NAME_ROLES and data.get('jsonmodel_type') in AGENT_NAME_TYPES:
+            data['jsonmodel_type'] = AGENT_NAME_TYPES[data['jsonmodel_type']]
+        agents.append({'role': agent['role'], 'ref': agent['ref'], 'data': data})
+
+    return agents
+
+
 def getAgents(archival_object):
     'Returns agents'
-    agents_lst = []
-    if 'linked_agents' in archival_object.keys():
-        for agent in archival_object['linked_agents']:
-            agents_lst.append(agent)
-
-    new_agents_lst = []     
-    for agent in agents_lst:
-        agent_dct = {}
-        agent_dct['role'] = agent['role']
-        uri = agent['ref']
-        agent_dct['data'] = aspace.get(uri) 
-        new_agents_lst.append(agent_dct)
-
-
-    for agent in new_agents_lst:
-        if agent['role'] == 'creator':
-            if agent['data']['jsonmodel_type'] == 'agent_person':
-                agent['data']['jsonmodel_type'] = 'personal'
-            elif agent['data']['jsonmodel_type'] == 'agent_corporate_entity':
-                agent['data']['jsonmodel_type'] = 'corporate'
-            else:
-                pass
-        if agent['role'] == 'source':
-            if agent['data']['jsonmodel_type'] == 'agent_person':
-                agent['data']['jsonmodel_type'] = 'personal'
-            elif agent['data']['jsonmodel_type'] == 'agent_corporate_entity':
-                agent['data']['jsonmodel_type'] = 'corporate'
-            else:
-                pass
-        if agent['role'] == 'subject':
-            if agent['data']['jsonmodel_type'] == 'agent_person':
-                agent['data']['jsonmodel_type'] = 'personal'
-            elif agent['data']['jsonmodel_type'] == 'agent_corporate_entity':
-                agent['data']['jsonmodel_type'] = 'corporate'
-            else:
-                pass
-
-            if 'display_name' in agent['data'].keys():
-                if 'authority_id' in agent['data']['display_name'].keys():
-                    if agent['data']['display_name']['source'] == 'naf':
-                        if 'loc.gov' not in agent['data']['display_name']['authority_id']:
-                            agent['data']['display_name']['authority_id'] = 'http://id.loc.gov/authorities/names/' + agent['data']['display_name']['authority_id']
-                        elif agent['data']['display_name']['source'] == 'lcsh':
-                            agent['data']['display_name']['authority_id'] = 'http://id.loc.gov/authorities/subjects/' + agent['data']['display_name']['authority_id']
-                        elif agent['data']['display_name']['source'] == 'tgn':
-                            agent['data']['display_name']['authority_id'] = 'http://vocab.getty.edu/tgn/' + agent['data']['display_name']['authority_id']
-                        elif agent['data']['display_name']['source'] == 'aat':
-                            agent['data']['display_name']['authority_id'] = 'http://vocab.getty.edu/aat/' + agent['data']['display_name']['authority_id']
-
-    return new_agents_lst
 
+    return resolveAgents(archival_object.get('linked_agents', []))
 
-def getParentRecords(archival_object):
-    parent_uris = []
-    for i in range(100):
-        try:
-            parentUri = archival_object['parent']['ref']
-        except KeyError:
-            break
-        parent_ao = aspace.get(parentUri)
-        if parent_ao['uri'] not in parent_uris:
-            parent_uris.append(parent_ao['uri'])
 
-    parent_records = []
-    for uri in parent_uris:
-        parent_record = aspace.get(uri)
-        parent_records.append(parent_record)
+def getParentRecords(archival_object):
+    ' Returns the parent records whose agents an Archival Object inherits '
+    # Only the immediate parent, which is all the earlier loop here ever returned
+    # since it kept re-reading the same parent ref
 
-    return parent_records
+    return myrecordfuncs.getAncestors(archival_object, levels=1)
 
 
-def getAllAgents(archival_object, resource):
-    all_agents = []
+def getAllAgents(archival_object, resource, resource_agents=None):
+    ' Returns the agents of the Resource, the Archival Object and its parent, in that order, each role and agent only once '
+    ' Pass resource_agents if the Resource\'s getAgents have already been worked out '
 
-    resource_agents = getAgents(resource)
-    all_agents.extend(resource_agents)
+    if resource_agents is None:
+        resource_agents = getAgents(resource)
+    all_agents = list(resource_agents)
+    seen = set((agent['role'], agent['ref']) for agent in all_agents)
 
-    ao_agents = getAgents(archival_object)
-    all_agents.extend(ao_agents)
+    # Resolved together so each role and agent linked from the chain is only read once
+    linked_agents = list(archival_object.get('linked_agents', []))
+    for record in getParentRecords(archival_object):
+        linked_agents.extend(record.get('linked_agents', []))
 
-    parent_records = getParentRecords(archival_object)
-    for record in parent_records:
-        parent_agents = getAgents(record)
-        all_agents.extend(parent_agents)
+    for agent in resolveAgents(linked_agents):
+        if (agent['role'], agent['ref']) not in seen:
+            seen.add((agent['role'], agent['ref']))
+            all_agents.append(agent)
 
     return all_agents
 
 
-def renderRecord(do_uri):
+class resourceContext(object):
+    ' The parts of a MODS record that are the same for every Archival Object in a Resource, worked out once '
+
+    def __init__(self, resource_uri):
+        with trackReads() as inputs:
+            self.resource = aspace.get(resource_uri)
+            self.repository = aspace.get(self.resource['repository']['ref'])
+            self.collecting_unit = self.repository['name']
+            self.ms_no = getResourceMsNo(self.resource)
+            self.notes = myrecordfuncs.getNotesByResource(self.resource)
+            self.agents = getAgents(self.resource)
+            self.genre_subs = myrecordfuncs.getResourceGenreSubjects(self.resource)
+        # Every record built from this context depends on these
+        self.inputs = dict(inputs)
+
+    def copy(self):
+        ' Returns a deep copy, so a record can use the shared parts without other records seeing its changes to them '
+
+        return copy.deepcopy(self)
+
+
+def getResourceContext(resource_uri):
+    ' Returns the resourceContext for a Resource, building it the first time it is asked for '
+    ' Other threads asking for the same Resource wait for it, while other Resources\' contexts can be looked up and built meanwhile '
+
+    while True:
+        with resource_contexts_lock:
+            context = resource_contexts.get(resource_uri)
+            if context is not None:
+                return context
+            building = resource_contexts_pending.get(resource_uri)
+            if building is None:
+                resource_contexts_pending[resource_uri] = threading.Event()
+                break
+        building.wait()
+
+    try:
+        logging.info('Building context for Resource %s' % resource_uri)
+        context = resourceContext(resource_uri)
+        with resource_contexts_lock:
+            resource_contexts[resource_uri] = context
+    finally:
+        with resource_contexts_lock:
+            resource_contexts_pending.pop(resource_uri).set()
+
+    return context
+
+
+def getRecordData(do_uri, context=None):
     'Call all the functions'
+    ' context is the resourceContext of the Archival Object\'s Resource, looked up if not given '
 
     logging.info('Calling all functions and rendering MODS record')
     digital_object = getDigitalObject(do_uri)
     archival_object = getArchivalObject(do_uri)
-    archival_object = archival_object
+    if context is None:
+        context = getResourceContext(archival_object['resource']['ref'])
+    noteInputs(context.inputs)
+    # The context is shared by every record, so this one gets its own copy, as it would from the record cache
+    context = context.copy()
     container = getShelfLocation(archival_object)
     folder = getFolder(archival_object)
-    resource = myrecordfuncs.getResource(archival_object)
-    notes = myrecordfuncs.getNotesTree(archival_object)
+    resource = context.resource
+    notes = myrecordfuncs.getNotesTree(archival_object, context.notes)
     abstract = myrecordfuncs.getNotesByType(notes, 'scopecontent')
     userestrict = myrecordfuncs.getNotesByType(notes, 'userestrict')
     accrestrict = myrecordfuncs.getNotesByType(notes, 'accessrestrict')
-    langs = myrecordfuncs.getLangAtAOLevel(archival_object)
-    collecting_unit = getCollectingUnit(archival_object)
-    ms_no = getMsNo(archival_object)
-    repository = getRepository(archival_object)
+    langs = myrecordfuncs.getLangAtAOLevel(archival_object, notes)
+    collecting_unit = context.collecting_unit
+    ms_no = context.ms_no
+    repository = context.repository
     subjects = myrecordfuncs.getSubjects(archival_object)
-    genre_subs = myrecordfuncs.getGenreSubjects(subjects, resource)
+    genre_subs = myrecordfuncs.getGenreSubjects(subjects, resource, context.genre_subs)
     subjects = myrecordfuncs.deleteGenreSubjects(subjects)
-    agents = getAllAgents(archival_object, resource)
+    agents = getAllAgents(archival_object, resource, context.agents)
 
     data = {'archival_object': archival_object, 'resource': resource, 'langs': langs, 'repository': repository, 'subjects': subjects, 'genre_subs': genre_subs, 'agents': agents, 'collecting_unit': collecting_unit, 'ms_no': ms_no, 'digital_object': digital_object, 'folder': folder, 'container': container, 'abstract': abstract, 'userestrict': userestrict, 'accessrestrict': accrestrict}
 
-    templateLoader = jinja2.FileSystemLoader(searchpath=".")
-    templateEnv = jinja2.Environment(loader=templateLoader)
+    return data
 
-    # Merge the template and data
-    template = templateEnv.get_template('compass-mods-template.xml')
 
-    return template.render(data)
+def renderData(data):
+    ' Merges the data for a record with the MODS template '
 
+    if renderer is None:
+        useRenderer(mods_renderer.modsRenderer())
 
+    return renderer.render(data)
 
 
-' ********************************* '
-' ***** Calling the functions ***** '
-' ********************************* '
+def renderRecord(do_uri, context=None):
+    ' Returns the MODS record for a Digital Object, built with the resourceContext of its Resource if given '
 
-'Retrieve list of digital object URIs for YWCA of the U.S.A. Photographic Records'
-ywca_photo_uris = myrecordfuncs.getAllResourceUris(cliArguments.RESOURCERECORDID)
+    return renderData(getRecordData(do_uri, context))
 
-'Make API call for each record in YWCA of the U.S.A. Photographic Records and add all Digital Object URIs to a list'
-do_photo_uris = myrecordfuncs.getDigitalObjectUris(ywca_photo_uris)
 
+def prefetchRecords(do_uris, batch_size=record_funcs.DEFAULT_BATCH_SIZE, workers=1):
+    ' Fetches the records needed to render a group of Digital Objects in batches, priming the record cache '
 
-'Writing the files'
-save_path = cliArguments.outputpath
+    myrecordfuncs.prefetchRecords(do_uris, batch_size, workers)
+    digital_objects = [getDigitalObject(do_uri) for do_uri in do_uris]
 
-if os.path.isdir(save_path) != False:
-    for do_uri in do_photo_uris:
-        logging.debug('Rendering MODS record for %s' % do_uri)
-        xml = renderRecord(do_uri)
-        do = getDigitalObject(do_uri)
-        handle = myrecordfuncs.getModsFileName(do)
-        filename = os.path.join(save_path, handle + ".xml")
+    ao_uris = [do['linked_instances'][0]['ref'] for do in digital_objects if do.get('linked_instances')]
+    myrecordfuncs.prefetchRecords(ao_uris, batch_size, workers)
+    archival_objects = [aspace.get(ao_uri) for ao_uri in ao_uris]
+
+    # Subjects, agents, top containers and parents, then the agents and grandparents linked from the parents
+    myrecordfuncs.prefetchLinkedRecords(archival_objects, batch_size, workers)
+    parents = [aspace.get(ao['parent']['ref']) for ao in archival_objects if 'parent' in ao]
+    myrecordfuncs.prefetchLinkedRecords(parents, batch_size, workers)
+
+
+def trackReads():
+    ' Collects the versions of the records read while assembling one record, if the client can track them '
+
+    if hasattr(aspace, 'trackReads'):
+        return aspace.trackReads()
+    return contextlib.nullcontext({})
 
+
+def noteInputs(inputs):
+    ' Adds records collected by an earlier trackReads, e.g. a resourceContext\'s, to the reads being tracked now '
+
+    if hasattr(aspace, 'noteInputs'):
+        aspace.noteInputs(inputs)
+
+
+class resourceProgress(object):
+    ' Counts the records written for each Resource of an export, for a report of each one\'s throughput '
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resources = collections.OrderedDict()
+
+    def start(self, resource_uri):
+        with self.lock:
+            self.resources.setdefault(resource_uri, {'records': 0, 'started': time.time(), 'finished': None})
+
+    def written(self, resource_uri):
+        with self.lock:
+            stats = self.resources.setdefault(resource_uri, {'records': 0, 'started': time.time(), 'finished': None})
+            stats['records'] += 1
+            stats['finished'] = time.time()
+
+    def logSummary(self):
+        with self.lock:
+            for resource_uri, stats in self.resources.items():
+                if stats['records']:
+                    elapsed = max(stats['finished'] - stats['started'], 0.001)
+                    logging.info('Resource %s: %s records written in %.1fs (%.1f/s)' % (resource_uri, stats['records'], elapsed, stats['records'] / elapsed))
+                else:
+                    logging.info('Resource %s: no records written' % resource_uri)
+
+
+def addRenderStages(export, save_path, workers=1, batch_size=record_funcs.DEFAULT_BATCH_SIZE, manifest=None, sync=None, progress=None):
+    ' Adds the record assembly -> template render -> file write stages for a stream of Digital Object URIs '
+    ' With a manifest the inputs of each file are recorded in it '
+    ' With sync, a function of the file name and rendered xml, only records it returns True for are written '
+    ' With a resourceProgress, each file written is counted against its Resource '
+
+    def assemble(do_uris):
+        if batch_size:
+            prefetchRecords(do_uris, batch_size)
+        assembled = []
+        for do_uri in do_uris:
+            with trackReads() as inputs, profileRecord(do_uri):
+                data = getRecordData(do_uri)
+            assembled.append((do_uri, data, inputs))
+        return assembled
+
+    def render(assembled):
+        do_uri, data, inputs = assembled
+        handle = myrecordfuncs.getModsFileName(data['digital_object'])
+        return [(do_uri, handle, renderData(data), inputs, data['resource']['uri'])]
+
+    def compare(rendered):
+        do_uri, handle, xml, inputs, resource_uri = rendered
+        if sync(handle, xml):
+            return [rendered]
+        logging.debug('%s matches the ingested datastream, not writing it' % handle)
+        return []
+
+    def write(rendered):
+        do_uri, handle, xml, inputs, resource_uri = rendered
+        filename = os.path.join(save_path, handle + ".xml")
         with open(filename, "w") as fh:
             logging.info('Writing %s' % filename)
             fh.write(xml)
-
-    logging.info('All files written.')        
-
-else:
-    logging.info("Directory not found. Please create if not created. Files cannot be written without an existing directory to store them.")
-    exit(1)
+        if manifest is not None:
+            manifest.record(do_uri, filename, inputs, resource_uri)
+        if progress is not None:
+            progress.written(resource_uri)
+        return [filename]
+
+    export.addStage('assemble', profiled('assemble', assemble), workers=workers, batch_size=batch_size or 1)
+    export.addStage('render', profiled('render', render), workers=workers)
+    if sync is not None:
+        export.addStage('compare', profiled('compare', compare), workers=workers)
+    export.addStage('write', profiled('write', write))
+
+
+def exportResource(resource_num, save_path, workers=1, batch_size=record_funcs.DEFAULT_BATCH_SIZE, manifest=None, incremental=False, sync=None, repo_num=record_funcs.DEFAULT_REPO_NUM):
+    ' Streams every Digital Object in a resource through to a MODS file in save_path '
+
+    exportResources([(repo_num, resource_num)], save_path, workers, batch_size, manifest, incremental, sync)
+
+
+def exportResources(resources, save_path, workers=1, batch_size=record_funcs.DEFAULT_BATCH_SIZE, manifest=None, incremental=False, sync=None):
+    ' Streams every Digital Object in each of resources, an iterable of (repository number, resource number), through to a MODS file in save_path '
+    ' tree walk -> digital object discovery -> record assembly -> template render -> file write '
+    ' The resources are walked one after another into the same stages, so they share the workers and the record cache '
+    ' With incremental only Digital Objects the manifest says have changed are exported '
+
+    def discover(ao_uris):
+        if batch_size:
+            myrecordfuncs.prefetchRecords(ao_uris, batch_size)
+        do_uris = []
+        for ao_uri in ao_uris:
+            archival_object = aspace.get(ao_uri)
+            if 'instances' not in archival_object.keys():
+                logging.error('Archival Object %s has no instances, skipping' % ao_uri)
+                continue
+            for do_uri in myrecordfuncs.getDigitalObjectRefs(archival_object):
+                if incremental and manifest.isCurrent(do_uri, archival_object['resource']['ref']):
+                    continue
+                do_uris.append(do_uri)
+        return do_uris
+
+    progress = resourceProgress()
+
+    def walk():
+        for repo_num, resource_num in resources:
+            logging.info('Walking Resource %s in repository %s' % (resource_num, repo_num))
+            resource_uri = '/repositories/%s/resources/%s' % (repo_num, resource_num)
+            progress.start(resource_uri)
+            walked = 0
+            for uri, has_digital_instance in myrecordfuncs.walkResourceTree(resource_num, repo_num):
+                walked += 1
+                if has_digital_instance is not False:
+                    yield uri
+            # An empty walk proves nothing, so the manifest's entries for it are kept
+            if manifest is not None and walked:
+                manifest.walkedResource(resource_uri)
+
+    ao_uris = walk()
+    if profiler is not None:
+        ao_uris = profiler.timedItems('walk', ao_uris)
+
+    export = pipeline.recordPipeline()
+    export.addStage('discover', profiled('discover', discover), workers=workers, batch_size=batch_size or 1)
+    addRenderStages(export, save_path, workers, batch_size, manifest, sync, progress)
+    export.run('walk', ao_uris)
+    progress.logSummary()
+
+
+def exportDigitalObjects(do_uris, save_path, workers=1, batch_size=record_funcs.DEFAULT_BATCH_SIZE, manifest=None, sync=None):
+    ' Exports just the given Digital Objects to MODS files in save_path '
+
+    export = pipeline.recordPipeline()
+    addRenderStages(export, save_path, workers, batch_size, manifest, sync)
+    export.run('digital objects', do_uris)
+
+
+def readUris(path):
+    ' Returns the URIs listed one per line in a file, ignoring blank lines '
+
+    with open(path) as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def parseResourceSpecs(specs, default_repo_num=record_funcs.DEFAULT_REPO_NUM):
+    ' Returns a (repository number, resource number) pair for each resource given as 676, 3:12, all or 3:all '
+    ' all has a resource number of None, and a repository number of None when it means every repository. Raises ValueError for anything else '
+
+    parsed = []
+    for spec in specs:
+        repo, separator, resource = spec.strip().rpartition(':')
+        repo_num = int(repo) if separator else default_repo_num
+        if resource == 'all':
+            parsed.append((repo_num if separator else None, None))
+        else:
+            parsed.append((repo_num, int(resource)))
+
+    return parsed
+
+
+def iterResources(parsed, workers=1, batch_size=record_funcs.DEFAULT_BATCH_SIZE):
+    ' Yields each distinct (repository number, resource number) from parseResourceSpecs, finding the resources with Digital Objects for all as it goes '
+
+    seen = set()
+    for repo_num, resource_num in parsed:
+        if resource_num is not None:
+            found = [(repo_num, resource_num)]
+        else:
+            repo_nums = [repo_num] if repo_num is not None else myrecordfuncs.getRepositoryNums()
+            found = ((repo, resource) for repo in repo_nums for resource in myrecordfuncs.iterResourcesWithDigitalObjects(repo, workers, batch_size))
+        for pair in found:
+            if pair not in seen:
+                seen.add(pair)
+                yield pair
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("outputpath", help="File path for record output.")
+    argparser.add_argument("RESOURCERECORDID", help="ID of top level resource record to get digital objects from (example: 676). Several can be separated by commas, each as an ID in the --repository or as REPOSITORY:ID (example: 676,3:12). 'all' exports every resource with Digital Objects, 'REPOSITORY:all' those in one repository, and '@FILE' reads the resources from FILE, one per line.")
+    argparser.add_argument("SERVERCFG", default="DEFAULT", help="Name of the server configuration section e.g. 'production' or 'testing'. Edit archivesspace.cfg to add a server configuration section. If no configuration is specified, the default settings will be used host=localhost user=admin pass=admin.")
+    argparser.add_argument("--repository", type=int, default=record_funcs.DEFAULT_REPO_NUM, help="Repository of resource IDs given without one. (default: %(default)s)")
+    argparser.add_argument("--cache-size", type=int, default=aspace_cache.DEFAULT_CACHE_SIZE, help="Maximum number of ArchivesSpace records to keep in the in-memory cache. (default: %(default)s)")
+    argparser.add_argument("--persistent-cache", metavar="PATH", help="Keep ArchivesSpace records in an SQLite file at PATH between runs and only refetch records that have changed.")
+    argparser.add_argument("--cache-max-age", type=float, metavar="HOURS", help="Refetch records from the persistent cache that are older than this, even if unchanged.")
+    argparser.add_argument("--purge-cache", action="store_true", help="Empty the persistent cache before exporting.")
+    argparser.add_argument("--workers", type=int, default=1, help="Number of threads fetching and rendering records at once. (default: %(default)s)")
+    argparser.add_argument("--batch-size", type=int, default=record_funcs.DEFAULT_BATCH_SIZE, help="Number of records to fetch from ArchivesSpace in one id_set request. 0 fetches records one at a time. (default: %(default)s)")
+    argparser.add_argument("--max-requests", type=int, help="Maximum number of ArchivesSpace requests in flight at once across all workers. Defaults to the number of workers.")
+    argparser.add_argument("--incremental", action="store_true", help="Only export Digital Objects whose ArchivesSpace records changed since the last export to outputpath, using the manifest kept there.")
+    argparser.add_argument("--changed-uris", metavar="FILE", help="Instead of walking the resource, re-export only the files in outputpath that depend on the ArchivesSpace URIs listed one per line in FILE (subjects, agents, resources, Archival Objects, ...).")
+    argparser.add_argument("--changed-since-last-run", action="store_true", help="Instead of walking the resource, ask ArchivesSpace which records changed since the last export to outputpath and re-export only the files that depend on them.")
+    argparser.add_argument("--sync", metavar="ENVIRONMENT", help="Compare each rendered record with the MODS datastream ingested in this Fedora environment (e.g. 'prod') and only write the records that differ, or aren't ingested yet.")
+    argparser.add_argument("--fedora-config", default="fedora.cfg", help="Fedora config file for --sync. (default: %(default)s)")
+    argparser.add_argument("--authority-prefixes", metavar="FILE", help="Config file with an [authority_prefixes] section mapping subject and agent sources to the URI prefix for their authority_ids, added to the built in lcsh, lcnaf, naf, tgn and aat.")
+    argparser.add_argument("--profile", action="store_true", help="Time each stage and helper, count ArchivesSpace requests by URI pattern and caller, and print a summary at the end.")
+    argparser.add_argument("--profile-trace", metavar="FILE", help="Save the profile, with every timed call and request, as JSON to FILE. It can be opened in chrome://tracing or Perfetto.")
+    argparser.add_argument("--template", default=mods_renderer.DEFAULT_TEMPLATE, help="Path to the jinja template to render records with. (default: %(default)s)")
+    argparser.add_argument("--compiled-templates", metavar="DIR", help="Precompile the template to Python modules in DIR and load it from there, recompiling when the template changes.")
+    cliArguments = argparser.parse_args()
+    if cliArguments.sync and (cliArguments.incremental or cliArguments.changed_uris or cliArguments.changed_since_last_run):
+        argparser.error("--sync only writes the records that differ from Fedora, so it can't be combined with the manifest based --incremental, --changed-uris or --changed-since-last-run")
+    if cliArguments.workers < 1:
+        argparser.error("--workers must be at least 1")
+    if cliArguments.max_requests is not None and cliArguments.max_requests < 1:
+        argparser.error("--max-requests must be at least 1")
+    if cliArguments.batch_size < 0:
+        argparser.error("--batch-size must be 0 or more")
+    if cliArguments.cache_size < 1:
+        argparser.error("--cache-size must be at least 1")
+
+    save_path = cliArguments.outputpath
+    if os.path.isdir(save_path) == False:
+        logging.info("Directory not found. Please create if not created. Files cannot be written without an existing directory to store them.")
+        exit(1)
+
+    client = archivesspace.ArchivesSpace()
+    client.setServerCfg(CONFIGFILE, section=cliArguments.SERVERCFG)
+    client.connect()
+    export_profiler = None
+    if cliArguments.profile or cliArguments.profile_trace:
+        export_profiler = profiling.exportProfiler(trace=cliArguments.profile_trace is not None)
+        client = profiling.profiledClient(client, export_profiler, 'requests')
+    client = worker_pool.aspaceRequestLimiter(client, cliArguments.max_requests or cliArguments.workers)
+
+    persistent_cache = None
+    if cliArguments.persistent_cache:
+        max_age = None
+        if cliArguments.cache_max_age is not None:
+            max_age = cliArguments.cache_max_age * 3600
+        server = aspace_cache.getServerName(CONFIGFILE, cliArguments.SERVERCFG)
+        persistent_cache = aspace_cache.aspacePersistentCache(client, cliArguments.persistent_cache, max_age=max_age, purge=cliArguments.purge_cache, server=server)
+        client = persistent_cache
+    elif cliArguments.purge_cache:
+        logging.warning('--purge-cache has no effect without --persistent-cache')
+
+    if cliArguments.authority_prefixes:
+        normalizer = authorities.authorityNormalizer(authorities.loadPrefixes(cliArguments.authority_prefixes))
+    else:
+        normalizer = authorities.authorityNormalizer()
+    client = aspace_cache.aspaceRecordCache(client, maxsize=cliArguments.cache_size, transform=normalizer.normalizeRecord)
+    if export_profiler is not None:
+        # Every lookup, including the ones the cache answers
+        client = profiling.profiledClient(client, export_profiler, 'lookups')
+    useClient(client)
+    if export_profiler is not None:
+        useProfiler(export_profiler)
+    useRenderer(mods_renderer.modsRenderer(cliArguments.template, compiled_path=cliArguments.compiled_templates))
+
+    resources = []
+    # Exports of changed records don't walk the resources
+    if not (cliArguments.changed_uris or cliArguments.changed_since_last_run):
+        if cliArguments.RESOURCERECORDID.startswith('@'):
+            resource_specs = readUris(cliArguments.RESOURCERECORDID[1:])
+        else:
+            resource_specs = [spec for spec in cliArguments.RESOURCERECORDID.split(',') if spec.strip()]
+        try:
+            parsed_resources = parseResourceSpecs(resource_specs, cliArguments.repository)
+        except ValueError as e:
+            argparser.error("Resources must be given as ID, REPOSITORY:ID, all or REPOSITORY:all: %s" % e)
+        # Resources for all are found while the first ones are exported
+        resources = iterResources(parsed_resources, cliArguments.workers, cliArguments.batch_size)
+
+    print("*********")
+
+    if cliArguments.sync:
+        fedora_config = check_asis_mods_diff.loadFedoraConfig(cliArguments.fedora_config, cliArguments.sync)
+        session = check_asis_mods_diff.makeSession(cliArguments.workers)
+
+        def differs(handle, xml):
+            datastream = check_asis_mods_diff.datastreamInfo(handle + '.xml')
+            return check_asis_mods_diff.differsFromIngested(session, datastream, xml.encode('utf-8'), fedora_config)
+
+        # The output directory only gets the records that need ingesting, so there's no manifest to keep
+        exportResources(resources, save_path, workers=cliArguments.workers, batch_size=cliArguments.batch_size, sync=differs)
+    elif cliArguments.changed_uris or cliArguments.changed_since_last_run:
+        manifest = export_manifest.exportManifest(save_path)
+        if cliArguments.changed_uris:
+            changed_uris = readUris(cliArguments.changed_uris)
+        else:
+            manifest.findChanges(aspace)
+            changed_uris = manifest.changed
+        do_uris = manifest.dependentsOf(changed_uris)
+        logging.info('%s changed records affect %s exported files' % (len(changed_uris), len(do_uris)))
+        exportDigitalObjects(do_uris, save_path, workers=cliArguments.workers, batch_size=cliArguments.batch_size, manifest=manifest)
+        # A hand made list of changes doesn't cover everything since the last run
+        manifest.save(prune=False, advance=cliArguments.changed_since_last_run)
+    else:
+        manifest = export_manifest.exportManifest(save_path)
+        if cliArguments.incremental:
+            manifest.findChanges(aspace)
+        exportResources(resources, save_path, workers=cliArguments.workers, batch_size=cliArguments.batch_size, manifest=manifest, incremental=cliArguments.incremental)
+        manifest.save()
+
+    logging.info('All files written.')
+    aspace.logStats()
+    if persistent_cache is not None:
+        persistent_cache.logStats()
+        persistent_cache.close()
+    if cliArguments.profile:
+        export_profiler.printSummary()
+    if cliArguments.profile_trace:
+        export_profiler.writeTrace(cliArguments.profile_trace)
@@ -0,0 +1,175 @@
+"""Manifest of what went into each exported MODS file, for incremental exports.
+
+The manifest lives in the output directory and maps each Digital Object URI to
+its output file and to the lock_version and system_mtime of every
+ArchivesSpace record read while assembling it: the Digital Object, Archival
+Object, ancestors, resource, repository, subjects, agents and top container.
+
+On the next run ArchivesSpace is asked which of those records were modified
+since the last one. Only Digital Objects with a modified input (or no output
+file) are exported again, so editing one agent only rebuilds the objects
+linked to that agent.
+
+Alongside it a dependency index is saved, the manifest turned inside out: for
+each subject, agent, resource, ancestor Archival Object etc. the Digital
+Objects and files that depend on it. dependentsOf uses it to find the files
+to rebuild for a list of changed URIs without walking the resource tree.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import aspace_cache
+
+
+MANIFEST_FILENAME = '.export-manifest.json'
+DEPENDENCY_INDEX_FILENAME = '.dependency-index.json'
+
+
+class exportManifest(object):
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.path = os.path.join(save_path, MANIFEST_FILENAME)
+        self.index_path = os.path.join(save_path, DEPENDENCY_INDEX_FILENAME)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.last_run = None
+        self.records = {}
+        self.seen = set()
+        # Resources whose whole tree was walked this run
+        self.walked = set()
+        self.changed = set()
+        self.skipped = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                manifest = json.load(fh)
+        except FileNotFoundError:
+            logging.info('No export manifest at %s, every record will be exported' % self.path)
+            return
+        except ValueError as e:
+            logging.warning('Could not read export manifest %s, every record will be exported: %s' % (self.path, e))
+            return
+
+        self.last_run = manifest.get('last_run')
+        self.records = manifest.get('records', {})
+        logging.info('Loaded export manifest with %s records from %s' % (len(self.records), self.path))
+
+    def findChanges(self, aspace):
+        ' Asks ArchivesSpace which of the manifest\'s input records were modified since the last run '
+
+        if self.last_run is None:
+            return
+
+        endpoints = {}
+        for entry in self.records.values():
+            for uri in entry['inputs']:
+                endpoint, record_id = uri.rsplit('/', 1)
+                endpoints.setdefault(endpoint, set()).add(record_id)
+
+        since = self.last_run - aspace_cache.CLOCK_SKEW_SECONDS
+        for endpoint, record_ids in endpoints.items():
+            modified = aspace_cache.getModifiedIds(aspace, endpoint, since)
+            if modified is None:
+                modified = record_ids
+            for record_id in record_ids & modified:
+                self.changed.add(endpoint + '/' + record_id)
+
+        logging.info('%s input records modified since the last export' % len(self.changed))
+
+    def isCurrent(self, do_uri, resource_uri=None):
+        ' True if the file for a Digital Object exists and none of its inputs have changed since it was written '
+
+        with self.lock:
+            self.seen.add(do_uri)
+            entry = self.records.get(do_uri)
+            if entry is not None and resource_uri is not None:
+                # Entries from before resources were recorded pick theirs up here
+                entry['resource'] = resource_uri
+        if entry is None or self.last_run is None:
+            return False
+        if not os.path.exists(os.path.join(self.save_path, entry['filename'])):
+            return False
+        if any(uri in self.changed for uri in entry['inputs']):
+            return False
+
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def record(self, do_uri, filename, inputs, resource_uri=None):
+        ' Notes the file written for a Digital Object, the Resource it is in and the records it was built from '
+
+        entry = {'filename': os.path.basename(filename), 'inputs': inputs}
+        if resource_uri is not None:
+            entry['resource'] = resource_uri
+        with self.lock:
+            self.seen.add(do_uri)
+            self.records[do_uri] = entry
+
+    def walkedResource(self, resource_uri):
+        ' Notes that every Archival Object in a Resource was walked this run, so its Digital Objects not seen can be pruned '
+
+        with self.lock:
+            self.walked.add(resource_uri)
+
+    def getDependencyIndex(self):
+        ' Returns a dictionary of input record URI to the Digital Objects and file names that were built from it '
+
+        index = {}
+        with self.lock:
+            for do_uri, entry in self.records.items():
+                for uri in entry['inputs']:
+                    if uri == do_uri:
+                        continue
+                    dependents = index.setdefault(uri, {'digital_objects': [], 'filenames': []})
+                    dependents['digital_objects'].append(do_uri)
+                    dependents['filenames'].append(entry['filename'])
+
+        return index
+
+    def dependentsOf(self, uris):
+        ' Returns the sorted Digital Object URIs whose files were built from any of uris '
+
+        try:
+            with open(self.index_path) as fh:
+                index = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            logging.info('No dependency index at %s, building it from the manifest' % self.index_path)
+            index = self.getDependencyIndex()
+
+        do_uris = set()
+        for uri in uris:
+            if uri in index:
+                do_uris.update(index[uri]['digital_objects'])
+            if uri in self.records:
+                # A Digital Object itself
+                do_uris.add(uri)
+
+        return sorted(do_uris)
+
+    def save(self, prune=True, advance=True):
+        ' Writes the manifest and dependency index '
+        ' prune drops Digital Objects that were not seen this run from the Resources that were walked, so files from '
+        ' other Resources in the same directory are kept. advance moves the last run time on to this run, '
+        ' which is only right if every change since the last run has been dealt with '
+
+        with self.lock:
+            if prune:
+                self.records = dict((do_uri, entry) for do_uri, entry in self.records.items() if do_uri in self.seen or entry.get('resource') not in self.walked)
+            manifest = {'last_run': self.started, 'records': self.records}
+            if not advance and self.last_run is not None:
+                manifest['last_run'] = self.last_run
+            self.writeJson(self.path, manifest)
+        self.writeJson(self.index_path, self.getDependencyIndex())
+        logging.info('Saved export manifest with %s records, %s were unchanged and skipped' % (len(manifest['records']), self.skipped))
+
+    def writeJson(self, path, data):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(temp_path, path)
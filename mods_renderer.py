@@ -0,0 +1,48 @@
+"""Renders MODS records from a jinja template.
+
+A modsRenderer loads and compiles its template once and can then render any
+number of records, from any number of threads. Optionally the template is
+precompiled to Python modules in a directory with
+Environment.compile_templates and loaded from there with a ModuleLoader,
+which saves parsing the template at all on later runs. The compiled copy is
+rebuilt whenever the template is newer than it.
+
+    renderer = modsRenderer('compass-mods-template.xml')
+    xml = renderer.render(data)
+"""
+import jinja2
+import logging
+import os.path
+
+
+DEFAULT_TEMPLATE = 'compass-mods-template.xml'
+
+
+def compileTemplate(template_path, compiled_path):
+    ' Compiles the template at template_path to a Python module in the compiled_path directory '
+
+    searchpath, name = os.path.split(template_path)
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=searchpath or '.'))
+    logging.info('Compiling template %s to %s' % (template_path, compiled_path))
+    environment.compile_templates(compiled_path, zip=None, filter_func=lambda template_name: template_name == name, ignore_errors=False)
+
+
+class modsRenderer(object):
+    def __init__(self, template_path=DEFAULT_TEMPLATE, compiled_path=None):
+        searchpath, name = os.path.split(template_path)
+        if compiled_path is None:
+            loader = jinja2.FileSystemLoader(searchpath=searchpath or '.')
+        else:
+            compiled_file = os.path.join(compiled_path, jinja2.ModuleLoader.get_module_filename(name))
+            if not os.path.exists(compiled_file) or os.path.getmtime(compiled_file) < os.path.getmtime(template_path):
+                compileTemplate(template_path, compiled_path)
+            loader = jinja2.ModuleLoader(compiled_path)
+
+        self.template_path = template_path
+        self.environment = jinja2.Environment(loader=loader)
+        self.template = self.environment.get_template(name)
+
+    def render(self, data):
+        ' Merges the data for one record with the template '
+
+        return self.template.render(data)
@@ -0,0 +1,175 @@
+"""A small threaded pipeline for streaming records through a series of stages.
+
+Each stage runs on its own worker threads and is connected to the next by a
+bounded queue, so items flow through as soon as they are produced and memory
+stays flat however many items there are. A stage function takes one item (or,
+for stages with a batch_size, a list of items) and returns a list of items to
+pass on to the next stage, which may be empty.
+
+    export = pipeline.recordPipeline()
+    export.addStage('discover', getDigitalObjectRefs, workers=4)
+    export.addStage('write', writeFile)
+    export.run('walk', archival_object_uris)
+
+Progress and per-stage throughput are logged while the pipeline runs.
+"""
+import logging
+import queue
+import threading
+import time
+
+
+QUEUE_SIZE = 100
+
+# Seconds between progress reports
+REPORT_INTERVAL = 10
+
+# Marks the end of a stage's input
+DONE = object()
+
+
+class pipelineStage(object):
+    def __init__(self, name, func, workers=1, batch_size=None):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.batch_size = batch_size
+        self.items_in = 0
+        self.items_out = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def count(self, items_in, items_out, busy):
+        with self.lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy += busy
+
+
+class recordPipeline(object):
+    def __init__(self, queue_size=QUEUE_SIZE, report_interval=REPORT_INTERVAL):
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.stages = []
+        self.error = None
+        self.aborted = threading.Event()
+
+    def addStage(self, name, func, workers=1, batch_size=None):
+        self.stages.append(pipelineStage(name, func, workers, batch_size))
+
+    def put(self, q, item):
+        ' Waits for room in q, giving up if another stage has failed '
+
+        while not self.aborted.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.aborted.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def fail(self, name, error):
+        logging.error('Stage %s failed: %s' % (name, error))
+        if self.error is None:
+            self.error = error
+        self.aborted.set()
+
+    def runSource(self, stage, items, out_queue):
+        try:
+            for item in items:
+                stage.count(0, 1, 0)
+                if not self.put(out_queue, item):
+                    return
+        except BaseException as e:
+            self.fail(stage.name, e)
+        self.put(out_queue, DONE)
+
+    def runWorker(self, stage, in_queue, out_queue, finished):
+        try:
+            while True:
+                item = self.get(in_queue)
+                if item is DONE:
+                    # Let the other workers of this stage see the end of the input too
+                    self.put(in_queue, DONE)
+                    break
+
+                if stage.batch_size:
+                    batch = [item]
+                    while len(batch) < stage.batch_size:
+                        try:
+                            item = in_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is DONE:
+                            self.put(in_queue, DONE)
+                            break
+                        batch.append(item)
+                    item = batch
+
+                started = time.time()
+                results = stage.func(item)
+                if stage.batch_size:
+                    stage.count(len(item), len(results), time.time() - started)
+                else:
+                    stage.count(1, len(results), time.time() - started)
+                for result in results:
+                    if out_queue is not None and not self.put(out_queue, result):
+                        return
+        except BaseException as e:
+            self.fail(stage.name, e)
+        finally:
+            # The last worker of a stage to finish passes the end marker on
+            with finished['lock']:
+                finished['count'] += 1
+                last = finished['count'] == stage.workers
+            if last and out_queue is not None:
+                self.put(out_queue, DONE)
+
+    def run(self, source_name, items):
+        ' Feeds items through all the stages, returning when every stage has finished '
+
+        source = pipelineStage(source_name, None)
+        queues = [queue.Queue(self.queue_size) for stage in self.stages]
+        threads = [threading.Thread(target=self.runSource, args=(source, items, queues[0]), name=source_name, daemon=True)]
+        for position, stage in enumerate(self.stages):
+            if position + 1 < len(queues):
+                out_queue = queues[position + 1]
+            else:
+                out_queue = None
+            finished = {'lock': threading.Lock(), 'count': 0}
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self.runWorker, args=(stage, queues[position], out_queue, finished), name='%s-%s' % (stage.name, worker), daemon=True))
+
+        self.started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.report_interval)
+                if thread.is_alive():
+                    self.logProgress(source)
+
+        self.logProgress(source, final=True)
+        if self.error is not None:
+            raise self.error
+
+    def logProgress(self, source, final=False):
+        elapsed = max(time.time() - self.started, 0.001)
+        parts = ['%s %s (%.1f/s)' % (source.name, source.items_out, source.items_out / elapsed)]
+        for stage in self.stages:
+            parts.append('%s %s (%.1f/s)' % (stage.name, stage.items_in, stage.items_in / elapsed))
+        if final:
+            logging.info('Finished in %.1fs: %s' % (elapsed, ', '.join(parts)))
+            for stage in self.stages:
+                if stage.busy > 0:
+                    logging.info('Stage %s: %s in, %s out, %.2fs busy across %s workers (%.1f items/s per worker)' % (stage.name, stage.items_in, stage.items_out, stage.busy, stage.workers, stage.items_in / stage.busy))
+        else:
+            logging.info('Progress after %.0fs: %s' % (elapsed, ', '.join(parts)))
@@ -0,0 +1,285 @@
+"""Instrumentation for finding out where an export spends its time.
+
+An exportProfiler collects:
+
+- time spent in each pipeline stage (walk, discover, assemble, render, write)
+- time spent in each helper function, e.g. getAgents or getNotesTree, once
+  instrument() has swapped in timed versions of them
+- ArchivesSpace requests by URI pattern and by the helper or stage that made
+  them, with a latency histogram, from profiledClient wrappers around the
+  client
+- URIs looked up more than once while a single record was assembled
+
+Wrap the raw client to see the requests that reach ArchivesSpace and the
+record cache to see every lookup the code makes:
+
+    profiler = exportProfiler()
+    client = profiledClient(client, profiler, 'requests')
+    ...
+    aspace = profiledClient(aspaceRecordCache(client), profiler, 'lookups')
+
+printSummary() prints a table of the results. writeTrace() saves them as JSON
+along with a trace of every span and request, in the Trace Event Format that
+chrome://tracing and Perfetto can open.
+"""
+import collections
+import contextlib
+import functools
+import json
+import re
+import threading
+import time
+
+
+# Upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+BUCKET_LABELS = ['<=%sms' % bound for bound in LATENCY_BUCKETS] + ['>%sms' % LATENCY_BUCKETS[-1]]
+
+# Rows to print in each table of the summary
+SUMMARY_ROWS = 15
+
+# Records to keep as examples of repeated lookups
+DUPLICATE_EXAMPLES = 20
+
+
+def uriPattern(path):
+    ' Returns the pattern of a request path, e.g. /repositories/:id/archival_objects?id_set[] '
+
+    split = path.split('?', 1)
+    pattern = re.sub(r'/\d+(?=/|$)', '/:id', split[0])
+    if len(split) > 1:
+        names = sorted(set(pair.split('=')[0] for pair in split[1].split('&')))
+        pattern += '?' + '&'.join(names).replace('%5B%5D', '[]')
+    return pattern
+
+
+def getBucket(seconds):
+    milliseconds = seconds * 1000
+    for bound, label in zip(LATENCY_BUCKETS, BUCKET_LABELS):
+        if milliseconds <= bound:
+            return label
+    return BUCKET_LABELS[-1]
+
+
+class timing(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def asDict(self):
+        return {'count': self.count, 'total_seconds': round(self.total, 4), 'mean_ms': round(1000 * self.total / max(self.count, 1), 3), 'max_ms': round(1000 * self.max, 3)}
+
+
+class exportProfiler(object):
+    def __init__(self, trace=False):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = {'stage': collections.defaultdict(timing), 'helper': collections.defaultdict(timing)}
+        self.requests = {}
+        self.records = 0
+        self.duplicate_records = 0
+        self.duplicates = collections.Counter()
+        self.duplicate_examples = []
+        # Trace Event Format events, only kept if a trace is wanted
+        self.events = [] if trace else None
+        # (id of target, name) -> (target, name, original function) for restore()
+        self.instrumented = {}
+
+    def getStack(self):
+        ' The names of the stages and helpers this thread is in, innermost last '
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def addEvent(self, name, category, started, elapsed, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': threading.get_ident(),
+                 'ts': round((started - self.started) * 1e6), 'dur': round(elapsed * 1e6)}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, kind='helper'):
+        ' Times the with block as a stage or helper called name '
+
+        stack = self.getStack()
+        stack.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.pop()
+            with self.lock:
+                self.spans[kind][name].add(elapsed)
+                if self.events is not None:
+                    self.addEvent(name, kind, started, elapsed)
+
+    def timed(self, name, func, kind='helper'):
+        ' Returns a version of func that times every call '
+
+        @functools.wraps(func)
+        def timedFunc(*args, **kwargs):
+            with self.span(name, kind):
+                return func(*args, **kwargs)
+
+        return timedFunc
+
+    def timedItems(self, name, items, kind='stage'):
+        ' Yields items, timing the work of producing each one, e.g. a tree walk '
+
+        iterator = iter(items)
+        while True:
+            with self.span(name, kind):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def instrument(self, target, names, prefix=''):
+        ' Replaces the named functions of a module, or methods of an object, with timed versions '
+        ' Functions this profiler has already replaced are left alone, so calling it again does not time them twice '
+
+        for name in names:
+            key = (id(target), name)
+            if key in self.instrumented:
+                continue
+            original = getattr(target, name)
+            self.instrumented[key] = (target, name, original)
+            setattr(target, name, self.timed(prefix + name, original))
+
+    def restore(self):
+        ' Puts back the functions instrument() replaced '
+
+        for target, name, original in self.instrumented.values():
+            setattr(target, name, original)
+        self.instrumented.clear()
+
+    @contextlib.contextmanager
+    def record(self, key):
+        ' Watches the lookups made while one record is assembled for URIs looked up more than once '
+
+        self.local.lookups = collections.Counter()
+        try:
+            yield
+        finally:
+            lookups = self.local.lookups
+            self.local.lookups = None
+            repeated = [(uri, count) for uri, count in lookups.items() if count > 1]
+            with self.lock:
+                self.records += 1
+                if repeated:
+                    self.duplicate_records += 1
+                for uri, count in repeated:
+                    self.duplicates[uri] += count - 1
+                    if len(self.duplicate_examples) < DUPLICATE_EXAMPLES:
+                        self.duplicate_examples.append({'record': key, 'uri': uri, 'count': count})
+
+    def noteRequest(self, level, method, uri, seconds):
+        ' Counts a request made through a profiledClient '
+
+        stack = self.getStack()
+        caller = stack[-1] if stack else 'main'
+        lookups = getattr(self.local, 'lookups', None)
+        if lookups is not None and level == 'lookups':
+            lookups[uri] += 1
+
+        pattern = method + ' ' + uriPattern(uri)
+        with self.lock:
+            stats = self.requests.get(level)
+            if stats is None:
+                stats = self.requests[level] = {'patterns': collections.defaultdict(timing), 'callers': collections.Counter(), 'histogram': collections.Counter()}
+            stats['patterns'][pattern].add(seconds)
+            stats['callers'][caller] += 1
+            stats['histogram'][getBucket(seconds)] += 1
+            if self.events is not None:
+                self.addEvent(pattern, level, time.perf_counter() - seconds, seconds, {'uri': uri, 'caller': caller})
+
+    def getSummary(self):
+        with self.lock:
+            summary = {'wall_seconds': round(time.perf_counter() - self.started, 3)}
+            for kind, spans in self.spans.items():
+                summary[kind + 's'] = dict((name, stats.asDict()) for name, stats in sorted(spans.items(), key=lambda item: -item[1].total))
+            summary['requests'] = {}
+            for level, stats in self.requests.items():
+                summary['requests'][level] = {
+                    'total': sum(timed.count for timed in stats['patterns'].values()),
+                    'by_pattern': dict((pattern, timed.asDict()) for pattern, timed in sorted(stats['patterns'].items(), key=lambda item: -item[1].count)),
+                    'by_caller': dict(stats['callers'].most_common()),
+                    'latency_histogram': dict((bucket, stats['histogram'][bucket]) for bucket in BUCKET_LABELS if stats['histogram'][bucket]),
+                }
+            summary['repeated_lookups'] = {
+                'records': self.records,
+                'records_with_repeats': self.duplicate_records,
+                'extra_lookups_by_uri': dict(self.duplicates.most_common()),
+                'examples': list(self.duplicate_examples),
+            }
+        return summary
+
+    def printSummary(self):
+        summary = self.getSummary()
+        print('Profile of %.1fs export' % summary['wall_seconds'])
+
+        for kind in ('stages', 'helpers'):
+            print('\n%-45s %8s %10s %10s %10s' % (kind.capitalize(), 'calls', 'total s', 'mean ms', 'max ms'))
+            for name, stats in list(summary[kind].items())[:SUMMARY_ROWS]:
+                print('%-45s %8s %10.3f %10.3f %10.3f' % (name, stats['count'], stats['total_seconds'], stats['mean_ms'], stats['max_ms']))
+
+        for level, stats in summary['requests'].items():
+            print('\n%-60s %8s %10s %10s' % ('%s (%s) by URI pattern' % (level.capitalize(), stats['total']), 'count', 'total s', 'mean ms'))
+            for pattern, timed in list(stats['by_pattern'].items())[:SUMMARY_ROWS]:
+                print('%-60s %8s %10.3f %10.3f' % (pattern, timed['count'], timed['total_seconds'], timed['mean_ms']))
+            print('\n%-60s %8s' % ('%s by caller' % level.capitalize(), 'count'))
+            for caller, count in list(stats['by_caller'].items())[:SUMMARY_ROWS]:
+                print('%-60s %8s' % (caller, count))
+            print('\n%s latency: %s' % (level.capitalize(), ', '.join('%s %s' % (bucket, count) for bucket, count in stats['latency_histogram'].items())))
+
+        repeated = summary['repeated_lookups']
+        print('\n%s of %s records looked up the same URI more than once' % (repeated['records_with_repeats'], repeated['records']))
+        for uri, extra in list(repeated['extra_lookups_by_uri'].items())[:SUMMARY_ROWS]:
+            print('%-60s %8s extra' % (uri, extra))
+
+    def writeTrace(self, path):
+        ' Saves the summary and, if kept, every span and request as JSON '
+
+        trace = {'summary': self.getSummary(), 'displayTimeUnit': 'ms'}
+        with self.lock:
+            trace['traceEvents'] = list(self.events or [])
+        with open(path, 'w') as fh:
+            json.dump(trace, fh)
+
+
+class profiledClient(object):
+    ' Wraps an aspace client, or a cache in front of one, and reports every get and post to a profiler '
+
+    def __init__(self, aspace, profiler, level):
+        self.aspace = aspace
+        self.profiler = profiler
+        self.level = level
+
+    def get(self, uri, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.aspace.get(uri, *args, **kwargs)
+        finally:
+            self.profiler.noteRequest(self.level, 'GET', uri, time.perf_counter() - started)
+
+    def post(self, uri, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.aspace.post(uri, *args, **kwargs)
+        finally:
+            self.profiler.noteRequest(self.level, 'POST', uri, time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.aspace, name)
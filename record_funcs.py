@@ -4,15 +4,40 @@ from archivesspace import archivesspace
 import pprint
 import argparse
 import logging
+import threading
+import urllib.parse
+import authorities
+import worker_pool
 
 
-REPO_NUM = 2
+# Repository of resource ids given without one
+DEFAULT_REPO_NUM = 2
+
+# Number of records to ask for in one id_set request
+DEFAULT_BATCH_SIZE = 100
 
 logging.basicConfig(level=logging.INFO)
 
+
+class aspaceError(Exception):
+    pass
+
+
+def checkResponse(response, uri):
+    ' Returns response, raising aspaceError if ArchivesSpace sent back an error instead, e.g. for a missing record '
+
+    if isinstance(response, dict) and 'error' in response:
+        raise aspaceError('%s: %s' % (uri, response['error']))
+    return response
+
+
 class aspaceRecordFuncs(object):
     def __init__(self, aspace):
-        self.aspace = aspace
+        # Subjects and agents are only normalized once, as the client fetches them
+        self.aspace = authorities.normalizingClient(aspace)
+        # Archival Object URI -> URIs of its ancestors, worked out once per run
+        self.ancestor_uris = {}
+        self.lock = threading.Lock()
 
     def getModsFileName(self, digital_object):
         ' Returns file name in format islandora_NUMBER_MODS '
@@ -34,6 +59,7 @@ class aspaceRecordFuncs(object):
     def getSubjects(self, archival_object):
         ' Returns list of subjects for an Archival Object '
         ' Only looking at Archival Object level -- NOT getting them from the hierarchy because all YWCA AOs with Digital Objects have subjects at the AO level '
+        ' authority_ids are turned into URIs by the authorities.authorityNormalizer the client applies '
         
         logging.debug('Retrieving Subject list from %s' % archival_object['uri'])
         sub_list = []
@@ -43,46 +69,36 @@ class aspaceRecordFuncs(object):
             sub_rec = self.aspace.get(sub)
             sub_list.append(sub_rec)
 
-        for sub in sub_list:
-            if 'authority_id' in sub.keys():
-                if sub['source'] == 'lcsh':
-                    if 'loc.gov' not in sub['authority_id']:
-                        sub['authority_id'] = 'http://id.loc.gov/authorities/subjects/' + sub['authority_id']
-                elif sub['source'] == 'lcnaf':
-                    if 'loc.gov' not in sub['authority_id']:
-                        sub['authority_id'] = 'http://id.loc.gov/authorities/names/' + sub['authority_id']
-                elif sub['source'] == 'naf':
-                    if 'loc.gov' not in sub['authority_id']:
-                        sub['authority_id'] = 'http://id.loc.gov/authorities/names/' + sub['authority_id']
-                elif sub['source'] == 'tgn':
-                    if 'getty.edu' not in sub['authority_id']:
-                        sub['authority_id'] = 'http://vocab.getty.edu/tgn/' + sub['authority_id']
-                elif sub['source'] == 'aat':
-                    if 'getty.edu' not in sub['authority_id']:
-                        sub['authority_id'] = 'http://vocab.getty.edu/aat/' + sub['authority_id']
-                else:
-                    pass
-            else:
-                pass
-
         return sub_list
 
 
-    def getGenreSubjects(self, subjects, resource):
+    def getGenreSubjects(self, subjects, resource, resource_genre_subs=None):
+        ' Returns the genre subjects of an Archival Object, or failing that of its Resource '
+        ' Pass resource_genre_subs if the Resource\'s have already been worked out '
 
         genre_subs = []
         for subject in subjects:
             if subject['terms'][0]['term_type'] == 'genre_form':
                 genre_subs.append(subject)
 
+        if len(genre_subs) == 0:
+            if resource_genre_subs is None:
+                resource_genre_subs = self.getResourceGenreSubjects(resource)
+            genre_subs.extend(resource_genre_subs)
+
+        return genre_subs
+
+    def getResourceGenreSubjects(self, resource):
+        ' Returns the genre subjects of a Resource, which Archival Objects without any of their own fall back on '
+
+        genre_subs = []
         try:        
-            if len(genre_subs) == 0:
-                resource_subjects = self.getSubjects(resource)
-                for subject in resource_subjects:
-                    if subject['terms'][0]['term_type'] == 'genre_form':
-                        genre_subs.append(subject)
-                    else: 
-                        pass
+            resource_subjects = self.getSubjects(resource)
+            for subject in resource_subjects:
+                if subject['terms'][0]['term_type'] == 'genre_form':
+                    genre_subs.append(subject)
+                else: 
+                    pass
         except:
             pass
 
@@ -108,14 +124,13 @@ class aspaceRecordFuncs(object):
         return resource 
 
 
-    def getNotesByResource(self, resource):
-        ' Returns a list of tuples of all the notes from a Resource '
+    def getNoteTuples(self, record):
+        ' Returns a list of (type, content or subnotes) tuples for the notes of any record '
 
         note_tups = []
-        if 'notes' in resource.keys():
-            notes = resource['notes']
-            for note in notes:
-                logging.debug('Retrieving available notes from the Resource of %s' % resource['uri'])
+        if 'notes' in record.keys():
+            for note in record['notes']:
+                logging.debug('Retrieving available notes from %s' % record['uri'])
                 if 'content' in note.keys():
                     tup = (note['type'], note['content'])
                     note_tups.append(tup)
@@ -126,52 +141,71 @@ class aspaceRecordFuncs(object):
         return note_tups
 
 
-    def getNotesTree(self, archival_object):
+    def getNotesByResource(self, resource):
+        ' Returns a list of tuples of all the notes from a Resource '
+
+        return self.getNoteTuples(resource)
+
+
+    def getAncestorUris(self, archival_object):
+        ' Returns the URIs of the parent, grandparent etc. of an Archival Object, nearest first, not including the Resource '
+        ' Chains are remembered, so siblings and descendants only fetch ancestors nobody has asked about yet '
+
+        uri = archival_object['uri']
+        with self.lock:
+            if uri in self.ancestor_uris:
+                return list(self.ancestor_uris[uri])
+
+        chain = []
+        record = archival_object
+        while 'parent' in record.keys():
+            parent_uri = record['parent']['ref']
+            with self.lock:
+                known = self.ancestor_uris.get(parent_uri)
+            if known is not None:
+                chain.append(parent_uri)
+                chain.extend(known)
+                break
+            if parent_uri in chain or parent_uri == uri:
+                logging.error('Archival Object %s is its own ancestor, stopping at %s' % (uri, parent_uri))
+                break
+            chain.append(parent_uri)
+            record = self.aspace.get(parent_uri)
+
+        with self.lock:
+            self.ancestor_uris[uri] = chain
+            for position, ancestor_uri in enumerate(chain):
+                self.ancestor_uris.setdefault(ancestor_uri, chain[position + 1:])
+
+        return list(chain)
+
+
+    def getAncestors(self, archival_object, levels=None):
+        ' Returns the ancestor records of an Archival Object, nearest first, optionally only the nearest levels of them '
+
+        ancestor_uris = self.getAncestorUris(archival_object)
+        if levels is not None:
+            ancestor_uris = ancestor_uris[:levels]
+
+        return [self.aspace.get(ancestor_uri) for ancestor_uri in ancestor_uris]
+
+
+    def getNotesTree(self, archival_object, resource_notes=None):
         ' Returns a list of tuples of all the notes from an Archival Object heirarchy '
+        ' Notes come from the Archival Object, its parent and grandparent, then the Resource '
+        ' Pass resource_notes if the Resource\'s getNotesByResource tuples have already been worked out '
         
         logging.debug('Returning list of tuples of all notes from Archival Object %s heirarchy' % archival_object['uri'])
         note_tups = []
         if 'notes' in archival_object.keys():
-            notes = archival_object['notes']
-            for note in notes:
-                logging.debug('Retrieving available notes from %s' % archival_object['uri'])
-                if 'content' in note.keys():
-                    tup = (note['type'], note['content'])
-                    note_tups.append(tup)
-                else:
-                    tup = (note['type'], note['subnotes'])
-                    note_tups.append(tup)
+            note_tups.extend(self.getNoteTuples(archival_object))
 
-            if 'parent' in archival_object.keys():
-                parent = archival_object['parent']['ref']
-                parent_record = self.aspace.get(parent)
-                if 'notes' in parent_record.keys():
-                    notes = parent_record['notes']
-                    for note in notes:
-                        logging.debug('Retrieving available notes from parent of %s' % archival_object['uri'])
-                        if 'content' in note.keys():
-                            tup = (note['type'], note['content'])
-                            note_tups.append(tup)
-                        else:
-                            tup = (note['type'], note['subnotes'])
-                            note_tups.append(tup)
-
-                if 'parent' in parent_record.keys():
-                    grandparent = parent_record['parent']['ref']
-                    grandparent_record = self.aspace.get(grandparent)
-                    if 'notes' in grandparent_record.keys():
-                        notes = grandparent_record['notes']
-                        for note in notes:
-                            logging.debug('Retrieving available notes from grandparent of %s' % archival_object['uri'])
-                            if 'content' in note.keys():
-                                tup = (note['type'], note['content'])
-                                note_tups.append(tup)
-                            else:
-                                tup = (note['type'], note['subnotes']) 
-                                note_tups.append(tup)  
-
-            resource = self.getResource(archival_object)
-            resource_notes = self.getNotesByResource(resource)
+            for ancestor in self.getAncestors(archival_object, levels=2):
+                note_tups.extend(self.getNoteTuples(ancestor))
+
+            if resource_notes is None:
+                resource = self.getResource(archival_object)
+                resource_notes = self.getNotesByResource(resource)
             note_tups.extend(resource_notes)
 
         return note_tups
@@ -187,9 +221,12 @@ class aspaceRecordFuncs(object):
                 return note[1]
 
 
-    def getLangAtAOLevel(self, archival_object):
+    def getLangAtAOLevel(self, archival_object, note_tups=None):
+        ' Returns the languages from the nearest langmaterial note; pass the getNotesTree tuples if you already have them '
+
         obj_langs = []
-        note_tups = self.getNotesTree(archival_object)
+        if note_tups is None:
+            note_tups = self.getNotesTree(archival_object)
         lang_notes = self.getNotesByType(note_tups, 'langmaterial')
         try:
             for lang in lang_notes:
@@ -206,101 +243,227 @@ class aspaceRecordFuncs(object):
         return obj_langs
 
 
-    def getSeries(self, resource_num, repo_num):
-        ' Returns first level down children of given resource '
+    def getTreeChildren(self, tree_uri, node_uri, node):
+        ' Yields the children of a tree node a waypoint (page) at a time '
+        ' node is the tree/root or tree/node response for node_uri, which carries the first waypoint precomputed '
 
-        logging.debug('Retrieving Series level children of Resource %s' % resource_num)
-        resource_num = str(resource_num)
-        series_lst = []
+        precomputed = node.get('precomputed_waypoints', {}).get(node_uri or '', {})
+        for waypoint in range(node.get('waypoints', 0)):
+            if str(waypoint) in precomputed:
+                children = precomputed[str(waypoint)]
+            else:
+                query = {'offset': waypoint}
+                if node_uri:
+                    query['parent_node'] = node_uri
+                logging.debug('Retrieving waypoint %s of %s' % (waypoint, node_uri or tree_uri))
+                waypoint_uri = tree_uri + '/waypoint?' + urllib.parse.urlencode(query)
+                children = checkResponse(self.aspace.get(waypoint_uri), waypoint_uri)
+            for child in children:
+                yield child
+
+
+    def walkResourceTree(self, resource_num, repo_num=DEFAULT_REPO_NUM):
+        ' Yields a (URI, has digital object) pair for each Archival Object in a resource, parents before their children '
+        ' has digital object is None when the tree does not say whether the node has a digital object instance '
+
+        logging.debug('Walking the tree of Resource %s' % resource_num)
+        tree_uri = '/repositories/' + str(repo_num) + '/resources/' + str(resource_num) + '/tree'
+        # A missing resource, or one we may not see, is an error rather than an empty tree
+        root = checkResponse(self.aspace.get(tree_uri + '/root'), tree_uri + '/root')
+
+        # One generator of children per level being walked, so there's no depth limit
+        stack = [self.getTreeChildren(tree_uri, None, root)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+
+            yield child['uri'], child.get('has_digital_instance')
+
+            if child.get('child_count', 0) > 0:
+                node_uri = tree_uri + '/node?' + urllib.parse.urlencode({'node_uri': child['uri']})
+                node = checkResponse(self.aspace.get(node_uri), node_uri)
+                stack.append(self.getTreeChildren(tree_uri, child['uri'], node))
+
+
+    def getAllResourceUris(self, resource_num, digital_only=False, repo_num=DEFAULT_REPO_NUM):
+        ' Returns all the Archival Object URIs for a resource '
+        ' With digital_only, leaves out the ones the tree says have no Digital Object instance '
+
+        logging.info('Walking the tree of Resource %s for Archival Object URIs' % resource_num)
+        uri_lst = []
+        for uri, has_digital_instance in self.walkResourceTree(resource_num, repo_num):
+            if digital_only and has_digital_instance is False:
+                continue
+            uri_lst.append(uri)
 
-        record = self.aspace.get('/repositories/'+ str(repo_num) +'/resources/' + resource_num + '/tree')
+        return uri_lst
 
-        if record['children']:
-            for child in record['children']:
-                logging.debug('Adding each first level child of Resource %s to a list' % resource_num)
-                series_lst.append(child)
 
-        return series_lst
+    def getDigitalObjectUris(self, ao_uri_list, workers=1, batch_size=None):
+        ' Returns list of Digital Object uris; with workers > 1 the Archival Objects are fetched concurrently '
+        ' With a batch_size the Archival Objects are fetched batch_size at a time with id_set '
 
+        logging.info('Retrieving Digital Object URIs from list of Archival Object URIs')
+        do_list = []
 
-    def getSeriesUri(self, series):
-        return series['record_uri']
+        if len(ao_uri_list) > 0:
+            for archival_object in self.getRecords(ao_uri_list, workers, batch_size):
+                if 'instances' in archival_object.keys():
+                    do_list.extend(self.getDigitalObjectRefs(archival_object))
+                else:
+                    exit(1)
 
+        else:
+            exit(1)
 
-    def getChildUri(self, child):
-        logging.debug('Returning URI for Archival Object %s' % child['record_uri'])
-        return child['record_uri']
+        return do_list
 
 
-    def getChildUris(self, series):  # Could probably be reworked
-        ' Returns list of child URIs for the child of a parent resource '
-        ' Assumes searching through a single series in a record group '
+    def getRepositoryNums(self):
+        ' Returns the number of every repository '
 
-        logging.debug('Retrieving URIs for each child of Series %s passed' % series)
-        child_uris = []  # Starting list to append to
-        children = series['children']  # Children of the series, which is itself the child of a record group
+        return [int(repository['uri'].rsplit('/', 1)[1]) for repository in self.aspace.get('/repositories')]
 
-        child_uris.append(self.getSeriesUri(series))
 
-        for child in children:
-            child_uris.append(self.getChildUri(child))
-            if child['children']:
-                for child in child['children']:
-                    child_uris.append(self.getChildUri(child))
-                    if child['children']:
-                        for child in child['children']:
-                            child_uris.append(self.getChildUri(child))
-                            if child['children']:
-                                for child in child['children']:
-                                    child_uris.append(self.getChildUri(child))
-                                    if child['children']:
-                                        for child in child['children']:
-                                            child_uris.append(self.getChildUri(child))
-                                            if child['children']:
-                                                for child in child['children']:
-                                                    child_uris.append(self.getChildUri(child))
-                                                    if child['children']:
-                                                        for child in child['children']:
-                                                            child_uris.append(self.getChildUri(child))
+    def iterResourcesWithDigitalObjects(self, repo_num=DEFAULT_REPO_NUM, workers=1, batch_size=DEFAULT_BATCH_SIZE):
+        ' Yields the number of each resource in a repository with Digital Objects linked from it or its Archival Objects, as soon as it is found '
+        ' The Digital Objects are read a window at a time, so exporting the first resources can start before the whole repository is scanned '
 
+        logging.info('Finding the resources in repository %s with Digital Objects' % repo_num)
+        endpoint = '/repositories/%s/digital_objects' % repo_num
+        do_uris = ['%s/%s' % (endpoint, do_id) for do_id in self.aspace.get(endpoint + '?all_ids=true')]
+        window = max(batch_size or 1, 1) * max(workers, 1)
 
-        return child_uris
+        seen_resources = set()
+        seen_aos = set()
+        for start in range(0, len(do_uris), window):
+            resource_uris = []
+            # Kept in the order they were found, so the Archival Objects are fetched in that order
+            ao_uris = {}
+            for digital_object in self.getRecords(do_uris[start:start + window], workers, batch_size):
+                for instance in digital_object.get('linked_instances', []):
+                    if '/resources/' in instance['ref']:
+                        resource_uris.append(instance['ref'])
+                    elif instance['ref'] not in seen_aos:
+                        seen_aos.add(instance['ref'])
+                        ao_uris[instance['ref']] = None
+            for archival_object in self.getRecords(list(ao_uris), workers, batch_size):
+                if 'resource' in archival_object:
+                    resource_uris.append(archival_object['resource']['ref'])
+            for uri in resource_uris:
+                if uri not in seen_resources:
+                    seen_resources.add(uri)
+                    yield int(uri.rsplit('/', 1)[1])
 
 
-    def getAllResourceUris(self, resource_num):
-        ' Calls getSeries and getChildUris to return all the Archival Object URIs for a resource '
-        
-        logging.info('Calling getSeries and getChildUris for Resource %s' % resource_num)
-        hierarchy = self.getSeries(resource_num, REPO_NUM)
-        uri_lst = []
-        for level in hierarchy:
-            logging.info('Adding all Archival Object URIs for Resource to list')
-            uri_lst.extend(self.getChildUris(level))
+    def getDigitalObjectRefs(self, archival_object):
+        ' Returns the URIs of the Digital Objects attached to an Archival Object as instances '
 
-        return uri_lst
+        logging.debug('Checking if Archival Object %s has Digital Object instance' % archival_object['uri'])
+        do_list = []
+        for instance in archival_object.get('instances', []):
+            if 'digital_object' in instance.keys():
+                do_list.append(instance['digital_object']['ref'])
 
+        return do_list
 
-    def getDigitalObjectUris(self, ao_uri_list):
-        ' Returns list of Digital Object uris '
 
-        logging.info('Retrieving Digital Object URIs from list of Archival Object URIs')
-        do_list = []
+    def getRecords(self, uris, workers=1, batch_size=None):
+        ' Yields the record for each URI in order, prefetching them in batches first if batch_size is given '
 
-        if len(ao_uri_list) > 0:
-            for uri in ao_uri_list:
-                logging.debug('Checking if Archival Object %s has Digital Object instance' % uri)
-                archival_object = self.aspace.get(uri)
-                if 'instances' in archival_object.keys():
-                    for instance in archival_object['instances']:
-                        if 'digital_object' in instance.keys():
-                            do_list.append(instance['digital_object']['ref'])
-                else:
-                    exit(1)
+        if not batch_size:
+            for record in worker_pool.mapInOrder(self.aspace.get, uris, workers):
+                yield record
+            return
 
-        else:
-            exit(1)
+        window = batch_size * max(workers, 1)
+        for start in range(0, len(uris), window):
+            chunk = uris[start:start + window]
+            self.prefetchRecords(chunk, batch_size, workers)
+            for record in worker_pool.mapInOrder(self.aspace.get, chunk, workers):
+                yield record
 
-        return do_list
+
+    def groupIdsByEndpoint(self, uris):
+        ' Returns a dictionary of list endpoint to record ids e.g. /subjects/1 and /subjects/2 give {"/subjects": ["1", "2"]} '
+
+        endpoints = {}
+        for uri in uris:
+            endpoint, record_id = uri.rsplit('/', 1)
+            if record_id.isdigit():
+                ids = endpoints.setdefault(endpoint, [])
+                if record_id not in ids:
+                    ids.append(record_id)
+
+        return endpoints
+
+
+    def getBatch(self, batch):
+        ' Returns the list of records for an (endpoint, ids) pair in one id_set request '
+
+        endpoint, ids = batch
+        query = urllib.parse.urlencode([('id_set[]', record_id) for record_id in ids])
+        logging.debug('Retrieving %s records from %s in one request' % (len(ids), endpoint))
+        records = self.aspace.get(endpoint + '?' + query)
+        if not isinstance(records, list):
+            logging.warning('Could not retrieve a batch of records from %s, they will be retrieved one by one: %s' % (endpoint, records))
+            return []
+
+        return records
+
+
+    def prefetchRecords(self, uris, batch_size=DEFAULT_BATCH_SIZE, workers=1):
+        ' Retrieves the uncached records in uris batch_size at a time and primes the record cache with them '
+        ' Later aspace.get calls for those URIs are answered by the cache. Does nothing without a cache '
+
+        if not hasattr(self.aspace, 'prime'):
+            return 0
+
+        uncached = [uri for uri in uris if not self.aspace.isCached(uri)]
+        batches = []
+        for endpoint, ids in self.groupIdsByEndpoint(uncached).items():
+            for start in range(0, len(ids), batch_size):
+                batches.append((endpoint, ids[start:start + batch_size]))
+
+        count = 0
+        for records in worker_pool.mapInOrder(self.getBatch, batches, workers):
+            for record in records:
+                self.aspace.prime(record['uri'], record)
+                count += 1
+
+        logging.debug('Prefetched %s records in %s requests' % (count, len(batches)))
+        return count
+
+
+    def getLinkedUris(self, record):
+        ' Returns the URIs of the subjects, agents, top containers and parent linked from a record '
+
+        uris = []
+        for subject in record.get('subjects', []):
+            uris.append(subject['ref'])
+        for agent in record.get('linked_agents', []):
+            uris.append(agent['ref'])
+        for instance in record.get('instances', []):
+            try:
+                uris.append(instance['sub_container']['top_container']['ref'])
+            except KeyError:
+                pass
+        if 'parent' in record:
+            uris.append(record['parent']['ref'])
+
+        return uris
+
+
+    def prefetchLinkedRecords(self, records, batch_size=DEFAULT_BATCH_SIZE, workers=1):
+        ' Prefetches everything linked from a group of records in as few requests as possible '
+
+        uris = []
+        for record in records:
+            uris.extend(self.getLinkedUris(record))
+
+        return self.prefetchRecords(uris, batch_size, workers)
 
 
     def getSlice(self, a_list, num=5):  
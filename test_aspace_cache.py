@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import aspace_cache
+import fake_aspace
+
+
+SUBJECT = '/subjects/1'
+
+
+class aspaceRecordCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=2, subjects=10, agents=4)
+
+    def test_repeat_gets_are_answered_from_memory(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        first = cache.get(SUBJECT)
+        second = cache.get(SUBJECT)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.fake.requests[SUBJECT], 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_records_are_handed_out_as_copies(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        cache.get(SUBJECT)['title'] = 'Changed by a caller'
+
+        self.assertEqual(cache.get(SUBJECT)['title'], 'Subject 1')
+
+    def test_least_recently_used_record_is_evicted(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake, maxsize=2)
+        cache.get('/subjects/1')
+        cache.get('/subjects/2')
+        # Using subject 1 again leaves subject 2 as the least recently used
+        cache.get('/subjects/1')
+        cache.get('/subjects/3')
+
+        self.assertEqual(list(cache.records), ['/subjects/1', '/subjects/3'])
+        self.assertEqual(cache.evictions, 1)
+        cache.get('/subjects/2')
+        self.assertEqual(self.fake.requests['/subjects/2'], 2)
+
+    def test_requests_with_parameters_are_not_cached(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        cache.get('/subjects?all_ids=true')
+        cache.get('/subjects?all_ids=true')
+
+        self.assertEqual(self.fake.requests['/subjects?all_ids=true'], 2)
+        self.assertEqual(len(cache.records), 0)
+
+    def test_concurrent_gets_of_one_uri_fetch_it_once(self):
+        self.fake.latency = 0.05
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        results = []
+
+        def get():
+            results.append(cache.get(SUBJECT))
+
+        threads = [threading.Thread(target=get) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fake.requests[SUBJECT], 1)
+        self.assertEqual(len(results), 8)
+        self.assertEqual(cache.pending, {})
+
+    def test_failed_fetch_releases_waiting_threads(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        with mock.patch.object(self.fake, 'get', side_effect=IOError('connection reset')):
+            with self.assertRaises(IOError):
+                cache.get(SUBJECT)
+
+        self.assertEqual(cache.pending, {})
+        self.assertEqual(cache.get(SUBJECT)['title'], 'Subject 1')
+
+    def test_error_responses_are_not_cached(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+
+        self.assertIn('error', cache.get('/subjects/9999'))
+        self.assertNotIn('/subjects/9999', cache.records)
+        self.fake.add({'uri': '/subjects/9999', 'jsonmodel_type': 'subject', 'title': 'Subject 9999'})
+        self.assertEqual(cache.get('/subjects/9999')['title'], 'Subject 9999')
+
+    def test_transform_is_applied_once_as_records_enter(self):
+        calls = []
+
+        def transform(record):
+            calls.append(record['uri'])
+            record['title'] = record['title'].upper()
+            return record
+
+        cache = aspace_cache.aspaceRecordCache(self.fake, transform=transform)
+        cache.get(SUBJECT)
+
+        self.assertEqual(cache.get(SUBJECT)['title'], 'SUBJECT 1')
+        self.assertEqual(calls, [SUBJECT])
+
+    def test_post_drops_the_cached_record(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        record = cache.get(SUBJECT)
+        record['title'] = 'Renamed'
+        cache.post(SUBJECT, record)
+
+        self.assertEqual(cache.get(SUBJECT)['title'], 'Renamed')
+
+    def test_track_reads_collects_versions(self):
+        cache = aspace_cache.aspaceRecordCache(self.fake)
+        cache.get('/subjects/2')
+        with cache.trackReads() as inputs:
+            cache.get(SUBJECT)
+            cache.get('/subjects/2')
+
+        self.assertEqual(inputs, {SUBJECT: [0, '2019-01-01T00:00:00Z'], '/subjects/2': [0, '2019-01-01T00:00:00Z']})
+
+
+class aspacePersistentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=2, subjects=10, agents=4)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'aspace-cache.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_export(self, uris, **kwargs):
+        cache = aspace_cache.aspacePersistentCache(self.fake, self.path, **kwargs)
+        records = dict((uri, cache.get(uri)) for uri in uris)
+        cache.close()
+        return cache, records
+
+    def isStored(self, uri):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute('SELECT 1 FROM records WHERE uri = ?', (uri,)).fetchone() is not None
+        finally:
+            db.close()
+
+    def test_records_are_kept_between_runs(self):
+        self.run_export([SUBJECT, '/agents/people/1'])
+        cache, records = self.run_export([SUBJECT, '/agents/people/1'])
+
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        self.assertEqual(self.fake.requests[SUBJECT], 1)
+        self.assertEqual(records[SUBJECT]['title'], 'Subject 1')
+
+    def test_only_records_modified_since_the_last_run_are_refetched(self):
+        self.run_export([SUBJECT, '/subjects/2'])
+        self.fake.records[SUBJECT]['title'] = 'Retitled'
+        self.fake.touch(SUBJECT)
+        cache, records = self.run_export([SUBJECT, '/subjects/2'])
+
+        self.assertEqual(records[SUBJECT]['title'], 'Retitled')
+        self.assertEqual(self.fake.requests[SUBJECT], 2)
+        self.assertEqual(self.fake.requests['/subjects/2'], 1)
+
+    def test_everything_from_an_endpoint_is_dropped_if_it_cannot_be_checked(self):
+        self.run_export([SUBJECT, '/agents/people/1'])
+        get = self.fake.get
+
+        def unreachable_subjects(uri, *args, **kwargs):
+            if uri.startswith('/subjects?'):
+                raise IOError('connection reset')
+            return get(uri, *args, **kwargs)
+
+        with mock.patch.object(self.fake, 'get', side_effect=unreachable_subjects):
+            aspace_cache.aspacePersistentCache(self.fake, self.path).close()
+
+        self.assertFalse(self.isStored(SUBJECT))
+        self.assertTrue(self.isStored('/agents/people/1'))
+
+    def test_records_older_than_max_age_are_refetched(self):
+        self.run_export([SUBJECT])
+        with mock.patch('time.time', return_value=time.time() + 60):
+            cache, records = self.run_export([SUBJECT], max_age=30)
+
+        self.assertEqual((cache.expired, self.fake.requests[SUBJECT]), (1, 2))
+
+    def test_a_cache_from_another_server_is_purged(self):
+        self.run_export([SUBJECT], server='https://archivesspace-test.example.edu:8089')
+        cache, records = self.run_export([SUBJECT], server='https://archivesspace.example.edu:8089')
+
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        cache, records = self.run_export([SUBJECT], server='https://archivesspace.example.edu:8089')
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_a_cache_from_an_unknown_server_is_purged(self):
+        self.run_export([SUBJECT])
+        self.run_export([], server='https://archivesspace.example.edu:8089')
+
+        self.assertFalse(self.isStored(SUBJECT))
+
+    def test_server_name_comes_from_the_config(self):
+        config = os.path.join(self.directory.name, 'archivesspace.cfg')
+        with open(config, 'w') as fh:
+            fh.write('[DEFAULT]\nprotocol=http\nhostname=localhost\nport=8089\n\n[production]\nprotocol=https\nhostname=archivesspace.example.edu\n')
+
+        self.assertEqual(aspace_cache.getServerName(config, 'DEFAULT'), 'http://localhost:8089')
+        self.assertEqual(aspace_cache.getServerName(config, 'production'), 'https://archivesspace.example.edu:8089')
+        self.assertEqual(aspace_cache.getServerName(config, 'missing'), 'missing')
+        self.assertEqual(aspace_cache.getServerName(os.path.join(self.directory.name, 'none.cfg'), 'production'), 'production')
+
+    def test_unversioned_responses_are_not_stored(self):
+        self.run_export([fake_aspace.REPO_URI + '/resources/1/tree/root', '/subjects/999'])
+
+        self.assertFalse(self.isStored(fake_aspace.REPO_URI + '/resources/1/tree/root'))
+        self.assertFalse(self.isStored('/subjects/999'))
+
+
+if __name__ == '__main__':
+    unittest.main()
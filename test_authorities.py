@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import aspace_cache
+import authorities
+import fake_aspace
+
+
+class authorityNormalizerTest(unittest.TestCase):
+    def setUp(self):
+        self.normalizer = authorities.authorityNormalizer()
+
+    def test_known_sources_get_their_prefix(self):
+        self.assertEqual(self.normalizer.normalize('lcsh', 'sh85061212'), 'http://id.loc.gov/authorities/subjects/sh85061212')
+        self.assertEqual(self.normalizer.normalize('naf', 'n79021164'), 'http://id.loc.gov/authorities/names/n79021164')
+
+    def test_uris_and_unknown_sources_are_left_alone(self):
+        uri = 'http://id.loc.gov/authorities/subjects/sh85061212'
+
+        self.assertEqual(self.normalizer.normalize('lcsh', uri), uri)
+        self.assertEqual(self.normalizer.normalize('local', 'ssc-001'), 'ssc-001')
+
+    def test_prefixes_without_a_hostname(self):
+        normalizer = authorities.authorityNormalizer({'lcsh': 'info:lc/authorities/subjects/'})
+
+        self.assertEqual(normalizer.normalize('lcsh', 'sh85061212'), 'info:lc/authorities/subjects/sh85061212')
+        self.assertEqual(normalizer.normalize('lcsh', 'info:lc/authorities/subjects/sh1'), 'info:lc/authorities/subjects/sh1')
+
+    def test_each_pair_is_worked_out_once(self):
+        self.normalizer.normalize('aat', '300026096')
+        self.normalizer.prefixes['aat'] = 'http://example.edu/aat/'
+
+        self.assertEqual(self.normalizer.normalize('aat', '300026096'), 'http://vocab.getty.edu/aat/300026096')
+
+    def test_subject_and_agent_records_are_normalized(self):
+        subject = {'jsonmodel_type': 'subject', 'source': 'tgn', 'authority_id': '7013445'}
+        agent = {'jsonmodel_type': 'agent_person', 'display_name': {'source': 'lcnaf', 'authority_id': 'n50034328'}}
+        archival_object = {'jsonmodel_type': 'archival_object', 'source': 'lcsh', 'authority_id': 'sh1'}
+
+        self.assertEqual(self.normalizer.normalizeRecord(subject)['authority_id'], 'http://vocab.getty.edu/tgn/7013445')
+        self.assertEqual(self.normalizer.normalizeRecord(agent)['display_name']['authority_id'], 'http://id.loc.gov/authorities/names/n50034328')
+        self.assertEqual(self.normalizer.normalizeRecord(archival_object)['authority_id'], 'sh1')
+        self.assertEqual(self.normalizer.normalizeRecord({'error': 'Record not found'}), {'error': 'Record not found'})
+        self.assertEqual(self.normalizer.normalizeRecord([1, 2]), [1, 2])
+
+    def test_records_are_normalized_as_they_enter_the_cache(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=1, digital_objects=0, subjects=50, agents=10)
+        cache = aspace_cache.aspaceRecordCache(fake, transform=self.normalizer.normalizeRecord)
+
+        for uri in fake.subject_uris + fake.agent_uris:
+            original = fake.records[uri] if uri in fake.subject_uris else fake.records[uri]['display_name']
+            record = cache.get(uri)
+            authority = record if uri in fake.subject_uris else record['display_name']
+            prefix = authorities.DEFAULT_PREFIXES.get(original['source'], '')
+            self.assertEqual(authority['authority_id'], prefix + original['authority_id'])
+        # The fake's own records are untouched
+        self.assertFalse(fake.records[fake.subject_uris[0]]['authority_id'].startswith('http'))
+
+
+class normalizingClientTest(unittest.TestCase):
+    def test_a_plain_client_gets_the_default_normalizer(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=1, digital_objects=0, subjects=10, agents=2)
+        fake.records['/subjects/1'].update({'source': 'lcsh', 'authority_id': 'sh85061212'})
+        client = authorities.normalizingClient(fake)
+
+        self.assertEqual(client.get('/subjects/1')['authority_id'], 'http://id.loc.gov/authorities/subjects/sh85061212')
+
+    def test_a_normalizing_client_is_left_alone(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=1, digital_objects=0)
+        cache = aspace_cache.aspaceRecordCache(fake, transform=authorities.authorityNormalizer().normalizeRecord)
+
+        self.assertIs(authorities.normalizingClient(cache), cache)
+
+
+class loadPrefixesTest(unittest.TestCase):
+    def loadConfig(self, text):
+        with tempfile.NamedTemporaryFile('w', suffix='.cfg', delete=False) as fh:
+            fh.write(text)
+        self.addCleanup(os.remove, fh.name)
+        return authorities.loadPrefixes(fh.name)
+
+    def test_config_extends_and_overrides_the_defaults(self):
+        prefixes = self.loadConfig('[DEFAULT]\nhost = localhost\n\n[authority_prefixes]\nfast = http://id.worldcat.org/fast/\nlcsh = https://id.loc.gov/authorities/subjects/\n')
+
+        self.assertEqual(prefixes['fast'], 'http://id.worldcat.org/fast/')
+        self.assertEqual(prefixes['lcsh'], 'https://id.loc.gov/authorities/subjects/')
+        self.assertEqual(prefixes['aat'], authorities.DEFAULT_PREFIXES['aat'])
+        self.assertNotIn('host', prefixes)
+
+    def test_defaults_are_used_without_the_section(self):
+        self.assertEqual(self.loadConfig('[DEFAULT]\nhost = localhost\n'), authorities.DEFAULT_PREFIXES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import check_asis_mods_diff
+import datastream_manifest
+import fake_fedora
+
+
+MODS = b'<mods xmlns="http://www.loc.gov/mods/v3"><titleInfo><title>Sophia Smith</title></titleInfo></mods>'
+RETITLED = b'<mods xmlns="http://www.loc.gov/mods/v3"><titleInfo><title>Sophia Smith papers</title></titleInfo></mods>'
+
+
+class differsFromIngestedTest(unittest.TestCase):
+    def setUp(self):
+        self.session = fake_fedora.fakeFedoraSession()
+        self.session.ingest('smith:1', MODS)
+        self.datastream = check_asis_mods_diff.datastreamInfo('smith_1_MODS.xml')
+
+    def differs(self, contents, datastream=None):
+        return check_asis_mods_diff.differsFromIngested(self.session, datastream or self.datastream, contents, fake_fedora.FEDORA_CONFIG)
+
+    def test_matching_record(self):
+        self.assertFalse(self.differs(MODS))
+
+    def test_changed_record(self):
+        self.assertTrue(self.differs(RETITLED))
+
+    def test_record_that_is_not_ingested(self):
+        self.assertTrue(self.differs(MODS, check_asis_mods_diff.datastreamInfo('smith_2_MODS.xml')))
+
+    def test_bad_credentials_raise(self):
+        self.session.status = 401
+
+        with self.assertRaisesRegex(check_asis_mods_diff.fetchFailed, '401'):
+            self.differs(MODS)
+
+    def test_server_errors_raise(self):
+        self.session.status = 503
+
+        with self.assertRaises(check_asis_mods_diff.fetchFailed):
+            self.differs(MODS)
+
+    def test_timeouts_raise(self):
+        self.session.error = requests.Timeout('read timed out')
+
+        with self.assertRaisesRegex(check_asis_mods_diff.fetchFailed, 'read timed out'):
+            self.differs(MODS)
+
+
+class checkDatastreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = fake_fedora.fakeFedoraSession()
+        self.directory = tempfile.TemporaryDirectory()
+        self.manifest_path = os.path.join(self.directory.name, datastream_manifest.manifestFilename('test'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeLocal(self, number, contents, mtime=1000000000):
+        ' Writes the local file for smith:number, with a given mtime so changes show up however fast the test runs '
+
+        path = os.path.join(self.directory.name, 'smith_%s_MODS.xml' % number)
+        with open(path, 'wb') as fh:
+            fh.write(contents)
+        os.utime(path, (mtime, mtime))
+        return check_asis_mods_diff.datastreamInfo(path)
+
+    def contentRequests(self):
+        return sum(count for url, count in self.session.requests.items() if url.endswith('/content'))
+
+    def check(self, datastream, detailed=True):
+        ' One run of check_asis_mods_diff.py over a single datastream, with the manifest '
+
+        manifest = datastream_manifest.datastreamManifest(self.manifest_path)
+        pid, differs = check_asis_mods_diff.checkDatastream(self.session, datastream, fake_fedora.FEDORA_CONFIG, detailed=detailed, manifest=manifest)
+        manifest.save()
+        return differs, manifest
+
+
+class checkDatastreamTest(checkDatastreamTestCase):
+    def test_without_a_manifest_both_sides_are_compared(self):
+        self.session.ingest('smith:1', MODS)
+        datastream = self.writeLocal(1, RETITLED)
+
+        self.assertEqual(check_asis_mods_diff.checkDatastream(self.session, datastream, fake_fedora.FEDORA_CONFIG), ('smith:1', True))
+        self.assertEqual(self.contentRequests(), 1)
+
+    def test_a_datastream_that_cannot_be_fetched_is_not_compared(self):
+        datastream = self.writeLocal(1, MODS)
+
+        self.assertEqual(check_asis_mods_diff.checkDatastream(self.session, datastream, fake_fedora.FEDORA_CONFIG), ('smith:1', None))
+
+    def test_unchanged_on_both_sides_reuses_the_last_result(self):
+        self.session.ingest('smith:1', MODS)
+        datastream = self.writeLocal(1, RETITLED)
+        self.assertTrue(self.check(datastream)[0])
+
+        differs, manifest = self.check(datastream)
+        self.assertTrue(differs)
+        self.assertEqual(manifest.skipped, 1)
+        # Only the datastream profile was asked for the second time
+        self.assertEqual(self.contentRequests(), 1)
+
+    def test_a_local_file_that_now_matches_is_found_by_its_hash(self):
+        self.session.ingest('smith:1', MODS)
+        self.assertTrue(self.check(self.writeLocal(1, RETITLED))[0])
+
+        differs, manifest = self.check(self.writeLocal(1, MODS, mtime=1000000100))
+        self.assertFalse(differs)
+        self.assertEqual(self.contentRequests(), 1)
+        self.assertFalse(manifest.entries['smith:1/MODS']['differs'])
+
+    def test_a_changed_local_file_is_compared_again(self):
+        self.session.ingest('smith:1', MODS)
+        self.assertFalse(self.check(self.writeLocal(1, MODS))[0])
+
+        self.assertTrue(self.check(self.writeLocal(1, RETITLED, mtime=1000000100))[0])
+        self.assertEqual(self.contentRequests(), 2)
+
+    def test_a_reingested_datastream_is_fetched_again(self):
+        self.session.ingest('smith:1', MODS)
+        datastream = self.writeLocal(1, MODS)
+        self.assertFalse(self.check(datastream)[0])
+
+        self.session.ingest('smith:1', RETITLED)
+        self.assertTrue(self.check(datastream)[0])
+        self.assertEqual(self.contentRequests(), 2)
+
+    def test_a_missing_profile_means_fetching_the_datastream(self):
+        self.session.ingest('smith:1', MODS)
+        datastream = self.writeLocal(1, MODS)
+        self.check(datastream)
+        get = self.session.get
+
+        def no_profiles(url, auth=None, timeout=None):
+            if not url.endswith('/content'):
+                return fake_fedora.fakeResponse(500)
+            return get(url, auth, timeout)
+
+        with mock.patch.object(self.session, 'get', side_effect=no_profiles):
+            self.assertFalse(self.check(datastream)[0])
+        self.assertEqual(self.contentRequests(), 2)
+
+    def test_a_quick_difference_is_not_reused_for_a_detailed_run(self):
+        self.session.ingest('smith:1', MODS)
+        datastream = self.writeLocal(1, RETITLED)
+        self.assertTrue(self.check(datastream, detailed=False)[0])
+
+        differs, manifest = self.check(datastream, detailed=True)
+        self.assertTrue(differs)
+        self.assertEqual(manifest.skipped, 0)
+        self.assertEqual(self.contentRequests(), 2)
+        self.assertTrue(manifest.entries['smith:1/MODS']['detailed'])
+
+    def test_a_match_is_reused_whichever_kind_of_run_found_it(self):
+        self.session.ingest('smith:1', MODS)
+        datastream = self.writeLocal(1, MODS)
+        self.assertFalse(self.check(datastream, detailed=False)[0])
+
+        differs, manifest = self.check(datastream, detailed=True)
+        self.assertFalse(differs)
+        self.assertEqual(manifest.skipped, 1)
+        self.assertEqual(self.contentRequests(), 1)
+
+
+class datastreamManifestTest(checkDatastreamTestCase):
+    def test_save_prunes_datastreams_without_a_local_file(self):
+        self.session.ingest('smith:1', MODS)
+        self.session.ingest('smith:2', MODS)
+        manifest = datastream_manifest.datastreamManifest(self.manifest_path)
+        for number in (1, 2):
+            check_asis_mods_diff.checkDatastream(self.session, self.writeLocal(number, MODS), fake_fedora.FEDORA_CONFIG, manifest=manifest)
+        manifest.save()
+
+        self.check(self.writeLocal(1, MODS))
+        self.assertEqual(list(datastream_manifest.datastreamManifest(self.manifest_path).entries), ['smith:1/MODS'])
+
+    def test_an_unreadable_manifest_is_ignored(self):
+        with open(self.manifest_path, 'w') as fh:
+            fh.write('{"datastreams": {')
+
+        self.assertEqual(datastream_manifest.datastreamManifest(self.manifest_path).entries, {})
+
+
+class iterDifferencesTest(checkDatastreamTestCase):
+    def differences(self, **kwargs):
+        datastreams = check_asis_mods_diff.iterDatastreamsInfo(os.path.join(self.directory.name, '*MODS.xml'))
+        with mock.patch.object(check_asis_mods_diff, 'makeSession', return_value=self.session):
+            return sorted(check_asis_mods_diff.iterDifferences(datastreams, fake_fedora.FEDORA_CONFIG, **kwargs))
+
+    def setUp(self):
+        super().setUp()
+        for number in range(1, 11):
+            self.session.ingest('smith:%s' % number, MODS)
+            self.writeLocal(number, RETITLED if number % 3 == 0 else MODS)
+        # Not ingested, so it can't be compared
+        self.writeLocal(11, MODS)
+
+    def test_differing_pids_are_yielded(self):
+        self.assertEqual(self.differences(), ['smith:3', 'smith:6', 'smith:9'])
+
+    def test_with_several_workers(self):
+        self.assertEqual(self.differences(workers=4), ['smith:3', 'smith:6', 'smith:9'])
+
+    def test_with_several_processes(self):
+        self.assertEqual(self.differences(workers=2, jobs=2, detailed=False), ['smith:3', 'smith:6', 'smith:9'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,340 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import fake_aspace
+
+try:
+    import digitalobjecturiadd
+except ImportError:
+    # digitalobjecturiadd needs the archivesspace module
+    digitalobjecturiadd = None
+
+
+def compassObject(number):
+    return digitalobjecturiadd.makeCompassObject({'PID': 'smith:%s' % number, 'mods_identifier_local_s': 'synthetic_digital_object_%s' % number})
+
+
+def solrDocs(count):
+    return [{'PID': 'smith:%s' % number, 'mods_identifier_local_s': 'synthetic_digital_object_%s' % number} for number in range(1, count + 1)]
+
+
+class stubSolrResponse(object):
+    def __init__(self, page):
+        self.page = page
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.page
+
+
+class stubSolrSession(object):
+    ' Answers Solr select requests from a list of docs, paging with start or cursorMark; cursor marks are the offset of the next doc '
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        params = dict(params)
+        self.requests.append((url, params))
+        rows = int(params['rows'])
+        if 'cursorMark' in params:
+            start = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+        else:
+            start = int(params['start'])
+        docs = self.docs[start:start + rows]
+        page = {'response': {'numFound': len(self.docs), 'start': start, 'docs': docs}}
+        if 'cursorMark' in params:
+            page['nextCursorMark'] = str(start + len(docs)) if docs else params['cursorMark']
+        return stubSolrResponse(page)
+
+
+@unittest.skipIf(digitalobjecturiadd is None, 'the archivesspace module is not installed')
+class iterSolrDocsTest(unittest.TestCase):
+    SOLR_URL = 'http://localhost:8080/solr/select?q=PID:smith*&fl=PID,mods_identifier_local_s&rows=10&start=20&wt=xml'
+
+    def docs(self, count, **kwargs):
+        session = stubSolrSession(solrDocs(count))
+        return list(digitalobjecturiadd.iterSolrDocs(self.SOLR_URL, session=session, **kwargs)), session.requests
+
+    def test_pages_with_start(self):
+        docs, requests = self.docs(7, rows=3)
+
+        self.assertEqual(docs, solrDocs(7))
+        self.assertEqual([params['start'] for url, params in requests], [0, 3, 6])
+
+    def test_stops_at_the_end_of_a_full_last_page(self):
+        docs, requests = self.docs(6, rows=3)
+
+        self.assertEqual(docs, solrDocs(6))
+        self.assertEqual(len(requests), 2)
+
+    def test_no_matches(self):
+        self.assertEqual(self.docs(0, rows=3), ([], [('http://localhost:8080/solr/select', {'q': 'PID:smith*', 'fl': 'PID,mods_identifier_local_s', 'wt': 'json', 'rows': 3, 'start': 0})]))
+
+    def test_the_urls_paging_and_format_are_replaced(self):
+        docs, requests = self.docs(1, rows=3)
+        url, params = requests[0]
+
+        self.assertEqual(url, 'http://localhost:8080/solr/select')
+        self.assertEqual((params['rows'], params['start'], params['wt']), (3, 0, 'json'))
+
+    def test_pages_with_cursor_mark(self):
+        docs, requests = self.docs(7, rows=3, cursor=True)
+
+        self.assertEqual(docs, solrDocs(7))
+        self.assertEqual([params['cursorMark'] for url, params in requests], ['*', '3', '6', '7'])
+        self.assertTrue(all(params['sort'] == digitalobjecturiadd.SOLR_SORT and 'start' not in params for url, params in requests))
+
+    def test_a_cursor_keeps_the_urls_sort(self):
+        session = stubSolrSession(solrDocs(2))
+        list(digitalobjecturiadd.iterSolrDocs(self.SOLR_URL + '&sort=PID+desc', rows=3, cursor=True, session=session))
+
+        self.assertEqual(session.requests[0][1]['sort'], 'PID desc')
+
+
+@unittest.skipIf(digitalobjecturiadd is None, 'the archivesspace module is not installed')
+class iterCompassObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, filename, contents):
+        path = os.path.join(self.directory.name, filename)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def writeSolrOutput(self, docs):
+        return self.write('compass.json', json.dumps({'responseHeader': {'status': 0}, 'response': {'numFound': len(docs), 'start': 0, 'docs': docs}}))
+
+    def test_json_lines(self):
+        path = self.write('compass.jsonl', '\n'.join(json.dumps(doc) for doc in solrDocs(3)) + '\n\n')
+
+        self.assertEqual(list(digitalobjecturiadd.iterCompassObjects(path)), [compassObject(number) for number in (1, 2, 3)])
+
+    @unittest.skipIf(digitalobjecturiadd is None or digitalobjecturiadd.ijson is None, 'ijson is not installed')
+    def test_json_with_ijson(self):
+        path = self.writeSolrOutput(solrDocs(3))
+
+        with mock.patch.object(digitalobjecturiadd.json, 'load', side_effect=AssertionError('loaded whole')):
+            self.assertEqual(list(digitalobjecturiadd.iterCompassObjects(path)), [compassObject(number) for number in (1, 2, 3)])
+
+    def test_json_without_ijson(self):
+        path = self.writeSolrOutput(solrDocs(3))
+
+        with mock.patch.object(digitalobjecturiadd, 'ijson', None), self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(list(digitalobjecturiadd.iterCompassObjects(path)), [compassObject(number) for number in (1, 2, 3)])
+        self.assertIn('ijson is not installed', logs.output[0])
+
+    def test_docs_without_identifiers_are_skipped(self):
+        path = self.write('compass.jsonl', json.dumps({'PID': 'smith:1'}) + '\n' + json.dumps(solrDocs(2)[1]))
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(list(digitalobjecturiadd.iterCompassObjects(path)), [compassObject(2)])
+
+    def test_unparseable_input_raises(self):
+        path = self.write('compass.jsonl', '{"PID": ')
+
+        with self.assertRaises(digitalobjecturiadd.inputFailed):
+            list(digitalobjecturiadd.iterCompassObjects(path))
+
+    def test_a_solr_url_is_paged_through(self):
+        session = stubSolrSession(solrDocs(5))
+
+        with mock.patch.object(digitalobjecturiadd.check_asis_mods_diff, 'makeSession', return_value=session):
+            compass_objects = list(digitalobjecturiadd.iterCompassObjects('http://localhost:8080/solr/select?q=*:*', rows=2))
+
+        self.assertEqual(compass_objects, [compassObject(number) for number in range(1, 6)])
+        self.assertEqual(len(session.requests), 3)
+
+
+@unittest.skipIf(digitalobjecturiadd is None, 'the archivesspace module is not installed')
+class updateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'compass.json.done')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_updates_are_kept_between_runs(self):
+        journal = digitalobjecturiadd.updateJournal(self.path)
+        journal.add('synthetic_digital_object_1')
+        # Written straight away, before the journal is closed
+        self.assertIn('synthetic_digital_object_1', digitalobjecturiadd.updateJournal(self.path))
+        journal.add('synthetic_digital_object_2')
+        journal.close()
+
+        reopened = digitalobjecturiadd.updateJournal(self.path)
+        self.assertIn('synthetic_digital_object_2', reopened)
+        self.assertNotIn('synthetic_digital_object_3', reopened)
+
+    def test_blank_lines_are_ignored(self):
+        with open(self.path, 'w') as fh:
+            fh.write('synthetic_digital_object_1\n\n  \nsynthetic_digital_object_2')
+
+        self.assertEqual(digitalobjecturiadd.updateJournal(self.path).done, set(['synthetic_digital_object_1', 'synthetic_digital_object_2']))
+
+    def test_a_rerun_skips_what_was_done_and_retries_failures(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=3)
+        # Digital Object 9 doesn't exist, so its update fails
+        compass_objects = [compassObject(number) for number in (1, 2, 9, 3)]
+
+        with mock.patch.object(digitalobjecturiadd, 'aspace', fake), contextlib.redirect_stdout(io.StringIO()):
+            journal = digitalobjecturiadd.updateJournal(self.path)
+            first = digitalobjecturiadd.updateAll(compass_objects, journal, workers=2, retries=0)
+            journal.close()
+            journal = digitalobjecturiadd.updateJournal(self.path)
+            second = digitalobjecturiadd.updateAll(compass_objects, journal, workers=2, retries=0)
+            journal.close()
+
+        self.assertEqual(first, {'updated': 3, 'unchanged': 0, 'skipped': 0, 'failed': 1})
+        self.assertEqual(second, {'updated': 0, 'unchanged': 0, 'skipped': 3, 'failed': 1})
+        self.assertEqual(fake.requests['POST ' + fake_aspace.REPO_URI + '/digital_objects/1'], 1)
+        self.assertIn(compassObject(1)['PID'], [file_version['file_uri'] for file_version in fake.records[fake_aspace.REPO_URI + '/digital_objects/1']['file_versions']])
+
+    def test_a_dry_run_journals_nothing(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=3)
+        journal = digitalobjecturiadd.updateJournal(self.path)
+
+        with mock.patch.object(digitalobjecturiadd, 'aspace', fake), contextlib.redirect_stdout(io.StringIO()):
+            counts = digitalobjecturiadd.updateAll([compassObject(1)], journal, dry_run=True)
+        journal.close()
+
+        self.assertEqual(counts['updated'], 1)
+        self.assertNotIn('synthetic_digital_object_1', digitalobjecturiadd.updateJournal(self.path))
+        self.assertFalse(any(uri.startswith('POST ') for uri in fake.requests))
+
+
+@unittest.skipIf(digitalobjecturiadd is None, 'the archivesspace module is not installed')
+class addCompassURITest(unittest.TestCase):
+    def setUp(self):
+        self.compass_uri = compassObject(1)['PID']
+
+    def test_a_missing_uri_is_added(self):
+        digital_object = {'file_versions': [{'file_uri': 'https://compass.example.edu/object/test:1', 'publish': True}]}
+
+        self.assertEqual(digitalobjecturiadd.addCompassURI(digital_object, self.compass_uri), ['add file version %s' % self.compass_uri])
+        self.assertEqual([file_version['file_uri'] for file_version in digital_object['file_versions']], ['https://compass.example.edu/object/test:1', self.compass_uri])
+
+    def test_a_record_without_file_versions_gets_a_published_one(self):
+        digital_object = {}
+
+        self.assertEqual(len(digitalobjecturiadd.addCompassURI(digital_object, self.compass_uri)), 2)
+        self.assertEqual(digital_object['file_versions'], [{'file_uri': self.compass_uri, 'publish': True}])
+
+    def test_a_record_that_already_has_the_uri_is_unchanged(self):
+        digital_object = {'file_versions': [{'file_uri': self.compass_uri, 'publish': True}]}
+
+        self.assertEqual(digitalobjecturiadd.addCompassURI(digital_object, self.compass_uri), [])
+        self.assertEqual(digital_object['file_versions'], [{'file_uri': self.compass_uri, 'publish': True}])
+
+    def test_an_unpublished_first_file_version_is_only_published(self):
+        digital_object = {'file_versions': [{'file_uri': 'https://compass.example.edu/object/test:1', 'publish': False}, {'file_uri': self.compass_uri}]}
+
+        self.assertEqual(digitalobjecturiadd.addCompassURI(digital_object, self.compass_uri), ['publish file version https://compass.example.edu/object/test:1'])
+        self.assertEqual(len(digital_object['file_versions']), 2)
+
+    def test_adding_twice_changes_nothing_the_second_time(self):
+        digital_object = {'file_versions': [{'file_uri': 'https://compass.example.edu/object/test:1'}]}
+        digitalobjecturiadd.addCompassURI(digital_object, self.compass_uri)
+
+        self.assertEqual(digitalobjecturiadd.addCompassURI(digital_object, self.compass_uri), [])
+
+
+@unittest.skipIf(digitalobjecturiadd is None, 'the archivesspace module is not installed')
+class updateAllTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=3)
+        self.do_uri = fake_aspace.REPO_URI + '/digital_objects/1'
+        self.file_versions = self.fake.records[self.do_uri]['file_versions']
+
+    def update(self, compass_objects):
+        with mock.patch.object(digitalobjecturiadd, 'aspace', self.fake), contextlib.redirect_stdout(io.StringIO()):
+            return digitalobjecturiadd.updateAll(compass_objects, workers=2, retries=0)
+
+    def posts(self):
+        return self.fake.requests['POST ' + self.do_uri]
+
+    def test_a_record_that_already_has_the_uri_is_not_saved(self):
+        self.file_versions.append({'file_uri': compassObject(1)['PID']})
+
+        self.assertEqual(self.update([compassObject(1)]), {'updated': 0, 'unchanged': 1, 'skipped': 0, 'failed': 0})
+        self.assertEqual(self.posts(), 0)
+        self.assertEqual(self.fake.records[self.do_uri]['lock_version'], 0)
+
+    def test_a_record_that_only_needs_publishing_is_saved(self):
+        self.file_versions[0]['publish'] = False
+        self.file_versions.append({'file_uri': compassObject(1)['PID']})
+
+        self.assertEqual(self.update([compassObject(1)])['updated'], 1)
+        self.assertEqual(self.posts(), 1)
+        saved = self.fake.records[self.do_uri]['file_versions']
+        self.assertEqual(len(saved), 2)
+        self.assertIs(saved[0]['publish'], True)
+
+    def test_a_second_run_without_a_journal_saves_nothing(self):
+        self.assertEqual(self.update([compassObject(1)])['updated'], 1)
+
+        self.assertEqual(self.update([compassObject(1)]), {'updated': 0, 'unchanged': 1, 'skipped': 0, 'failed': 0})
+        self.assertEqual(self.posts(), 1)
+        self.assertEqual([file_version['file_uri'] for file_version in self.fake.records[self.do_uri]['file_versions']].count(compassObject(1)['PID']), 1)
+
+
+@unittest.skipIf(digitalobjecturiadd is None, 'the archivesspace module is not installed')
+class checkResponseTest(unittest.TestCase):
+    def check(self, response):
+        with self.assertRaises(digitalobjecturiadd.updateFailed) as raised:
+            digitalobjecturiadd.checkResponse(response, 'POST /repositories/2/digital_objects/1')
+        return raised.exception
+
+    def test_records_pass_through(self):
+        self.assertEqual(digitalobjecturiadd.checkResponse({'uri': '/subjects/1'}, 'GET /subjects/1'), {'uri': '/subjects/1'})
+
+    def test_server_errors_are_retried(self):
+        error = self.check({'error': 'Sequel::DatabaseConnectionError'})
+
+        self.assertTrue(error.retryable)
+        self.assertFalse(error.conflict)
+
+    def test_conflicts_are_retried(self):
+        error = self.check({'error': 'The record you tried to update has been modified since you fetched it.'})
+
+        self.assertTrue(error.retryable and error.conflict)
+
+    def test_validation_errors_and_missing_records_are_not_retried(self):
+        self.assertFalse(self.check({'error': {'file_versions/0/file_uri': ['Property is required but was missing']}}).retryable)
+        self.assertFalse(self.check({'error': 'Record not found'}).retryable)
+        self.assertFalse(self.check({'error': 'Access denied'}).retryable)
+
+    def test_an_update_is_retried_after_a_server_error(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=3)
+        post = fake.post
+        responses = [{'error': 'Sequel::DatabaseConnectionError'}]
+
+        def flaky_post(uri, requestData={}):
+            if responses:
+                return responses.pop()
+            return post(uri, requestData)
+
+        with mock.patch.object(digitalobjecturiadd, 'aspace', fake), mock.patch.object(fake, 'post', side_effect=flaky_post), mock.patch('time.sleep'):
+            digital_object_id, changes = digitalobjecturiadd.updateDOwithCompassURI(compassObject(1), retries=1)
+
+        self.assertEqual(digital_object_id, 'synthetic_digital_object_1')
+        self.assertEqual(fake.records[fake_aspace.REPO_URI + '/digital_objects/1']['lock_version'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import fake_aspace
+
+try:
+    import exportASAOtoMODS
+except ImportError:
+    # exportASAOtoMODS needs the archivesspace module
+    exportASAOtoMODS = None
+
+
+def pairs(agents):
+    return [(agent['role'], agent['ref']) for agent in agents]
+
+
+@unittest.skipIf(exportASAOtoMODS is None, 'the archivesspace module is not installed')
+class getAllAgentsTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=0, agents=10)
+        self.parent_uri = self.fake.children[self.fake.resource_uri][0]
+        self.ao_uri = self.fake.children[self.parent_uri][0]
+        self.creator, self.other, self.another = self.fake.agent_uris[0], self.fake.agent_uris[2], self.fake.agent_uris[3]
+        exportASAOtoMODS.useClient(self.fake)
+
+    def allAgents(self, ao_agents, parent_agents=()):
+        self.fake.records[self.ao_uri]['linked_agents'] = list(ao_agents)
+        self.fake.records[self.parent_uri]['linked_agents'] = list(parent_agents)
+        archival_object = exportASAOtoMODS.aspace.get(self.ao_uri)
+        resource = exportASAOtoMODS.aspace.get(self.fake.resource_uri)
+        return exportASAOtoMODS.getAllAgents(archival_object, resource)
+
+    def test_a_creator_linked_from_the_resource_and_the_ao_is_named_once(self):
+        agents = self.allAgents([{'role': 'creator', 'ref': self.creator}, {'role': 'subject', 'ref': self.other}])
+
+        self.assertEqual(pairs(agents), [('creator', self.creator), ('source', self.fake.agent_uris[-1]), ('subject', self.other)])
+
+    def test_resource_then_ao_then_parent_order_is_kept(self):
+        agents = self.allAgents(
+            [{'role': 'subject', 'ref': self.other}, {'role': 'creator', 'ref': self.creator}, {'role': 'subject', 'ref': self.other}],
+            [{'role': 'creator', 'ref': self.another}, {'role': 'subject', 'ref': self.other}])
+
+        self.assertEqual(pairs(agents), [('creator', self.creator), ('source', self.fake.agent_uris[-1]), ('subject', self.other), ('creator', self.another)])
+
+    def test_the_same_agent_in_another_role_is_kept(self):
+        agents = self.allAgents([{'role': 'creator', 'ref': self.creator}, {'role': 'subject', 'ref': self.creator}])
+
+        self.assertEqual(pairs(agents)[2:], [('subject', self.creator)])
+
+    def test_each_agent_is_fetched_once(self):
+        self.allAgents([{'role': 'subject', 'ref': self.other}, {'role': 'creator', 'ref': self.other}], [{'role': 'subject', 'ref': self.other}])
+
+        self.assertEqual(self.fake.requests[self.other], 1)
+
+    def test_name_roles_get_mods_name_types(self):
+        agents = self.allAgents([{'role': 'subject', 'ref': self.other}])
+
+        self.assertEqual([agent['data']['jsonmodel_type'] for agent in agents], ['personal', 'corporate', 'personal'])
+
+
+@unittest.skipIf(exportASAOtoMODS is None, 'the archivesspace module is not installed')
+class getResourceContextTest(unittest.TestCase):
+    THREADS = 8
+
+    def setUp(self):
+        self.fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=2)
+        exportASAOtoMODS.useClient(self.fake)
+        self.builds = []
+        self.build = exportASAOtoMODS.resourceContext
+
+    def slowBuild(self, resource_uri):
+        ' Builds a context slowly enough for the other threads to be waiting on it '
+
+        self.builds.append(resource_uri)
+        time.sleep(0.05)
+        return self.build(resource_uri)
+
+    def getConcurrently(self, build):
+        ' Calls getResourceContext from THREADS threads at once, returning what each got or raised '
+
+        results = [None] * self.THREADS
+        start = threading.Barrier(self.THREADS)
+
+        def get(index):
+            start.wait()
+            try:
+                results[index] = exportASAOtoMODS.getResourceContext(self.fake.resource_uri)
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=get, args=(index,)) for index in range(self.THREADS)]
+        with mock.patch.object(exportASAOtoMODS, 'resourceContext', side_effect=build):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        return results
+
+    def test_concurrent_callers_build_the_context_once(self):
+        results = self.getConcurrently(self.slowBuild)
+
+        self.assertEqual(self.builds, [self.fake.resource_uri])
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(self.fake.requests[self.fake.resource_uri], 1)
+        self.assertEqual(exportASAOtoMODS.resource_contexts_pending, {})
+
+    def test_a_failed_build_releases_the_waiting_threads(self):
+        def failing_first_build(resource_uri):
+            if not self.builds:
+                self.builds.append(resource_uri)
+                time.sleep(0.05)
+                raise RuntimeError('ArchivesSpace went away')
+            return self.slowBuild(resource_uri)
+
+        results = self.getConcurrently(failing_first_build)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        contexts = [result for result in results if not isinstance(result, Exception)]
+        self.assertEqual([str(error) for error in errors], ['ArchivesSpace went away'])
+        # One of the released threads builds it again for the rest
+        self.assertEqual(len(self.builds), 2)
+        self.assertTrue(all(context is contexts[0] for context in contexts))
+        self.assertEqual(exportASAOtoMODS.resource_contexts_pending, {})
+
+    def test_a_failed_build_is_not_kept(self):
+        with mock.patch.object(exportASAOtoMODS, 'resourceContext', side_effect=RuntimeError('ArchivesSpace went away')):
+            with self.assertRaises(RuntimeError):
+                exportASAOtoMODS.getResourceContext(self.fake.resource_uri)
+
+        self.assertIsInstance(exportASAOtoMODS.getResourceContext(self.fake.resource_uri), exportASAOtoMODS.resourceContext)
+
+    def test_each_record_gets_its_own_copy_of_the_context(self):
+        context = exportASAOtoMODS.getResourceContext(self.fake.resource_uri)
+        do_uris = [fake_aspace.REPO_URI + '/digital_objects/%s' % number for number in (1, 2)]
+
+        first = exportASAOtoMODS.getRecordData(do_uris[0])
+        first['resource']['title'] = 'Changed'
+        first['agents'][0]['data']['title'] = 'Changed'
+        second = exportASAOtoMODS.getRecordData(do_uris[1])
+
+        self.assertNotEqual(second['resource']['title'], 'Changed')
+        self.assertNotEqual(second['agents'][0]['data']['title'], 'Changed')
+        self.assertNotEqual(context.resource['title'], 'Changed')
+        self.assertIs(exportASAOtoMODS.getResourceContext(self.fake.resource_uri), context)
+
+
+if __name__ == '__main__':
+    unittest.main()
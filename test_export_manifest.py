@@ -0,0 +1,171 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import export_manifest
+import fake_aspace
+
+
+DO_1 = fake_aspace.REPO_URI + '/digital_objects/1'
+DO_2 = fake_aspace.REPO_URI + '/digital_objects/2'
+DO_3 = fake_aspace.REPO_URI + '/digital_objects/3'
+RESOURCE = fake_aspace.REPO_URI + '/resources/1'
+OTHER_RESOURCE = fake_aspace.REPO_URI + '/resources/2'
+
+
+class manifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2, digital_objects=3, subjects=10, agents=4)
+        self.directory = tempfile.TemporaryDirectory()
+        self.save_path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, manifest, do_uri, filename, input_uris, resource_uri=RESOURCE):
+        ' Writes a file for do_uri and records it as built from input_uris '
+
+        with open(os.path.join(self.save_path, filename), 'w') as fh:
+            fh.write('<mods/>')
+        inputs = dict((uri, [self.fake.records[uri]['lock_version'], self.fake.records[uri]['system_mtime']]) for uri in input_uris)
+        manifest.record(do_uri, filename, inputs, resource_uri)
+
+    def first_run(self):
+        manifest = export_manifest.exportManifest(self.save_path)
+        self.write(manifest, DO_1, 'islandora_1_MODS.xml', [DO_1, '/subjects/1', '/agents/people/1'])
+        self.write(manifest, DO_2, 'islandora_2_MODS.xml', [DO_2, '/subjects/2', '/agents/people/1'])
+        manifest.walkedResource(RESOURCE)
+        manifest.save()
+
+
+class exportManifestTest(manifestTestCase):
+    def test_everything_is_exported_without_a_manifest(self):
+        manifest = export_manifest.exportManifest(self.save_path)
+
+        self.assertIsNone(manifest.last_run)
+        self.assertFalse(manifest.isCurrent(DO_1))
+
+    def test_unchanged_records_are_current(self):
+        self.first_run()
+        manifest = export_manifest.exportManifest(self.save_path)
+        manifest.findChanges(self.fake)
+
+        self.assertEqual(manifest.changed, set())
+        self.assertTrue(manifest.isCurrent(DO_1))
+        self.assertTrue(manifest.isCurrent(DO_2))
+        self.assertEqual(manifest.skipped, 2)
+
+    def test_a_modified_input_makes_its_records_stale(self):
+        self.first_run()
+        self.fake.touch('/subjects/1')
+        manifest = export_manifest.exportManifest(self.save_path)
+        manifest.findChanges(self.fake)
+
+        self.assertEqual(manifest.changed, set(['/subjects/1']))
+        self.assertFalse(manifest.isCurrent(DO_1))
+        self.assertTrue(manifest.isCurrent(DO_2))
+
+    def test_a_missing_file_is_exported_again(self):
+        self.first_run()
+        os.remove(os.path.join(self.save_path, 'islandora_2_MODS.xml'))
+        manifest = export_manifest.exportManifest(self.save_path)
+        manifest.findChanges(self.fake)
+
+        self.assertFalse(manifest.isCurrent(DO_2))
+
+    def test_save_prunes_records_not_seen_in_a_walked_resource(self):
+        self.first_run()
+        manifest = export_manifest.exportManifest(self.save_path)
+        manifest.isCurrent(DO_1)
+        manifest.walkedResource(RESOURCE)
+        manifest.save()
+
+        self.assertEqual(list(export_manifest.exportManifest(self.save_path).records), [DO_1])
+
+    def test_save_keeps_records_of_other_resources(self):
+        self.first_run()
+        manifest = export_manifest.exportManifest(self.save_path)
+        self.write(manifest, DO_3, 'islandora_3_MODS.xml', [DO_3], OTHER_RESOURCE)
+        manifest.walkedResource(OTHER_RESOURCE)
+        manifest.save()
+
+        self.assertEqual(sorted(export_manifest.exportManifest(self.save_path).records), [DO_1, DO_2, DO_3])
+
+    def test_save_keeps_everything_when_nothing_was_walked(self):
+        # e.g. a mistyped resource ID
+        self.first_run()
+        export_manifest.exportManifest(self.save_path).save()
+
+        self.assertEqual(sorted(export_manifest.exportManifest(self.save_path).records), [DO_1, DO_2])
+
+    def test_entries_without_a_resource_pick_it_up_when_checked(self):
+        manifest = export_manifest.exportManifest(self.save_path)
+        self.write(manifest, DO_1, 'islandora_1_MODS.xml', [DO_1], None)
+        manifest.save()
+        manifest = export_manifest.exportManifest(self.save_path)
+        manifest.isCurrent(DO_1, RESOURCE)
+
+        self.assertEqual(manifest.records[DO_1]['resource'], RESOURCE)
+
+    def test_save_without_advance_keeps_the_last_run_time(self):
+        self.first_run()
+        manifest = export_manifest.exportManifest(self.save_path)
+        last_run = manifest.last_run
+        manifest.save(prune=False, advance=False)
+
+        reloaded = export_manifest.exportManifest(self.save_path)
+        self.assertEqual(reloaded.last_run, last_run)
+        self.assertEqual(len(reloaded.records), 2)
+
+    def test_an_unreadable_manifest_exports_everything(self):
+        with open(os.path.join(self.save_path, export_manifest.MANIFEST_FILENAME), 'w') as fh:
+            fh.write('{"records": ')
+        manifest = export_manifest.exportManifest(self.save_path)
+
+        self.assertEqual(manifest.records, {})
+        self.assertFalse(manifest.isCurrent(DO_1))
+
+
+class dependencyIndexTest(manifestTestCase):
+    def test_index_maps_each_input_to_its_dependents(self):
+        self.first_run()
+        index = export_manifest.exportManifest(self.save_path).getDependencyIndex()
+
+        self.assertEqual(index['/agents/people/1'], {'digital_objects': [DO_1, DO_2], 'filenames': ['islandora_1_MODS.xml', 'islandora_2_MODS.xml']})
+        self.assertEqual(index['/subjects/2']['digital_objects'], [DO_2])
+        # A Digital Object isn't listed as depending on itself
+        self.assertNotIn(DO_1, index)
+
+    def test_dependents_of_changed_uris(self):
+        self.first_run()
+        manifest = export_manifest.exportManifest(self.save_path)
+
+        self.assertEqual(manifest.dependentsOf(['/agents/people/1']), [DO_1, DO_2])
+        self.assertEqual(manifest.dependentsOf(['/subjects/1', '/subjects/9']), [DO_1])
+        self.assertEqual(manifest.dependentsOf([DO_2]), [DO_2])
+        self.assertEqual(manifest.dependentsOf(['/subjects/9']), [])
+
+    def test_the_index_is_rebuilt_if_missing(self):
+        self.first_run()
+        os.remove(os.path.join(self.save_path, export_manifest.DEPENDENCY_INDEX_FILENAME))
+
+        self.assertEqual(export_manifest.exportManifest(self.save_path).dependentsOf(['/subjects/2']), [DO_2])
+
+    def test_the_saved_index_is_used(self):
+        self.first_run()
+        with open(os.path.join(self.save_path, export_manifest.DEPENDENCY_INDEX_FILENAME)) as fh:
+            saved = json.load(fh)
+        manifest = export_manifest.exportManifest(self.save_path)
+
+        self.assertEqual(saved, manifest.getDependencyIndex())
+        with mock.patch.object(manifest, 'getDependencyIndex') as getDependencyIndex:
+            manifest.dependentsOf(['/subjects/1'])
+        getDependencyIndex.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
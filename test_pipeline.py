@@ -0,0 +1,82 @@
+import threading
+import unittest
+
+import pipeline
+
+
+class recordPipelineTest(unittest.TestCase):
+    def test_items_flow_through_every_stage(self):
+        written = []
+        export = pipeline.recordPipeline()
+        export.addStage('double', lambda item: [item, item], workers=3)
+        export.addStage('square', lambda item: [item * item], workers=2)
+        export.addStage('write', lambda item: written.append(item) or [])
+        export.run('source', range(50))
+
+        self.assertEqual(sorted(written), sorted([n * n for n in range(50)] * 2))
+
+    def test_batched_stages_get_lists(self):
+        batches = []
+        export = pipeline.recordPipeline()
+        export.addStage('batch', lambda batch: batches.append(batch) or [], batch_size=10)
+        export.run('source', range(95))
+
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        self.assertEqual(sorted(item for batch in batches for item in batch), list(range(95)))
+
+    def test_a_failing_stage_stops_the_pipeline_and_raises(self):
+        written = []
+
+        def render(item):
+            if item == 5:
+                raise ValueError('bad record %s' % item)
+            return [item]
+
+        export = pipeline.recordPipeline(queue_size=2)
+        export.addStage('render', render, workers=2)
+        export.addStage('write', lambda item: written.append(item) or [])
+        with self.assertRaisesRegex(ValueError, 'bad record 5'):
+            # Far more items than fit in the queues, so the source has to give up too
+            export.run('source', range(10000))
+
+        self.assertTrue(export.aborted.is_set())
+        self.assertLess(len(written), 10000)
+
+    def test_a_failing_source_raises(self):
+        def source():
+            yield 1
+            raise IOError('tree walk failed')
+
+        export = pipeline.recordPipeline()
+        export.addStage('write', lambda item: [])
+        with self.assertRaisesRegex(IOError, 'tree walk failed'):
+            export.run('source', source())
+
+    def test_only_the_first_error_is_raised(self):
+        started = threading.Barrier(2)
+
+        def fail(item):
+            started.wait()
+            raise ValueError('failure %s' % item)
+
+        export = pipeline.recordPipeline()
+        export.addStage('fail', fail, workers=2)
+        with self.assertRaises(ValueError):
+            export.run('source', [1, 2])
+
+        self.assertIn(str(export.error), ('failure 1', 'failure 2'))
+
+    def test_no_threads_are_left_running(self):
+        before = threading.active_count()
+        export = pipeline.recordPipeline(queue_size=1)
+        export.addStage('fail', lambda item: 1 / 0, workers=4)
+        export.addStage('write', lambda item: [], workers=4)
+        with self.assertRaises(ZeroDivisionError):
+            export.run('source', range(1000))
+
+        # run joins every thread before raising
+        self.assertEqual(threading.active_count(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
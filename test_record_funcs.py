@@ -0,0 +1,110 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import fake_aspace
+
+try:
+    import record_funcs
+except ImportError:
+    # record_funcs needs the archivesspace module
+    record_funcs = None
+
+
+def preorder(fake, uri):
+    ' The Archival Objects under uri in the fake\'s tree, parents before their children '
+
+    uris = []
+    for child in fake.children[uri]:
+        uris.append(child)
+        uris.extend(preorder(fake, child))
+    return uris
+
+
+@unittest.skipIf(record_funcs is None, 'the archivesspace module is not installed')
+class walkResourceTreeTest(unittest.TestCase):
+    def test_walks_parents_before_their_children(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=3, fanout=3, digital_objects=5)
+        walked = list(record_funcs.aspaceRecordFuncs(fake).walkResourceTree(fake_aspace.RESOURCE_NUM))
+
+        self.assertEqual([uri for uri, has_digital_instance in walked], preorder(fake, fake.resource_uri))
+
+    def test_reports_which_nodes_have_digital_objects(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=3, fanout=3, digital_objects=5)
+        walked = record_funcs.aspaceRecordFuncs(fake).walkResourceTree(fake_aspace.RESOURCE_NUM)
+        with_digital_objects = [uri for uri, has_digital_instance in walked if has_digital_instance]
+
+        self.assertEqual(len(with_digital_objects), 5)
+        for uri in with_digital_objects:
+            self.assertTrue(any('digital_object' in instance for instance in fake.records[uri]['instances']))
+
+    def test_fetches_waypoints_past_the_precomputed_one(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=fake_aspace.WAYPOINT_SIZE * 2 + 1, digital_objects=0)
+        uris = record_funcs.aspaceRecordFuncs(fake).getAllResourceUris(fake_aspace.RESOURCE_NUM)
+
+        self.assertEqual(uris, fake.children[fake.resource_uri])
+        self.assertEqual(sum(count for uri, count in fake.requests.items() if '/tree/waypoint' in uri), 2)
+
+    def test_only_nodes_with_children_are_fetched(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=4, digital_objects=0)
+        list(record_funcs.aspaceRecordFuncs(fake).walkResourceTree(fake_aspace.RESOURCE_NUM))
+
+        node_requests = sum(count for uri, count in fake.requests.items() if '/tree/node' in uri)
+        self.assertEqual(node_requests, 4)
+
+    def test_digital_only_leaves_out_nodes_without_digital_objects(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=4, digital_objects=3)
+        uris = record_funcs.aspaceRecordFuncs(fake).getAllResourceUris(fake_aspace.RESOURCE_NUM, digital_only=True)
+
+        self.assertEqual(len(uris), 3)
+
+    def test_a_missing_resource_raises(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2)
+
+        with self.assertRaisesRegex(record_funcs.aspaceError, 'resources/99/tree/root'):
+            list(record_funcs.aspaceRecordFuncs(fake).walkResourceTree(99))
+
+    def test_an_error_for_a_node_raises(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=2)
+        get = fake.get
+
+        def forbidden_nodes(uri, *args, **kwargs):
+            if '/tree/node' in uri:
+                return {'error': 'Access denied'}
+            return get(uri, *args, **kwargs)
+
+        with mock.patch.object(fake, 'get', side_effect=forbidden_nodes):
+            with self.assertRaisesRegex(record_funcs.aspaceError, 'Access denied'):
+                list(record_funcs.aspaceRecordFuncs(fake).walkResourceTree(fake_aspace.RESOURCE_NUM))
+
+
+@unittest.skipIf(record_funcs is None, 'the archivesspace module is not installed')
+class getSubjectsTest(unittest.TestCase):
+    def test_subjects_are_normalized_with_a_plain_client(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=1, digital_objects=0, subjects=10)
+        fake.records['/subjects/1'].update({'source': 'naf', 'authority_id': 'n82'})
+        subjects = record_funcs.aspaceRecordFuncs(fake).getSubjects({'uri': fake.resource_uri, 'subjects': [{'ref': '/subjects/1'}]})
+
+        self.assertEqual(subjects[0]['authority_id'], 'http://id.loc.gov/authorities/names/n82')
+
+
+@unittest.skipIf(record_funcs is None, 'the archivesspace module is not installed')
+class iterResourcesWithDigitalObjectsTest(unittest.TestCase):
+    def test_finds_the_resource_once(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=3, digital_objects=9)
+
+        self.assertEqual(list(record_funcs.aspaceRecordFuncs(fake).iterResourcesWithDigitalObjects(2, batch_size=2)), [fake_aspace.RESOURCE_NUM])
+
+    def test_yields_before_reading_every_digital_object(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=2, fanout=3, digital_objects=9)
+        resources = record_funcs.aspaceRecordFuncs(fake).iterResourcesWithDigitalObjects(2, batch_size=0)
+        next(resources)
+
+        do_requests = [uri for uri in fake.requests if '/digital_objects/' in uri]
+        self.assertEqual(do_requests, [fake_aspace.REPO_URI + '/digital_objects/1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
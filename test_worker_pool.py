@@ -0,0 +1,53 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+import fake_aspace
+import worker_pool
+
+
+class mapInOrderTest(unittest.TestCase):
+    def test_results_come_back_in_order(self):
+        def slow_square(n):
+            time.sleep(0.001 * (10 - n))
+            return n * n
+
+        for workers in (0, 1, 4):
+            self.assertEqual(list(worker_pool.mapInOrder(slow_square, range(10), workers)), [n * n for n in range(10)])
+
+
+class aspaceRequestLimiterTest(unittest.TestCase):
+    def test_requests_in_flight_are_capped(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=1, subjects=20)
+        limiter = worker_pool.aspaceRequestLimiter(fake, 2)
+        in_flight = [0]
+        most_in_flight = [0]
+        lock = threading.Lock()
+        get = fake.get
+
+        def counting_get(uri, *args, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+            time.sleep(0.005)
+            with lock:
+                in_flight[0] -= 1
+            return get(uri, *args, **kwargs)
+
+        fake.get = counting_get
+        list(worker_pool.mapInOrder(limiter.get, fake.subject_uris, 8))
+
+        self.assertEqual(most_in_flight[0], 2)
+
+    def test_no_requests_in_flight_is_taken_as_one(self):
+        fake = fake_aspace.fakeArchivesSpace(depth=1, fanout=1)
+        limiter = worker_pool.aspaceRequestLimiter(fake, 0)
+
+        self.assertEqual(limiter.get('/subjects/1')['title'], 'Subject 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
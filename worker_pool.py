@@ -0,0 +1,47 @@
+"""Helpers for spreading ArchivesSpace requests and record rendering over a
+pool of worker threads without overloading the server.
+"""
+import collections
+import concurrent.futures
+import threading
+
+
+def mapInOrder(func, items, workers=1):
+    ' Calls func on each of items using up to workers threads and yields the results in the same order as items '
+
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # Only keep a couple of items per worker queued up so results don't pile up in memory
+    window = workers * 2
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+class aspaceRequestLimiter(object):
+    ' Wraps an aspace client so that no more than max_in_flight requests are made at once across all threads '
+
+    def __init__(self, aspace, max_in_flight):
+        self.aspace = aspace
+        # With no requests allowed in flight every request would wait forever
+        self.max_in_flight = max(max_in_flight, 1)
+        self.semaphore = threading.BoundedSemaphore(self.max_in_flight)
+
+    def get(self, *args, **kwargs):
+        with self.semaphore:
+            return self.aspace.get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        with self.semaphore:
+            return self.aspace.post(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.aspace, name)
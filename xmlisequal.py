@@ -17,13 +17,66 @@ Doe NOT ignore differences in order:
 False
 >>> 
 
+Identical records, or records that are the same once canonicalized (C14N with
+comments and whitespace only text dropped), are reported equal without
+running xmldiff, which is slow on large records:
+
+>>> xmlisequal.canonicalize("<xml> <mytag b='2' a='1'>Hello</mytag><!-- note --> </xml>")
+b'<xml><mytag a="1" b="2">Hello</mytag></xml>'
+>>> xml1 = "<xml><mytag>Hello</mytag></xml>"
+>>> xml2 = "<xml><mytag>Goodbye</mytag></xml>"
+>>> xmlisequal.xmlIsEqual(xml1, xml2, detailed=False)
+False
+>>> 
+
+xmldiff is only run when the canonical forms differ and a detailed report of
+the differences is wanted, which is the default.
 """
 from xmldiff import main as xmldiffmain
 import xmldiff
+from lxml import etree
+import hashlib
 import re
 import logging
 
-def xmlIsEqual(old, new, pid=''):
+def canonicalize(xml):
+    """Returns the C14N form of an XML string or bytes, without comments and
+    whitespace only text."""
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    parser = etree.XMLParser(remove_comments=True, remove_blank_text=True)
+    root = etree.fromstring(xml, parser)
+    for element in root.iter():
+        if element.text is not None and len(element.text.strip()) == 0:
+            element.text = None
+        if element.tail is not None and len(element.tail.strip()) == 0:
+            element.tail = None
+    return etree.tostring(root, method='c14n')
+
+def canonicalHash(xml):
+    """Returns a SHA-256 hex digest of the canonical form of xml."""
+    return hashlib.sha256(canonicalize(xml)).hexdigest()
+
+# Stands in for the detailed differences when they weren't asked for
+CANONICAL_DIFFERENCE = 'canonical forms differ'
+
+def getFilteredDifferences(old, new, pid='', detailed=True):
+    """Returns the list of real differences between two XML records, empty
+    if they are equal. Without detailed, records whose canonical forms differ
+    get [CANONICAL_DIFFERENCE] instead of the xmldiff actions."""
+    if old == new:
+        return []
+
+    try:
+        if canonicalize(old) == canonicalize(new):
+            logging.debug("Canonical forms match for %s" % pid)
+            return []
+    except (etree.XMLSyntaxError, ValueError) as e:
+        logging.debug("Could not canonicalize %s, comparing with xmldiff: %s" % (pid, e))
+    else:
+        if not detailed:
+            return [CANONICAL_DIFFERENCE]
+
     diff = xmldiffmain.diff_texts(old, new, diff_options={'F': 0.5, 'ratio_mode': 'fast'})
     diffFiltered = []
     for difference in diff:
@@ -44,6 +97,10 @@ def xmlIsEqual(old, new, pid=''):
             logging.debug("This one didn't match any of my filters, adding %s" % str(difference))
             diffFiltered.append(difference)
 
+    return diffFiltered
+
+def xmlIsEqual(old, new, pid='', detailed=True):
+    diffFiltered = getFilteredDifferences(old, new, pid=pid, detailed=detailed)
     if len(diffFiltered) > 0:
         for difference in diffFiltered:
             logging.info("Difference %s: %s" % (pid,str(difference)))